@@ -1,36 +1,43 @@
 from fastapi import FastAPI, Response
 from fastapi.responses import JSONResponse
 import os
+from utils.metrics import render_metrics, CONTENT_TYPE_LATEST
+from utils.health import HealthChecker
 
 app = FastAPI()
+# main.py attaches the bot when both run in one process
+health_checker = HealthChecker()
 
 @app.get("/")
 async def root():
     return {"message": "Bot API is running"}
 
 @app.get("/health")
+@app.get("/health/ready")
 async def health_check():
-    # Check if required environment variables are set
-    required_vars = ["TELEGRAM_BOT_TOKEN", "OPENAI_API_KEY"]
-    missing_vars = [var for var in required_vars if not os.getenv(var)]
-    
-    if missing_vars:
-        return JSONResponse(
-            status_code=500,
-            content={
-                "status": "error",
-                "message": f"Missing required environment variables: {', '.join(missing_vars)}"
-            }
-        )
-    
-    return JSONResponse(
-        content={
-            "status": "healthy",
-            "environment": "production" if os.getenv("RAILWAY_ENVIRONMENT") else "development"
-        }
-    )
+    """Readiness: config, database, upstream circuits and, in main.py, the bot and event loop"""
+    return _health_response(await health_checker.readiness())
+
+@app.get("/health/live")
+async def liveness_check():
+    """Liveness: fails when the bot's polling has stopped or stalled"""
+    return _health_response(await health_checker.liveness())
+
+def _health_response(result: dict) -> JSONResponse:
+    result = {
+        **result,
+        "environment": "production" if os.getenv("RAILWAY_ENVIRONMENT") else "development"
+    }
+    return JSONResponse(status_code=503 if result["status"] == "fail" else 200, content=result)
+
+@app.get("/metrics")
+async def metrics():
+    return Response(content=render_metrics(), media_type=CONTENT_TYPE_LATEST)
 
 # For local development
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=int(os.getenv("PORT", "3000"))) 
\ No newline at end of file
+    from utils.logging_config import configure_logging
+    configure_logging(os.path.join(os.path.dirname(__file__), 'logs', 'api.log'))
+    # Use the process-wide logging pipeline instead of uvicorn's own handlers
+    uvicorn.run(app, host="0.0.0.0", port=int(os.getenv("PORT", "3000")), log_config=None) 
\ No newline at end of file
@@ -0,0 +1,140 @@
+"""Storage saved and read/write cost of compressing Message content.
+
+Stores the same messages with compression off and on (in-memory SQLite)
+through the bot's own write path, search indexing included, and reports
+content bytes, database size, and the time to write the rows and to load
+them and read `content`. Messages are sampled from a real database with
+--database-url, or generated to look like chat answers (prose, lists and
+code, Russian and English).
+
+Run from project_root:
+    python -m benchmarks.bench_compression
+    python -m benchmarks.bench_compression --database-url sqlite:///bot.db --sample 5000
+"""
+import argparse
+import os
+import random
+import statistics
+import time
+
+os.environ['DATABASE_URL'] = 'sqlite://'
+
+from sqlalchemy import create_engine, text  # noqa: E402
+from sqlalchemy.orm import sessionmaker  # noqa: E402
+from sqlalchemy.pool import StaticPool  # noqa: E402
+
+import utils.database as database  # noqa: E402
+from utils.database import Message, create_schema  # noqa: E402
+from handlers.history import HistoryHandler  # noqa: E402
+
+WORDS_RU = ("запрос база данных индекс ответ сервер настройка модель память поток "
+            "пример функция значение таблица ошибка время пользователь данные").split()
+WORDS_EN = ("query database index response server config model memory stream "
+            "example function value table error latency user payload cache").split()
+
+
+def synthetic_answer(rng: random.Random) -> str:
+    """An assistant-style answer: paragraphs, a list and sometimes a code block"""
+    words = WORDS_RU if rng.random() < 0.6 else WORDS_EN
+    parts = []
+    for _ in range(rng.randint(1, 5)):
+        sentence_count = rng.randint(2, 6)
+        parts.append(' '.join(
+            ' '.join(rng.choice(words) for _ in range(rng.randint(6, 16))).capitalize() + '.'
+            for _ in range(sentence_count)
+        ))
+    if rng.random() < 0.5:
+        parts.append('\n'.join(f"{i}. {' '.join(rng.choices(words, k=rng.randint(3, 8)))}"
+                               for i in range(1, rng.randint(3, 8))))
+    if rng.random() < 0.3:
+        name = rng.choice(WORDS_EN)
+        parts.append(f"```python\ndef {name}(value):\n    result = {rng.randint(1, 99)} * value\n"
+                     f"    return result  # {' '.join(rng.choices(words, k=4))}\n```")
+    return '\n\n'.join(parts)
+
+
+def load_sample(database_url: str, size: int) -> list:
+    engine = create_engine(database_url)
+    with sessionmaker(bind=engine)() as session:
+        messages = session.query(Message).order_by(Message.id.desc()).limit(size).all()
+        return [(m.role, m.content) for m in messages if m.content]
+
+
+def generate_sample(size: int, seed: int) -> list:
+    rng = random.Random(seed)
+    sample = []
+    for _ in range(size):
+        question = ' '.join(rng.choices(WORDS_RU + WORDS_EN, k=rng.randint(4, 20))) + '?'
+        sample.append(('user', question))
+        sample.append(('assistant', synthetic_answer(rng)))
+    return sample
+
+
+def measure(sample: list, threshold: int, rounds: int) -> dict:
+    database.MESSAGE_COMPRESSION_THRESHOLD = threshold
+    engine = create_engine('sqlite://', poolclass=StaticPool)
+    create_schema(engine)
+    Session = sessionmaker(bind=engine)
+
+    # One transaction per message, as HistoryHandler.save_message runs them
+    handler = HistoryHandler()
+    started = time.perf_counter()
+    with Session() as session:
+        for role, content in sample:
+            handler._save_message(session, 1, content, role)
+            session.commit()
+    write_seconds = time.perf_counter() - started
+
+    read_times = []
+    for _ in range(rounds):
+        started = time.perf_counter()
+        with Session() as session:
+            total_chars = sum(len(m.content) for m in session.query(Message).all())
+        read_times.append(time.perf_counter() - started)
+
+    with engine.connect() as connection:
+        stored = connection.execute(text(
+            "SELECT COALESCE(SUM(LENGTH(CAST(content AS BLOB))), 0) + "
+            "COALESCE(SUM(LENGTH(content_compressed)), 0), "
+            "SUM(content_format IS NOT NULL) FROM messages"
+        )).one()
+        pages = connection.execute(text("PRAGMA page_count")).scalar()
+        page_size = connection.execute(text("PRAGMA page_size")).scalar()
+    return {
+        'content_bytes': stored[0],
+        'compressed_rows': stored[1] or 0,
+        'db_bytes': pages * page_size,
+        'write_us_per_row': write_seconds / len(sample) * 1e6,
+        'read_us_per_row': statistics.median(read_times) / len(sample) * 1e6,
+        'chars': total_chars,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--database-url', help='sample real messages from this database')
+    parser.add_argument('--sample', type=int, default=2000, help='messages to sample or conversations to generate')
+    parser.add_argument('--threshold', type=int, default=database.MESSAGE_COMPRESSION_THRESHOLD,
+                        help='compression threshold in bytes')
+    parser.add_argument('--rounds', type=int, default=5, help='timed read passes')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    sample = load_sample(args.database_url, args.sample) if args.database_url else generate_sample(args.sample, args.seed)
+    raw_bytes = sum(len(content.encode('utf-8')) for _, content in sample)
+    print(f"{len(sample)} messages, {raw_bytes / 1e6:.2f} MB of text, threshold {args.threshold} bytes\n")
+
+    plain = measure(sample, 0, args.rounds)
+    compressed = measure(sample, args.threshold, args.rounds)
+    assert plain['chars'] == compressed['chars'], "content differs after compression"
+
+    print(f"{'':>22}{'plain':>12}{'compressed':>14}{'change':>10}")
+    for key, label in (('content_bytes', 'content bytes'), ('db_bytes', 'database bytes'),
+                       ('write_us_per_row', 'write us/row'), ('read_us_per_row', 'read us/row')):
+        change = compressed[key] / plain[key] - 1 if plain[key] else 0
+        print(f"{label:>22}{plain[key]:12.1f}{compressed[key]:14.1f}{change:+10.1%}")
+    print(f"{'compressed rows':>22}{'':>12}{compressed['compressed_rows']:14d}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,263 @@
+"""Microbenchmarks for the per-message hot path on in-memory SQLite.
+
+Covers group-mention parsing, settings lookup, history save, load and search,
+stream chunk accumulation and the /history text builder. Each run is saved to
+benchmarks/.results/ and compared with the previous run (or --compare FILE);
+the exit status is 1 when any benchmark got slower than --threshold.
+
+Run from project_root:
+    python -m benchmarks.bench_hotpath
+    python -m benchmarks.bench_hotpath --compare benchmarks/.results/<run>.json --threshold 0.1
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+from datetime import datetime
+from pathlib import Path
+from types import SimpleNamespace
+
+os.environ['DEBUG_MODE'] = 'False'
+os.environ['DATABASE_URL'] = 'sqlite://'
+os.environ.pop('TRACING_EXPORT_FILE', None)
+
+from sqlalchemy import create_engine  # noqa: E402
+from sqlalchemy.pool import StaticPool  # noqa: E402
+
+import handlers.chat as chat_module  # noqa: E402
+import handlers.history as history_module  # noqa: E402
+from bot import TelegramBot  # noqa: E402
+from utils.addressing import ADDRESSED_TO_BOT, strip_bot_mention  # noqa: E402
+from utils.database import create_schema  # noqa: E402
+from utils.settings_store import text_settings  # noqa: E402
+
+RESULTS_DIR = Path(__file__).parent / '.results'
+BOT_USERNAME = 'bench_bot'
+USER_ID = 4242
+
+
+def use_in_memory_db():
+    """Point the shared session factory at one in-memory database"""
+    engine = create_engine(
+        'sqlite://', poolclass=StaticPool, connect_args={'check_same_thread': False}
+    )
+    create_schema(engine)
+    # Every module gets the same factory from init_db()
+    history_module.Session.configure(bind=engine)
+    return engine
+
+
+def mention_entity(offset: int, length: int) -> SimpleNamespace:
+    return SimpleNamespace(type='mention', offset=offset, length=length)
+
+
+BENCH_BOT = SimpleNamespace(username=BOT_USERNAME, id=1)
+
+
+def group_update(text: str, entities=None) -> SimpleNamespace:
+    message = SimpleNamespace(
+        text=text, entities=entities or [], caption=None, caption_entities=None,
+        photo=None, reply_to_message=None, chat=SimpleNamespace(type='supergroup'),
+        get_bot=lambda: BENCH_BOT
+    )
+    return SimpleNamespace(
+        message=message,
+        effective_chat=SimpleNamespace(type='supergroup'),
+        effective_user=SimpleNamespace(id=USER_ID),
+    )
+
+
+def stream_chunks(count: int):
+    tokens = [f"word{i}{'.' if i % 12 == 11 else ''} " for i in range(count)]
+    return [
+        SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=token))])
+        for token in tokens
+    ]
+
+
+async def build_benchmarks():
+    history = history_module.HistoryHandler()
+    chat = chat_module.ChatHandler(history)
+    bot = TelegramBot.__new__(TelegramBot)
+    context = SimpleNamespace(bot=BENCH_BOT, user_data={})
+
+    # Seed a user with settings and a realistic amount of history
+    await chat.get_user_settings(USER_ID)
+    for i in range(200):
+        await history.save_message(USER_ID, f"message {i} " * 20, role='user' if i % 2 else 'assistant')
+    history_page = await history.get_user_history(USER_ID)
+
+    # Streaming without network or Telegram: chunks come from memory, edits are no-ops
+    chunks = stream_chunks(300)
+    settings = {'model': 'bench-model'}
+
+    async def completion_chunks(settings, text):
+        for chunk in chunks:
+            yield chunk
+
+    async def safe_edit(message, text):
+        return True
+
+    chat._completion_chunks = completion_chunks
+    chat._safe_edit = safe_edit
+
+    long_text = 'hello there ' * 40
+    mention = f"@{BOT_USERNAME}"
+    entity_text = f"hey {mention} {long_text}"
+    entities = [mention_entity(0, 3), mention_entity(4, len(mention))]
+    unaddressed = group_update(long_text, [mention_entity(0, 5)])
+
+    async def mention_at_start():
+        strip_bot_mention(f"{mention} {long_text}", None, BOT_USERNAME)
+
+    async def mention_entity_match():
+        strip_bot_mention(entity_text, entities, BOT_USERNAME)
+
+    async def dispatch_unaddressed():
+        await bot._dispatch_message(unaddressed, context)
+
+    async def filter_unaddressed():
+        ADDRESSED_TO_BOT.filter(unaddressed.message)
+
+    async def get_user_settings():
+        await chat.get_user_settings(USER_ID)
+
+    async def get_user_settings_uncached():
+        text_settings.invalidate(USER_ID)
+        await chat.get_user_settings(USER_ID)
+
+    async def save_message():
+        await history.save_message(USER_ID, long_text)
+
+    async def get_user_history():
+        await history.get_user_history(USER_ID)
+
+    async def consume_stream():
+        await chat._consume_stream(settings, 'question', None)
+
+    async def search_history():
+        await history._search_page(USER_ID, 'message 1', 0)
+
+    async def format_history():
+        history_module.format_history(history_page)
+
+    # name -> (coroutine function, calls per round)
+    return {
+        'mention_at_start': (mention_at_start, 20000),
+        'mention_entity': (mention_entity_match, 20000),
+        'dispatch_unaddressed': (dispatch_unaddressed, 20000),
+        'filter_unaddressed': (filter_unaddressed, 20000),
+        'get_user_settings': (get_user_settings, 500),
+        'get_user_settings_uncached': (get_user_settings_uncached, 500),
+        'save_message': (save_message, 300),
+        'get_user_history': (get_user_history, 500),
+        'consume_stream_300_chunks': (consume_stream, 200),
+        'format_history': (format_history, 5000),
+        'search_history': (search_history, 500),
+    }
+
+
+async def measure(func, calls: int, rounds: int) -> dict:
+    await func()  # warm up
+    per_call = []
+    for _ in range(rounds):
+        started = time.perf_counter()
+        for _ in range(calls):
+            await func()
+        per_call.append((time.perf_counter() - started) / calls * 1e6)
+    return {
+        'median_us': statistics.median(per_call),
+        'min_us': min(per_call),
+        'stdev_us': statistics.stdev(per_call) if len(per_call) > 1 else 0.0,
+        'calls': calls,
+        'rounds': rounds,
+    }
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def previous_run(exclude: Path = None):
+    runs = sorted(p for p in RESULTS_DIR.glob('*.json') if p != exclude)
+    return runs[-1] if runs else None
+
+
+def compare(current: dict, baseline: dict, threshold: float) -> list:
+    regressions = []
+    print(f"\n{'benchmark':>26}  {'baseline':>10}  {'current':>10}  change")
+    for name, result in current['benchmarks'].items():
+        old = baseline['benchmarks'].get(name)
+        if not old:
+            print(f"{name:>26}  {'-':>10}  {result['median_us']:10.2f}  new")
+            continue
+        change = result['median_us'] / old['median_us'] - 1
+        flag = ''
+        if change > threshold:
+            regressions.append(name)
+            flag = '  REGRESSION'
+        print(f"{name:>26}  {old['median_us']:10.2f}  {result['median_us']:10.2f}  {change:+7.1%}{flag}")
+    return regressions
+
+
+async def run(args) -> dict:
+    use_in_memory_db()
+    benchmarks = await build_benchmarks()
+    results = {}
+    for name, (func, calls) in benchmarks.items():
+        if args.only and name not in args.only:
+            continue
+        calls = max(1, int(calls * args.scale))
+        results[name] = await measure(func, calls, args.rounds)
+        print(f"{name:>26}: {results[name]['median_us']:10.2f} us/call "
+              f"(min {results[name]['min_us']:.2f}, stdev {results[name]['stdev_us']:.2f})")
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rounds', type=int, default=5, help='timed rounds per benchmark')
+    parser.add_argument('--scale', type=float, default=1.0, help='multiply calls per round')
+    parser.add_argument('--only', nargs='*', help='run only these benchmarks')
+    parser.add_argument('--compare', type=Path, help='results file to compare with (default: previous run)')
+    parser.add_argument('--threshold', type=float, default=0.15,
+                        help='fail when a median is this fraction slower than the baseline')
+    parser.add_argument('--no-save', action='store_true', help='do not store this run')
+    args = parser.parse_args()
+
+    current = {
+        'revision': git_revision(),
+        'created_at': datetime.utcnow().isoformat(timespec='seconds'),
+        'python': sys.version.split()[0],
+        'benchmarks': asyncio.run(run(args)),
+    }
+
+    saved = None
+    if not args.no_save:
+        RESULTS_DIR.mkdir(exist_ok=True)
+        saved = RESULTS_DIR / f"{current['created_at'].replace(':', '')}_{current['revision']}.json"
+        saved.write_text(json.dumps(current, indent=2))
+        print(f"\nSaved {saved}")
+
+    baseline_path = args.compare or previous_run(exclude=saved)
+    if not baseline_path:
+        return
+    baseline = json.loads(baseline_path.read_text())
+    print(f"Comparing with {baseline_path.name} ({baseline.get('revision')})")
+    regressions = compare(current, baseline, args.threshold)
+    if regressions:
+        print(f"\n{len(regressions)} benchmark(s) slower than {args.threshold:.0%}: {', '.join(regressions)}")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+"""Per-call overhead of log_function_call with DEBUG_MODE off.
+
+Compares the previous decorator, which always formatted args and kwargs,
+with the current one, which calls straight through unless debug output is
+on for the current update.
+
+Run from project_root:
+    python -m benchmarks.bench_logging
+"""
+import asyncio
+import logging
+import os
+import time
+
+os.environ['DEBUG_MODE'] = 'False'
+
+from utils.logging_config import log_function_call  # noqa: E402
+
+logger = logging.getLogger('bench_logging')
+logger.setLevel(logging.INFO)
+
+ITERATIONS = 100_000
+
+
+def legacy_log_function_call(logger: logging.Logger):
+    """The decorator as it was before lazy logging"""
+    def decorator(func):
+        async def wrapper(*args, **kwargs):
+            func_name = func.__name__
+            logger.debug(
+                f"Calling {func_name} with args: {args}, kwargs: {kwargs}"
+            )
+            try:
+                result = await func(*args, **kwargs)
+                logger.debug(
+                    f"{func_name} completed successfully"
+                )
+                return result
+            except Exception as e:
+                logger.error(f"Error in {func_name}: {str(e)}")
+                raise
+        return wrapper
+    return decorator
+
+
+class FakeUpdate:
+    """Stands in for telegram.Update, whose repr walks the whole object tree"""
+
+    def __init__(self):
+        self.payload = {'message': {'text': 'hello ' * 50, 'entities': list(range(20))}}
+
+    def __repr__(self):
+        return f"Update({self.payload!r})"
+
+
+async def handler(update, context):
+    return None
+
+
+async def measure(func) -> float:
+    update, context = FakeUpdate(), {'user_data': {'k': 'v' * 100}}
+    started = time.perf_counter()
+    for _ in range(ITERATIONS):
+        await func(update, context)
+    return (time.perf_counter() - started) / ITERATIONS * 1e9
+
+
+async def main():
+    results = {
+        'undecorated': await measure(handler),
+        'legacy decorator': await measure(legacy_log_function_call(logger)(handler)),
+        'current decorator': await measure(log_function_call(logger)(handler)),
+    }
+    baseline = results['undecorated']
+    for name, ns in results.items():
+        print(f"{name:>18}: {ns:8.0f} ns/call  (+{ns - baseline:.0f} ns)")
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,175 @@
+"""Concurrent history reads and writes on a SQLite file, before and after the production profile.
+
+Modes:
+  on_loop  - sessions used directly in the handlers, blocking the event loop
+             (how handlers talked to the database before run_read/run_write)
+  threads  - the same work in asyncio.to_thread on a default engine
+             (rollback journal, writers contend for the lock)
+  profile  - run_write/run_read: WAL, tuned pragmas, one writer thread and
+             a pool of read-only connections
+
+Each mode starts from a fresh database. Reports operations per second,
+p50/p95/p99 latency, errors such as "database is locked", and the largest
+event loop lag seen while the workload ran.
+
+Run from project_root:
+    python -m benchmarks.bench_sqlite_concurrency --workers 64 --ops 50 --write-ratio 0.3
+"""
+import argparse
+import asyncio
+import os
+import random
+import statistics
+import tempfile
+import time
+
+WORKDIR = tempfile.mkdtemp(prefix='sqlite_bench_')
+os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(WORKDIR, 'profile.db')}"
+os.environ['SQLITE_PRODUCTION_MODE'] = 'True'
+
+from sqlalchemy import create_engine  # noqa: E402
+from sqlalchemy.orm import sessionmaker  # noqa: E402
+
+from handlers.history import HistoryHandler  # noqa: E402
+from utils.database import create_schema, get_workers  # noqa: E402
+
+history = HistoryHandler()
+
+
+def legacy_session_factory(name: str):
+    engine = create_engine(f"sqlite:///{os.path.join(WORKDIR, name)}")
+    create_schema(engine)
+    return sessionmaker(bind=engine)
+
+
+def write_op(session, user_id: int, content: str):
+    history._save_message(session, user_id, content, 'user')
+
+
+def read_op(session, user_id: int):
+    return history._query_history_page(session, user_id, 10, None, None)
+
+
+def make_runner(mode: str):
+    if mode == 'profile':
+        workers = get_workers()
+        return workers.run_write, workers.run_read
+
+    Session = legacy_session_factory(f"{mode}.db")
+
+    def write(fn, *args):
+        with Session() as session:
+            result = fn(session, *args)
+            session.commit()
+            return result
+
+    def read(fn, *args):
+        with Session() as session:
+            return fn(session, *args)
+
+    if mode == 'on_loop':
+        async def run_write(fn, *args):
+            return write(fn, *args)
+
+        async def run_read(fn, *args):
+            return read(fn, *args)
+    else:
+        async def run_write(fn, *args):
+            return await asyncio.to_thread(write, fn, *args)
+
+        async def run_read(fn, *args):
+            return await asyncio.to_thread(read, fn, *args)
+    return run_write, run_read
+
+
+async def watch_loop_lag(stop: asyncio.Event, interval: float = 0.01) -> float:
+    loop = asyncio.get_running_loop()
+    max_lag = 0.0
+    while not stop.is_set():
+        started = loop.time()
+        await asyncio.sleep(interval)
+        max_lag = max(max_lag, loop.time() - started - interval)
+    return max_lag
+
+
+async def run_mode(mode: str, args) -> dict:
+    run_write, run_read = make_runner(mode)
+    users = [1000 + i for i in range(args.users)]
+    # Seed every user so reads return a full page
+    for user_id in users:
+        for i in range(10):
+            await run_write(write_op, user_id, f"seed {i} " * 20)
+
+    latencies, errors = [], {}
+
+    async def worker(worker_id: int):
+        worker_rng = random.Random(args.seed + worker_id)
+        for op in range(args.ops):
+            user_id = worker_rng.choice(users)
+            started = time.perf_counter()
+            try:
+                if worker_rng.random() < args.write_ratio:
+                    await run_write(write_op, user_id, f"message {worker_id}-{op} " * 20)
+                else:
+                    await run_read(read_op, user_id)
+            except Exception as e:
+                key = f"{type(e).__name__}: {str(e).splitlines()[0][:60]}"
+                errors[key] = errors.get(key, 0) + 1
+                continue
+            latencies.append(time.perf_counter() - started)
+
+    stop = asyncio.Event()
+    lag_task = asyncio.create_task(watch_loop_lag(stop))
+    started = time.perf_counter()
+    await asyncio.gather(*(worker(i) for i in range(args.workers)))
+    elapsed = time.perf_counter() - started
+    stop.set()
+    max_lag = await lag_task
+
+    ordered = sorted(latencies) or [float('nan')]
+
+    def pct(p):
+        return ordered[min(len(ordered) - 1, int(p / 100 * len(ordered)))] * 1000
+
+    return {
+        'ops_per_sec': len(latencies) / elapsed,
+        'p50_ms': pct(50),
+        'p95_ms': pct(95),
+        'p99_ms': pct(99),
+        'mean_ms': statistics.fmean(ordered) * 1000 if latencies else float('nan'),
+        'errors': sum(errors.values()),
+        'max_loop_lag_ms': max_lag * 1000,
+        'error_kinds': errors,
+    }
+
+
+async def main_async(args):
+    results = {}
+    for mode in args.modes:
+        results[mode] = await run_mode(mode, args)
+    get_workers().shutdown()
+
+    columns = ('ops_per_sec', 'p50_ms', 'p95_ms', 'p99_ms', 'errors', 'max_loop_lag_ms')
+    print(f"{'mode':>10}" + ''.join(f"{c:>17}" for c in columns))
+    for mode, result in results.items():
+        print(f"{mode:>10}" + ''.join(f"{result[c]:17.1f}" for c in columns))
+    for mode, result in results.items():
+        for kind, count in result['error_kinds'].items():
+            print(f"{mode}: {count} x {kind}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--workers', type=int, default=32, help='concurrent handler coroutines')
+    parser.add_argument('--ops', type=int, default=50, help='operations per worker')
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--write-ratio', type=float, default=0.3)
+    parser.add_argument('--modes', nargs='+', default=['on_loop', 'threads', 'profile'],
+                        choices=['on_loop', 'threads', 'profile'])
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+    asyncio.run(main_async(args))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+"""Cold-start import time of the bot, checked against a budget.
+
+Imports the entry module in a fresh interpreter with `-X importtime`, prints
+the slowest modules by cumulative time and exits with status 1 when the
+total exceeds the budget or a module that should load lazily (PIL, aiohttp,
+openai) is imported at startup.
+
+Run from project_root:
+    python -m benchmarks.bench_startup
+    python -m benchmarks.bench_startup --module main --budget-ms 1500 --top 30
+"""
+import argparse
+import os
+import re
+import statistics
+import subprocess
+import sys
+import tempfile
+
+# Only needed once an image is generated or a chat request is made
+LAZY_MODULES = ('PIL', 'aiohttp', 'openai')
+
+IMPORT_LINE = re.compile(r'^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)')
+
+
+def import_profile(module: str) -> dict:
+    """Return {module: (self_us, cumulative_us, depth)} for one fresh import"""
+    env = dict(os.environ)
+    workdir = tempfile.mkdtemp(prefix='startup_')
+    # Importing handlers creates the database schema; keep it out of the working tree
+    env.setdefault('DATABASE_URL', f"sqlite:///{os.path.join(workdir, 'startup.db')}")
+    env['PYTHONPATH'] = os.pathsep.join(filter(None, [os.getcwd(), env.get('PYTHONPATH')]))
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+        capture_output=True, text=True, env=env, cwd=workdir
+    )
+    if result.returncode != 0:
+        sys.exit(f"Importing {module} failed:\n{result.stderr[-2000:]}")
+    profile = {}
+    for line in result.stderr.splitlines():
+        match = IMPORT_LINE.match(line)
+        if match:
+            self_us, cumulative_us, indent, name = match.groups()
+            profile[name] = (int(self_us), int(cumulative_us), len(indent) // 2)
+    return profile
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--module', default='bot', help='entry module to import')
+    parser.add_argument('--budget-ms', type=float,
+                        default=float(os.getenv('STARTUP_IMPORT_BUDGET_MS', '2000')),
+                        help='fail when the median import time exceeds this')
+    parser.add_argument('--runs', type=int, default=3, help='fresh interpreters to measure')
+    parser.add_argument('--top', type=int, default=20, help='slowest top-level imports to show')
+    args = parser.parse_args()
+
+    profiles = [import_profile(args.module) for _ in range(args.runs)]
+    total_ms = statistics.median(p[args.module][1] for p in profiles) / 1000
+    last = profiles[-1]
+
+    print(f"Slowest imports under {args.module} (cumulative ms, last run):")
+    # Packages directly imported by project modules, ranked by cumulative time
+    top_level = sorted(
+        ((name, cumulative) for name, (_, cumulative, depth) in last.items() if depth <= 1),
+        key=lambda item: item[1], reverse=True
+    )
+    for name, cumulative in top_level[:args.top]:
+        print(f"{cumulative / 1000:10.1f}  {name}")
+
+    failures = []
+    eager = sorted({name.split('.')[0] for name in last} & set(LAZY_MODULES))
+    if eager:
+        failures.append(f"imported at startup but should be lazy: {', '.join(eager)}")
+    if total_ms > args.budget_ms:
+        failures.append(f"import time {total_ms:.0f} ms exceeds budget {args.budget_ms:.0f} ms")
+
+    print(f"\nimport {args.module}: {total_ms:.0f} ms (median of {args.runs}), budget {args.budget_ms:.0f} ms")
+    if failures:
+        for failure in failures:
+            print(f"FAIL: {failure}")
+        sys.exit(1)
+    print("OK")
+
+
+if __name__ == '__main__':
+    main()
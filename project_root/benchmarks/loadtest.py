@@ -0,0 +1,312 @@
+"""Load test TelegramBot against local stand-ins for the Bot API and an OpenAI-compatible server.
+
+Starts a fake Bot API (getUpdates/sendMessage/editMessageText/...) and a fake
+OpenAI server that streams chat completions at a configurable time-to-first-token
+and token rate, drives the real TelegramBot with simulated users and groups,
+and reports throughput, reply latency percentiles, edits per reply and DB
+statements per update.
+
+Run from project_root:
+    python -m benchmarks.loadtest --users 50 --groups 5 --messages 4 --ttft 0.3 --tps 50
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional
+
+from aiohttp import web
+
+BOT_USERNAME = 'loadtest_bot'
+BOT_USER = {'id': 1, 'is_bot': True, 'first_name': 'Load', 'username': BOT_USERNAME,
+            'can_join_groups': True, 'can_read_all_group_messages': False,
+            'supports_inline_queries': False}
+
+
+@dataclass
+class Stats:
+    sent_at: Dict[int, float] = field(default_factory=dict)  # update message_id -> enqueue time
+    reply_for: Dict[int, int] = field(default_factory=dict)  # bot message_id -> update message_id
+    edits: Dict[int, int] = field(default_factory=lambda: defaultdict(int))  # bot message_id -> edits
+    latencies: List[float] = field(default_factory=list)
+    completed: set = field(default_factory=set)
+    api_calls: Dict[str, int] = field(default_factory=lambda: defaultdict(int))
+    openai_requests: int = 0
+    db_statements: int = 0
+    expected_replies: int = 0
+    all_done: asyncio.Event = field(default_factory=asyncio.Event)
+
+
+class FakeBotAPI:
+    """Minimal Bot API server: serves queued updates and records replies"""
+
+    def __init__(self, stats: Stats, expected_text: str):
+        self.stats = stats
+        self.expected_text = expected_text
+        self.updates: asyncio.Queue = asyncio.Queue()
+        self.chat_types: Dict[int, str] = {}
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1_000_000)
+
+    def enqueue_message(self, message_id: int, chat_id: int, chat_type: str, user_id: int,
+                        text: str, entities: Optional[list] = None):
+        self.chat_types[chat_id] = chat_type
+        chat = {'id': chat_id, 'type': chat_type}
+        if chat_type != 'private':
+            chat['title'] = f'Group {chat_id}'
+        message = {
+            'message_id': message_id,
+            'date': int(time.time()),
+            'chat': chat,
+            'from': {'id': user_id, 'is_bot': False, 'first_name': f'User{user_id}'},
+            'text': text,
+        }
+        if entities:
+            message['entities'] = entities
+        self.stats.sent_at[message_id] = time.perf_counter()
+        self.updates.put_nowait({'update_id': next(self._update_ids), 'message': message})
+
+    def _message(self, chat_id: int, text: str, message_id: Optional[int] = None) -> dict:
+        return {
+            'message_id': message_id or next(self._message_ids),
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': self.chat_types.get(chat_id, 'private')},
+            'from': BOT_USER,
+            'text': text,
+        }
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info['method']
+        self.stats.api_calls[method] += 1
+        params = dict(await request.post()) if request.can_read_body else {}
+        handler = getattr(self, f'api_{method}', None)
+        result = await handler(params) if handler else True
+        return web.json_response({'ok': True, 'result': result})
+
+    async def api_getMe(self, params):
+        return BOT_USER
+
+    async def api_getUpdates(self, params):
+        timeout = min(float(params.get('timeout', 0) or 0), 1.0)
+        batch = []
+        try:
+            batch.append(await asyncio.wait_for(self.updates.get(), timeout or 0.05))
+        except asyncio.TimeoutError:
+            return []
+        while not self.updates.empty() and len(batch) < 100:
+            batch.append(self.updates.get_nowait())
+        return batch
+
+    async def api_sendMessage(self, params):
+        chat_id = int(params['chat_id'])
+        message = self._message(chat_id, params.get('text', ''))
+        reply_to = params.get('reply_to_message_id') or _reply_to(params)
+        if reply_to:
+            self.stats.reply_for[message['message_id']] = int(reply_to)
+        return message
+
+    async def api_editMessageText(self, params):
+        chat_id = int(params['chat_id'])
+        message_id = int(params['message_id'])
+        text = params.get('text', '')
+        self.stats.edits[message_id] += 1
+        source = self.stats.reply_for.get(message_id)
+        if source and text == self.expected_text and source not in self.stats.completed:
+            self.stats.completed.add(source)
+            self.stats.latencies.append(time.perf_counter() - self.stats.sent_at[source])
+            if len(self.stats.completed) >= self.stats.expected_replies:
+                self.stats.all_done.set()
+        return self._message(chat_id, text, message_id)
+
+
+def _reply_to(params) -> Optional[str]:
+    """reply_parameters is used instead of reply_to_message_id by newer PTB versions"""
+    raw = params.get('reply_parameters')
+    if not raw:
+        return None
+    return json.loads(raw).get('message_id')
+
+
+class FakeOpenAI:
+    """OpenAI-compatible server streaming a fixed answer at a fixed pace"""
+
+    def __init__(self, stats: Stats, ttft: float, tps: float, tokens: List[str]):
+        self.stats = stats
+        self.ttft = ttft
+        self.tps = tps
+        self.tokens = tokens
+
+    async def chat_completions(self, request: web.Request) -> web.StreamResponse:
+        self.stats.openai_requests += 1
+        body = await request.json()
+        response = web.StreamResponse(headers={'Content-Type': 'text/event-stream'})
+        await response.prepare(request)
+        await asyncio.sleep(self.ttft)
+        for index, token in enumerate(self.tokens):
+            if index:
+                await asyncio.sleep(1 / self.tps)
+            chunk = {
+                'id': 'chatcmpl-load', 'object': 'chat.completion.chunk', 'created': int(time.time()),
+                'model': body.get('model', 'fake'),
+                'choices': [{'index': 0, 'delta': {'content': token}, 'finish_reason': None}],
+            }
+            await response.write(f"data: {json.dumps(chunk)}\n\n".encode())
+        await response.write(b"data: [DONE]\n\n")
+        await response.write_eof()
+        return response
+
+
+def build_tokens(count: int) -> List[str]:
+    # A sentence break every 12 tokens exercises the edit-on-sentence path
+    return [f"word{i}{'.' if i % 12 == 11 else ''} " for i in range(count - 1)] + ["end."]
+
+
+async def start_site(app: web.Application) -> (web.AppRunner, int):
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    return runner, port
+
+
+def percentile(values: List[float], pct: float) -> float:
+    if not values:
+        return float('nan')
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+async def run(args) -> dict:
+    stats = Stats()
+    tokens = build_tokens(args.tokens)
+    expected_text = ''.join(tokens)
+
+    bot_api = FakeBotAPI(stats, expected_text)
+    telegram_app = web.Application()
+    telegram_app.router.add_route('*', '/bot{token}/{method}', bot_api.handle)
+    openai = FakeOpenAI(stats, args.ttft, args.tps, tokens)
+    openai_app = web.Application()
+    openai_app.router.add_post('/v1/chat/completions', openai.chat_completions)
+
+    telegram_runner, telegram_port = await start_site(telegram_app)
+    openai_runner, openai_port = await start_site(openai_app)
+
+    workdir = tempfile.mkdtemp(prefix='loadtest_')
+    os.chdir(workdir)
+    os.environ.update({
+        'TELEGRAM_BOT_TOKEN': '123456:LOADTEST',
+        'TELEGRAM_API_BASE_URL': f'http://127.0.0.1:{telegram_port}/bot',
+        'OPENAI_API_KEY': 'sk-loadtest',
+        'OPENAI_BASE_URL': f'http://127.0.0.1:{openai_port}/v1',
+        'DATABASE_URL': f"sqlite:///{os.path.join(workdir, 'load.db')}",
+    })
+
+    # Imported after the environment points at the stand-ins
+    from sqlalchemy import event
+    from sqlalchemy.engine import Engine
+    from bot import TelegramBot
+
+    @event.listens_for(Engine, 'after_cursor_execute')
+    def count_statement(*_):
+        stats.db_statements += 1
+
+    bot = TelegramBot()
+    bot.setup_handlers()
+    application = bot.application
+    await application.initialize()
+    await bot.post_init(application)
+    await application.start()
+    await application.updater.start_polling(drop_pending_updates=False)
+
+    # Simulated traffic: private chats plus group messages mentioning the bot
+    message_ids = itertools.count(1)
+    questions = [f"question {i}" for i in range(args.distinct_questions)]
+    sent = 0
+    mention = f"@{BOT_USERNAME}"
+    started = time.perf_counter()
+    for round_index in range(args.messages):
+        for user in range(args.users):
+            user_id = 10_000 + user
+            question = questions[(round_index * args.users + user) % len(questions)]
+            if args.groups and user % 2:
+                chat_id = -(100 + user % args.groups)
+                text = f"{mention} {question}"
+                entities = [{'type': 'mention', 'offset': 0, 'length': len(mention)}]
+                bot_api.enqueue_message(next(message_ids), chat_id, 'group', user_id, text, entities)
+            else:
+                bot_api.enqueue_message(next(message_ids), user_id, 'private', user_id, question)
+            sent += 1
+            # Group chatter not addressed to the bot
+            for _ in range(args.chatter):
+                chat_id = -(100 + user % max(args.groups, 1))
+                bot_api.enqueue_message(next(message_ids), chat_id, 'group', user_id, 'just chatting')
+        if args.interval:
+            await asyncio.sleep(args.interval)
+    stats.expected_replies = sent
+    chatter = args.messages * args.users * args.chatter
+
+    try:
+        await asyncio.wait_for(stats.all_done.wait(), args.timeout)
+    except asyncio.TimeoutError:
+        print(f"Timed out with {len(stats.completed)}/{sent} replies", file=sys.stderr)
+    elapsed = time.perf_counter() - started
+
+    await application.updater.stop()
+    await application.stop()
+    await application.shutdown()
+    await telegram_runner.cleanup()
+    await openai_runner.cleanup()
+
+    replied = stats.reply_for.keys()
+    return {
+        'updates_sent': sent + chatter,
+        'replies': len(stats.completed),
+        'elapsed_seconds': round(elapsed, 3),
+        'updates_per_second': round((sent + chatter) / elapsed, 1),
+        'replies_per_second': round(len(stats.completed) / elapsed, 1),
+        'latency_p50': round(percentile(stats.latencies, 50), 3),
+        'latency_p95': round(percentile(stats.latencies, 95), 3),
+        'latency_p99': round(percentile(stats.latencies, 99), 3),
+        'latency_mean': round(statistics.fmean(stats.latencies), 3) if stats.latencies else None,
+        'edits_per_reply': round(sum(stats.edits[m] for m in replied) / max(len(replied), 1), 2),
+        'db_statements_per_update': round(stats.db_statements / max(sent + chatter, 1), 2),
+        'openai_requests': stats.openai_requests,
+        'bot_api_calls': dict(stats.api_calls),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=20, help='simulated users')
+    parser.add_argument('--groups', type=int, default=2, help='group chats (odd users write in groups)')
+    parser.add_argument('--messages', type=int, default=3, help='messages per user')
+    parser.add_argument('--chatter', type=int, default=0, help='unaddressed group messages per user message')
+    parser.add_argument('--distinct-questions', type=int, default=1000, help='distinct prompts in rotation')
+    parser.add_argument('--interval', type=float, default=0.0, help='seconds between rounds of messages')
+    parser.add_argument('--ttft', type=float, default=0.2, help='fake OpenAI time to first token')
+    parser.add_argument('--tps', type=float, default=50.0, help='fake OpenAI tokens per second')
+    parser.add_argument('--tokens', type=int, default=60, help='tokens per answer')
+    parser.add_argument('--timeout', type=float, default=120.0, help='seconds to wait for all replies')
+    parser.add_argument('--json', action='store_true', help='print the report as JSON')
+    args = parser.parse_args()
+
+    sys.path.insert(0, os.getcwd())
+    report = asyncio.run(run(args))
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        for key, value in report.items():
+            print(f"{key:>26}: {value}")
+
+
+if __name__ == '__main__':
+    main()
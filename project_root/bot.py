@@ -1,22 +1,33 @@
 from telegram import Update
-from telegram.ext import Application, ContextTypes, PicklePersistence
+from telegram.ext import Application, ContextTypes, PicklePersistence, TypeHandler
 from dotenv import load_dotenv
 import os
-import logging
 from handlers.settings import SettingsHandler
 from handlers.image_settings import ImageSettingsHandler
 from handlers.history import HistoryHandler
 from telegram.ext import MessageHandler, filters
 from handlers.chat import ChatHandler
 import asyncio
-from utils.logging_config import setup_logging, log_function_call, DEBUG_MODE
+import time
+from utils.logging_config import (
+    configure_logging, setup_logging,
+    is_debug_mode, set_debug_mode, set_trace_sample_rate, toggle_trace_user, reset_tracing,
+    start_update_trace
+)
+import utils.logging_config as logging_config
+from utils.metrics import instrument_handler
+from utils.watchdog import LoopWatchdog
+from utils.telegram_request import InstrumentedRequest
+from utils.tracing import start_span
+from utils.retention import retention_enabled, prune_history, HISTORY_RETENTION_INTERVAL
+from utils.database import shutdown_workers
+from utils.addressing import ADDRESSED_TO_BOT, DIRECT_CHAT_TYPES, addressed_text
 import json
-from pathlib import Path
+from typing import Optional
 
 # Set up logging directory
 LOGS_DIR = os.path.join(os.path.dirname(__file__), 'logs')
-# Initialize logging
-logger = setup_logging(__name__, os.path.join(LOGS_DIR, 'bot.log'))
+logger = setup_logging(__name__)
 
 class TelegramBot:
     def __init__(self):
@@ -37,15 +48,10 @@ class TelegramBot:
         else:
             logger.debug("No .env file found, using system environment variables")
         
-        # Debug: Print all environment variables (excluding sensitive data)
-        env_vars = {k: '***' if 'TOKEN' in k or 'KEY' in k else v for k, v in os.environ.items()}
-        logger.debug(f"Environment variables: {env_vars}")
-        
         # Try both possible environment variable names
         self.token = os.getenv('TELEGRAM_BOT_TOKEN') or os.getenv('TELEGRAM_TOKEN')
         if not self.token:
             logger.error("Telegram bot token not found in environment variables")
-            logger.debug(f"Available environment variables: {list(os.environ.keys())}")
             raise ValueError(
                 "Telegram bot token not found in environment variables. "
                 "Please set either TELEGRAM_BOT_TOKEN or TELEGRAM_TOKEN in your Railway.app environment variables "
@@ -54,28 +60,40 @@ class TelegramBot:
         else:
             logger.debug("Telegram bot token found")
         
+        # Telegram user ids allowed to use admin commands such as /loglevel
+        self.admin_ids = {
+            int(user_id) for user_id in os.getenv('ADMIN_USER_IDS', '').split(',') if user_id.strip()
+        }
+        
         try:
             # Initialize persistence with Railway-friendly path
             persistence_path = os.path.join(os.getcwd(), 'data', 'conversation_data')
-            logger.debug(f"Setting persistence path to: {persistence_path}")
+            logger.debug("Setting persistence path to: %s", persistence_path)
             persistence = PicklePersistence(
                 filepath=persistence_path,
                 update_interval=30
             )
             
-            self.application = (
+            # Kept to report when getUpdates last returned
+            self.polling_request = InstrumentedRequest()
+            builder = (
                 Application.builder()
                 .token(self.token)
                 .persistence(persistence)
                 .concurrent_updates(True)
-                .build()
+                # Record Bot API call latency and 429s
+                .request(InstrumentedRequest(connection_pool_size=256))
+                .get_updates_request(self.polling_request)
+                .post_init(self.post_init)
+                .post_shutdown(self.post_shutdown)
             )
+            # Alternative Bot API server, e.g. a local one or the load-test stand-in
+            api_base_url = os.getenv('TELEGRAM_API_BASE_URL')
+            if api_base_url:
+                builder = builder.base_url(api_base_url)
+            self.application = builder.build()
             logger.debug("Application built successfully")
             
-            # Initialize job queue
-            self.application.job_queue.scheduler.start()
-            logger.debug("Job queue initialized")
-            
             # Initialize handlers
             self.history_handler = HistoryHandler()
             self.settings_handler = SettingsHandler()
@@ -84,7 +102,12 @@ class TelegramBot:
             logger.debug("All handlers initialized")
             
             self._running = False
+            # post_shutdown runs from run_polling and again from stop()
+            self._shut_down = False
             self._offset = None
+            # Wall-clock time of the last update received, reported by /health
+            self.last_update_at: Optional[float] = None
+            self.watchdog = LoopWatchdog()
             
             # Add error handler
             self.application.add_error_handler(self.error_handler)
@@ -98,13 +121,13 @@ class TelegramBot:
         """Handle errors"""
         logger.error(
             "Exception while handling an update:",
-            exc_info=context.error if DEBUG_MODE else False
+            exc_info=context.error if is_debug_mode() else False
         )
         
         # Log update object in debug mode
-        if DEBUG_MODE:
-            logger.debug(f"Update object: {update}")
-            logger.debug(f"Context error: {context.error}")
+        if is_debug_mode():
+            logger.debug("Update object: %s", update)
+            logger.debug("Context error: %s", context.error)
         
         # Send message to user
         if update and update.effective_message:
@@ -112,17 +135,74 @@ class TelegramBot:
                 "❌ Произошла ошибка при обработке запроса. Пожалуйста, попробуйте позже."
             )
     
+    async def post_init(self, application: Application) -> None:
+        """Start background tasks once the application is initialized"""
+        self.watchdog.start()
+        # Runs once the job queue starts with the application
+        application.job_queue.run_once(self.history_handler.resume_purges, 0, name='resume_history_purges')
+        if retention_enabled():
+            application.job_queue.run_repeating(
+                self.prune_history, HISTORY_RETENTION_INTERVAL, first=60, name='history_retention'
+            )
+
+    async def prune_history(self, context: ContextTypes.DEFAULT_TYPE):
+        """Job: enforce the history retention policy"""
+        with start_span('history.retention'):
+            deleted = await prune_history()
+        if deleted:
+            logger.info(f"Retention pruned {deleted} messages")
+
+    async def post_shutdown(self, application: Application) -> None:
+        """Cancel background tasks"""
+        if self._shut_down:
+            return
+        self._shut_down = True
+        self.watchdog.stop()
+        await asyncio.to_thread(shutdown_workers)
+
+    async def start_polling(self):
+        """Start polling inside an already running event loop, e.g. next to the API server"""
+        logger.info("Starting bot...")
+        self.setup_handlers()
+        await self.application.initialize()
+        await self.post_init(self.application)
+        await self.application.start()
+        await self.application.updater.start_polling(
+            allowed_updates=Update.ALL_TYPES,
+            drop_pending_updates=True
+        )
+        self._running = True
+
+    def health(self) -> dict:
+        """Bot liveness details for the /health endpoint"""
+        application = self.application
+        return {
+            'running': application.running,
+            'polling': bool(application.updater and application.updater.running),
+            'seconds_since_last_update': (
+                round(time.time() - self.last_update_at, 1) if self.last_update_at else None
+            ),
+            'seconds_since_poll': (
+                round(time.monotonic() - self.polling_request.last_response_at, 1)
+                if self.polling_request.last_response_at else None
+            ),
+            'update_queue_size': application.update_queue.qsize(),
+            'updates_in_progress': application.update_processor.current_concurrent_updates,
+            'loop_lag_seconds': round(self.watchdog.last_lag, 3),
+        }
+
     async def stop(self):
         """Stop the bot"""
         if self._running:
             logger.info("Stopping bot...")
             try:
-                # Stop job queue
-                if self.application.job_queue:
-                    self.application.job_queue.scheduler.shutdown(wait=True)
-                # Stop application
-                await self.application.stop()
+                if self.application.updater and self.application.updater.running:
+                    await self.application.updater.stop()
+                # Stopping the application also stops the job queue
+                if self.application.running:
+                    await self.application.stop()
                 await self.application.shutdown()
+                await self.post_shutdown(self.application)
             except Exception as e:
                 logger.error(f"Error stopping bot: {e}")
             finally:
@@ -137,44 +217,40 @@ class TelegramBot:
             "/settings - Настройки текстовой модели\n"
             "/image_settings - Настройки модели изображений\n"
             "/history - История сообщений\n"
+            "/search - Поиск по истории\n"
+            "/export_history - Выгрузить историю файлом (jsonl или md)\n"
             "/clear_history - Очистить историю\n"
             "/help - Помощь"
         )
 
     async def handle_message(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle incoming messages"""
-        logger.debug(f"Received message: {update.message.text}")
-        
         # Check if message exists
         if not update.message:
             return
+        
+        logger.debug("Received message: %s", update.message.text)
+        with start_span(
+            'update',
+            update_id=update.update_id,
+            chat_type=update.effective_chat.type,
+            user_id=update.effective_user.id if update.effective_user else 0
+        ):
+            await self._dispatch_message(update, context)
+
+    async def _dispatch_message(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Route a message to text, image generation or image variation handling"""
 
         # Get bot's username and message text
         bot_username = context.bot.username
         message_text = update.message.text if update.message.text else ""
 
         # Check if message is meant for bot in group chats
-        if update.effective_chat.type not in ["private", "channel"]:
-            # Check if message mentions the bot
-            is_for_bot = False
-            
-            # Check for direct mention at start
-            if message_text.startswith(f"@{bot_username}"):
-                is_for_bot = True
-                message_text = message_text.replace(f"@{bot_username}", "", 1).strip()
-            
-            # Check for mentions in entities
-            elif update.message.entities:
-                for entity in update.message.entities:
-                    if entity.type == "mention":
-                        mention = message_text[entity.offset:entity.offset + entity.length]
-                        if mention == f"@{bot_username}":
-                            is_for_bot = True
-                            message_text = message_text.replace(mention, "").strip()
-                            break
+        if update.effective_chat.type not in DIRECT_CHAT_TYPES:
+            message_text = addressed_text(update.message, bot_username, context.bot.id)
             
             # If message is not for this bot, ignore it
-            if not is_for_bot:
+            if message_text is None:
                 return
         
         try:
@@ -230,6 +306,8 @@ class TelegramBot:
             "/settings - Настройки текстовой модели\n"
             "/image_settings - Настройки генерации изображений\n"
             "/history - История сообщений\n"
+            "/search - Поиск по истории\n"
+            "/export_history - Выгрузить историю файлом (jsonl или md)\n"
             "/clear_history - Очистить историю\n\n"
             "📝 Для генерации текста просто отправьте сообщение\n"
             "🎨 Для генерации изображения используйте команду /image с описанием\n"
@@ -239,12 +317,12 @@ class TelegramBot:
 
     async def debug_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle /debug command - only works in debug mode"""
-        if not DEBUG_MODE:
+        if not is_debug_mode():
             await update.message.reply_text("Debug mode is disabled")
             return
         
         user_id = update.effective_user.id
-        logger.debug(f"Debug command called by user {user_id}")
+        logger.debug("Debug command called by user %s", user_id)
         
         debug_info = {
             "user_id": user_id,
@@ -257,31 +335,98 @@ class TelegramBot:
             f"Debug information:\n{json.dumps(debug_info, indent=2)}"
         )
 
+    async def begin_update(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Record bot liveness and enable debug output for sampled or watched updates"""
+        self.last_update_at = time.time()
+        user = update.effective_user
+        if start_update_trace(user.id if user else None):
+            logger.debug("Tracing update %s: %s", update.update_id, update)
+
+    async def loglevel_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Handle /loglevel command - change logging and tracing at runtime (admins only)"""
+        if update.effective_user.id not in self.admin_ids:
+            return
+        
+        args = context.args or []
+        command = args[0].lower() if args else ''
+        try:
+            if command in ('debug', 'info'):
+                set_debug_mode(command == 'debug')
+            elif command == 'sample' and len(args) == 2:
+                set_trace_sample_rate(float(args[1]))
+            elif command == 'user' and len(args) == 2:
+                toggle_trace_user(int(args[1]))
+            elif command == 'off':
+                reset_tracing()
+            elif command:
+                raise ValueError(command)
+        except ValueError:
+            await update.message.reply_text(
+                "Использование:\n"
+                "/loglevel debug|info - уровень логирования\n"
+                "/loglevel sample 0.01 - трассировать долю обновлений\n"
+                "/loglevel user <id> - включить/выключить трассировку пользователя\n"
+                "/loglevel off - выключить трассировку"
+            )
+            return
+        
+        logger.info(
+            "Logging changed by admin %s: debug=%s, sample_rate=%s, traced_users=%s",
+            update.effective_user.id, is_debug_mode(),
+            logging_config.TRACE_SAMPLE_RATE, sorted(logging_config.TRACE_USER_IDS)
+        )
+        await update.message.reply_text(
+            "🔧 Логирование:\n"
+            f"Режим отладки: {'Вкл' if is_debug_mode() else 'Выкл'}\n"
+            f"Доля трассируемых обновлений: {logging_config.TRACE_SAMPLE_RATE}\n"
+            f"Трассируемые пользователи: {', '.join(map(str, sorted(logging_config.TRACE_USER_IDS))) or '-'}"
+        )
+
     def setup_handlers(self):
         """Setup all command and message handlers"""
         from telegram.ext import CommandHandler
         
+        # Runs first for every update to decide whether it is traced
+        self.application.add_handler(TypeHandler(Update, self.begin_update), group=-1)
+        
         # Basic command handlers
-        self.application.add_handler(CommandHandler("start", self.start))
-        self.application.add_handler(CommandHandler("help", self.help_command))
+        self.application.add_handler(instrument_handler(CommandHandler("start", self.start), "command"))
+        self.application.add_handler(instrument_handler(CommandHandler("help", self.help_command), "command"))
         
         # Add settings handlers
-        self.application.add_handler(self.settings_handler.get_conversation_handler())
-        self.application.add_handler(self.image_settings_handler.get_conversation_handler())
+        self.application.add_handler(
+            instrument_handler(self.settings_handler.get_conversation_handler(), "settings")
+        )
+        self.application.add_handler(
+            instrument_handler(self.image_settings_handler.get_conversation_handler(), "image")
+        )
         
         # Add history handler
-        self.application.add_handler(self.history_handler.get_conversation_handler())
+        self.application.add_handler(
+            instrument_handler(self.history_handler.get_conversation_handler(), "history")
+        )
+        # Buttons of timed-out /history menus fall through to the page handlers
+        for handler in (self.history_handler.get_page_handlers()
+                        + self.history_handler.get_search_handlers()
+                        + self.history_handler.get_export_handlers()):
+            self.application.add_handler(instrument_handler(handler, "history"))
         
-        # Add message handler for text and photos
+        # Add message handler for text and photos. Group messages not addressed
+        # to the bot are rejected while matching handlers, before the callback
+        # runs. PTB has already created the update's task by then.
         self.application.add_handler(
-            MessageHandler(
-                filters.TEXT | filters.PHOTO,
-                self.handle_message
+            instrument_handler(
+                MessageHandler(
+                    (filters.TEXT | filters.PHOTO) & ADDRESSED_TO_BOT,
+                    self.handle_message
+                ),
+                "handle_message"
             )
         )
         
-        if DEBUG_MODE:
-            self.application.add_handler(CommandHandler("debug", self.debug_command))
+        # Registered unconditionally since debug mode can be switched at runtime
+        self.application.add_handler(instrument_handler(CommandHandler("debug", self.debug_command), "command"))
+        self.application.add_handler(instrument_handler(CommandHandler("loglevel", self.loglevel_command), "command"))
         
     def run(self):
         """Run the bot in polling mode"""
@@ -302,6 +447,8 @@ class TelegramBot:
             asyncio.run(self.stop())
 
 if __name__ == "__main__":
+    # One logging pipeline for the whole process
+    configure_logging(os.path.join(LOGS_DIR, 'bot.log'))
     bot = TelegramBot()
     try:
         bot.run()
@@ -1,72 +1,41 @@
 from telegram import Update
 from telegram.ext import ContextTypes
-from utils.database import User, UserSettings, init_db, ImageSettings
-from sqlalchemy.orm import Session
-import logging
-from openai import AsyncOpenAI
-import asyncio
-import os
+from utils.settings_store import text_settings, image_settings
+import time
 from typing import Optional
-import aiohttp
 from io import BytesIO
 from utils.logging_config import setup_logging, log_function_call
-from PIL import Image
+from utils.singleflight import SingleFlight, normalize_prompt
+from utils.resilience import upstream, is_retryable, CircuitOpenError
+from utils.providers import router
+from utils.tracing import start_span, current_span
+from utils.metrics import (
+    STREAM_PHASE_SECONDS, STREAM_TTFT_SECONDS, STREAM_TOKENS_PER_SECOND,
+    STREAM_EDITS, TELEGRAM_EDIT_SECONDS, STREAM_ERRORS, OPENAI_REQUEST_SECONDS
+)
+from urllib.parse import urlparse
 import io
 
-# Initialize logging with just the filename
-logger = setup_logging(__name__, 'chat.log')
-
-Session = init_db()
+logger = setup_logging(__name__)
 
 class ChatHandler:
     def __init__(self, history_handler):
         logger.debug("Initializing ChatHandler")
-        self.openai_client = AsyncOpenAI(
-            api_key=os.getenv('OPENAI_API_KEY')
-        )
+        # Clients, timeouts and circuit breakers are kept per base_url
+        self.upstream = upstream
+        # Picks endpoints for models that have a provider pool configured
+        self.router = router
         self.history_handler = history_handler  # Store the history handler
+        # Concurrent identical upstream requests share one in-flight call
+        self.inflight = SingleFlight()
 
     async def get_user_settings(self, user_id: int) -> dict:
-        """Get user settings"""
-        with Session() as session:
-            user = session.query(User).filter_by(telegram_id=user_id).first()
-            if not user:
-                # Create user if doesn't exist
-                user = User(telegram_id=user_id)
-                session.add(user)
-                session.commit()
-            
-            settings = session.query(UserSettings).filter_by(user_id=user.id).first()
-            if not settings:
-                # Create default settings if don't exist
-                settings = UserSettings(
-                    user_id=user.id,
-                    base_url="https://api.openai.com/v1",
-                    model="gpt-3.5-turbo",
-                    temperature=0.7,
-                    max_tokens=1000,
-                    use_assistant=False
-                )
-                session.add(settings)
-                session.commit()
-                session.refresh(settings)
-            
-            return {
-                'base_url': settings.base_url,
-                'model': settings.model,
-                'temperature': settings.temperature,
-                'max_tokens': settings.max_tokens,
-                'use_assistant': settings.use_assistant,
-                'assistant_url': settings.assistant_url
-            }
+        """Get user settings: defaults overlaid with the user's own changes"""
+        return await text_settings.get(user_id)
 
-    async def get_image_settings(self, user_id: int) -> Optional[ImageSettings]:
+    async def get_image_settings(self, user_id: int) -> dict:
         """Get user's image settings"""
-        with Session() as session:
-            user = session.query(User).filter_by(telegram_id=user_id).first()
-            if not user or not user.image_settings:
-                return None
-            return user.image_settings
+        return await image_settings.get(user_id)
 
     @log_function_call(logger)
     async def stream_openai_response(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -79,67 +48,236 @@ class ChatHandler:
             "⌛ Генерирую ответ...",
             reply_to_message_id=update.message.message_id
         )
-        collected_chunks = []
-        last_message = ""
-        error_message = "❌ Произошла ошибка при генерации ответа"  # Define error message
-        
         try:
-            # Get user settings (will create default settings if none exist)
-            settings = await self.get_user_settings(update.effective_user.id)
-            
-            # Configure OpenAI client with user settings
-            self.openai_client.base_url = settings['base_url']
+            # Get user settings (defaults for users who never changed them)
+            with STREAM_PHASE_SECONDS.labels(phase='settings').time(), start_span('settings.lookup'):
+                settings = await self.get_user_settings(update.effective_user.id)
             
             if settings['use_assistant'] and settings['assistant_url']:
                 # TODO: Implement custom assistant API call
                 await response_message.edit_text("🤖 Режим ассистента пока не реализован")
                 return
             
-            # Start streaming response using processed text
-            stream = await self.openai_client.chat.completions.create(
-                model=settings['model'],
-                messages=[{"role": "user", "content": message_text}],
-                temperature=settings['temperature'],
-                max_tokens=settings['max_tokens'],
-                stream=True
+            # Identical questions asked at the same time share one upstream stream
+            key = (
+                'chat', settings['base_url'], settings['model'],
+                settings['temperature'], settings['max_tokens'],
+                normalize_prompt(message_text)
             )
+            final_response, shared = await self.inflight.do(
+                key,
+                lambda: self._stream_completion(settings, message_text, response_message)
+            )
+            if shared:
+                logger.debug("Reusing in-flight response for user %s", update.effective_user.id)
+                await self._safe_edit(response_message, final_response)
             
-            async for chunk in stream:
-                if chunk.choices[0].delta.content is not None:
-                    collected_chunks.append(chunk.choices[0].delta.content)
-                    # Update message every 20 chunks or when chunk ends with sentence
-                    if len(collected_chunks) % 20 == 0 or chunk.choices[0].delta.content.endswith(('.', '!', '?')):
-                        current_response = ''.join(collected_chunks)
-                        if current_response != last_message:  # Only update if content changed
-                            try:
-                                await response_message.edit_text(current_response)
-                                last_message = current_response
-                            except Exception as e:
-                                if "Message is not modified" not in str(e):
-                                    logger.error(f"Error updating message: {e}")
-                                continue
-                                
-            # Final update with complete response
-            final_response = ''.join(collected_chunks)
-            if final_response != last_message:
-                try:
-                    await response_message.edit_text(final_response)
-                    # Save bot's response to history
+            if final_response:
+                # Save bot's response to history
+                with STREAM_PHASE_SECONDS.labels(phase='history_save').time():
                     await self.history_handler.save_message(
                         update.effective_user.id,
                         final_response,
                         role='assistant'
                     )
-                except Exception as e:
-                    if "Message is not modified" not in str(e):
-                        logger.error(f"Error in final update: {e}")
-                        await response_message.edit_text(error_message)
             
         except Exception as e:
+            STREAM_ERRORS.inc()
             error_message = f"❌ Произошла ошибка: {str(e)}"
             logger.error(error_message)
             await response_message.edit_text(error_message)
 
+    async def _safe_edit(self, message, text: str) -> bool:
+        """Edit message text, ignoring "not modified" errors"""
+        try:
+            with TELEGRAM_EDIT_SECONDS.time(), start_span('telegram.edit', length=len(text)):
+                await message.edit_text(text)
+            return True
+        except Exception as e:
+            if "Message is not modified" not in str(e):
+                logger.error(f"Error updating message: {e}")
+            return False
+
+    async def _completion_chunks(self, settings: dict, message_text: str):
+        """Yield completion chunks, failing over between endpoints until the first token arrives"""
+        candidates = self.router.candidates(settings['model'], settings['base_url'])
+        for index, endpoint in enumerate(candidates):
+            is_last = index == len(candidates) - 1
+            client = self.upstream.client(endpoint.base_url, endpoint.api_key)
+            model = endpoint.model or settings['model']
+            
+            async def create(client=client, model=model):
+                with STREAM_PHASE_SECONDS.labels(phase='connect').time():
+                    return await client.chat.completions.create(
+                        model=model,
+                        messages=[{"role": "user", "content": message_text}],
+                        temperature=settings['temperature'],
+                        max_tokens=settings['max_tokens'],
+                        stream=True
+                    )
+            
+            started = time.monotonic()
+            stream = self.upstream.stream(
+                endpoint.base_url,
+                create,
+                # With a fallback available, switch endpoints instead of retrying
+                max_retries=None if is_last else 0
+            )
+            try:
+                first_chunk = await stream.__anext__()
+            except StopAsyncIteration:
+                self.router.record_success(endpoint, time.monotonic() - started)
+                return
+            except Exception as e:
+                if isinstance(e, CircuitOpenError):
+                    pass
+                elif is_retryable(e):
+                    self.router.record_failure(endpoint)
+                else:
+                    raise
+                if is_last:
+                    raise
+                logger.warning(f"Endpoint {endpoint.base_url} failed before first token ({e!r}), failing over")
+                continue
+            
+            ttft = time.monotonic() - started
+            self.router.record_success(endpoint, ttft)
+            span = current_span()
+            if span:
+                span.set_attribute('base_url', endpoint.base_url)
+                span.set_attribute('ttft_seconds', ttft)
+            STREAM_TTFT_SECONDS.labels(model=settings['model']).observe(ttft)
+            STREAM_PHASE_SECONDS.labels(phase='first_token').observe(ttft)
+            yield first_chunk
+            async for chunk in stream:
+                yield chunk
+            return
+
+    async def _stream_completion(self, settings: dict, message_text: str, response_message) -> str:
+        """Stream a completion into response_message and return the full text"""
+        started = time.monotonic()
+        outcome = 'error'
+        try:
+            with start_span('openai.chat', model=settings['model']):
+                final_response = await self._consume_stream(settings, message_text, response_message)
+            outcome = 'ok'
+            return final_response
+        finally:
+            OPENAI_REQUEST_SECONDS.labels(
+                operation='chat', model=settings['model'], outcome=outcome
+            ).observe(time.monotonic() - started)
+
+    async def _consume_stream(self, settings: dict, message_text: str, response_message) -> str:
+        """Accumulate streamed chunks, editing response_message as the text grows"""
+        collected_chunks = []
+        last_message = ""
+        edits = 0
+        first_token_at = None
+        
+        async for chunk in self._completion_chunks(settings, message_text):
+            if first_token_at is None:
+                first_token_at = time.monotonic()
+            if chunk.choices and chunk.choices[0].delta.content is not None:
+                collected_chunks.append(chunk.choices[0].delta.content)
+                # Update message every 20 chunks or when chunk ends with sentence
+                if len(collected_chunks) % 20 == 0 or chunk.choices[0].delta.content.endswith(('.', '!', '?')):
+                    current_response = ''.join(collected_chunks)
+                    if current_response != last_message:  # Only update if content changed
+                        edits += 1
+                        if await self._safe_edit(response_message, current_response):
+                            last_message = current_response
+        
+        if first_token_at is not None:
+            stream_seconds = time.monotonic() - first_token_at
+            STREAM_PHASE_SECONDS.labels(phase='stream').observe(stream_seconds)
+            if stream_seconds > 0:
+                STREAM_TOKENS_PER_SECOND.labels(model=settings['model']).observe(
+                    len(collected_chunks) / stream_seconds
+                )
+        
+        # Final update with complete response
+        final_response = ''.join(collected_chunks)
+        if final_response and final_response != last_message:
+            edits += 1
+            await self._safe_edit(response_message, final_response)
+        STREAM_EDITS.observe(edits)
+        span = current_span()
+        if span:
+            span.set_attribute('chunks', len(collected_chunks))
+            span.set_attribute('edits', edits)
+        return final_response
+
+    async def _download(self, url: str) -> Optional[bytes]:
+        """Download binary content, returning None on a non-200 response"""
+        parsed = urlparse(url)
+        origin = f"{parsed.scheme}://{parsed.netloc}"
+        policy = self.upstream.policy(origin)
+        # Imported on first use; text-only processes never load aiohttp
+        import aiohttp
+        timeout = aiohttp.ClientTimeout(total=policy.total_timeout, connect=policy.connect_timeout)
+        
+        async def fetch():
+            async with aiohttp.ClientSession(timeout=timeout) as session:
+                async with session.get(url) as resp:
+                    if resp.status == 429 or resp.status >= 500:
+                        resp.raise_for_status()
+                    if resp.status != 200:
+                        return None
+                    return await resp.read()
+        
+        # GET is idempotent, so transient failures are retried
+        with start_span('image.download', origin=origin):
+            return await self.upstream.call(origin, fetch, idempotent=True)
+
+    async def _timed_openai_call(self, operation: str, model: str, base_url: str, func):
+        """Call the image API through the resilience layer, recording its duration"""
+        started = time.monotonic()
+        outcome = 'error'
+        try:
+            # Image calls are billed per request, so they are not retried
+            with start_span(f'openai.{operation}', model=model):
+                result = await self.upstream.call(base_url, func)
+            outcome = 'ok'
+            return result
+        finally:
+            OPENAI_REQUEST_SECONDS.labels(
+                operation=operation, model=model, outcome=outcome
+            ).observe(time.monotonic() - started)
+
+    async def _generate_image(self, base_url: str, image_params: dict) -> Optional[bytes]:
+        """Generate an image and download it"""
+        client = self.upstream.client(base_url)
+        response = await self._timed_openai_call(
+            'image_generate', image_params['model'], base_url,
+            lambda: client.images.generate(**image_params)
+        )
+        if not response.data:
+            return None
+        return await self._download(response.data[0].url)
+
+    async def _create_variation(self, base_url: str, photo_file, variation_params: dict) -> Optional[bytes]:
+        """Convert a Telegram photo to PNG, create a variation and download it"""
+        with start_span('image.download', origin='telegram'):
+            photo_data = await photo_file.download_as_bytearray()
+        
+        # Convert to PNG and optimize; PIL is only loaded once images are used
+        from PIL import Image
+        with start_span('image.transcode', input_bytes=len(photo_data)):
+            image = Image.open(io.BytesIO(photo_data))
+            output = io.BytesIO()
+            image.save(output, format='PNG', optimize=True)
+            output.seek(0)
+            output.name = 'image.png'
+        
+        client = self.upstream.client(base_url)
+        response = await self._timed_openai_call(
+            'image_variation', variation_params['model'], base_url,
+            lambda: client.images.create_variation(image=output, **variation_params)
+        )
+        if not response.data:
+            return None
+        return await self._download(response.data[0].url)
+
     async def handle_image_generation(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle image generation request"""
         # Initial response message
@@ -148,11 +286,6 @@ class ChatHandler:
         try:
             # Get user settings
             settings = await self.get_image_settings(update.effective_user.id)
-            if not settings:
-                await response_message.edit_text(
-                    "⚠️ Пожалуйста, настройте параметры генерации изображений через /image_settings"
-                )
-                return
 
             # Get prompt from context
             prompt = context.user_data.get('image_prompt', '')
@@ -160,40 +293,29 @@ class ChatHandler:
                 await response_message.edit_text("❌ Не указан текст для генерации изображения")
                 return
 
-            # Configure OpenAI client with user settings
-            self.openai_client.base_url = settings.base_url
-            
             # Prepare image generation parameters
             image_params = {
-                "model": settings.model,
+                "model": settings['model'],
                 "prompt": prompt,  # Use prompt from context
-                "size": settings.size,
-                "quality": settings.quality,
-                "style": settings.style,
+                "size": settings['size'],
+                "quality": settings['quality'],
+                "style": settings['style'],
                 "n": 1  # Generate one image
             }
             
             # Add HDR if enabled
-            if settings.hdr:
+            if settings['hdr']:
                 image_params["hdr"] = True
             
-            # Generate image
-            response = await self.openai_client.images.generate(**image_params)
+            # Identical prompts requested at the same time share one generation
+            key = ('image', settings['base_url'], normalize_prompt(prompt)) + tuple(
+                sorted((k, v) for k, v in image_params.items() if k != 'prompt')
+            )
+            image_data, _ = await self.inflight.do(key, lambda: self._generate_image(settings['base_url'], image_params))
             
-            if not response.data:
+            if not image_data:
                 await response_message.edit_text("❌ Не удалось сгенерировать изображение")
                 return
-                
-            image_url = response.data[0].url
-            
-            # Download and send the image
-            async with aiohttp.ClientSession() as session:
-                async with session.get(image_url) as resp:
-                    if resp.status != 200:
-                        await response_message.edit_text("❌ Не удалось загрузить изображение")
-                        return
-                    
-                    image_data = await resp.read()
                     
             # Delete the "generating" message
             await response_message.delete()
@@ -226,11 +348,6 @@ class ChatHandler:
         try:
             # Get user settings
             settings = await self.get_image_settings(update.effective_user.id)
-            if not settings:
-                await response_message.edit_text(
-                    "⚠️ Пожалуйста, настройте параметры генерации изображений через /image_settings"
-                )
-                return
 
             # Get the largest photo version
             photo = update.message.photo[-1]
@@ -243,41 +360,22 @@ class ChatHandler:
             # Download the photo
             photo_file = await context.bot.get_file(photo.file_id)
             
-            # Create a BytesIO object for the image
-            import io
-            
-            # Download image data
-            photo_data = await photo_file.download_as_bytearray()
-            image = Image.open(io.BytesIO(photo_data))
-            
-            # Convert to PNG and optimize
-            output = io.BytesIO()
-            image.save(output, format='PNG', optimize=True)
-            output.seek(0)
-            output.name = 'image.png'
+            variation_params = {
+                "model": settings['model'],
+                "n": 1,
+                "size": settings['size']
+            }
             
-            # Generate variation
-            response = await self.openai_client.images.create_variation(
-                image=output,
-                model=settings.model,
-                n=1,
-                size=settings.size
+            # The same photo sent by several users shares one variation request
+            key = ('variation', settings['base_url'], photo.file_unique_id, settings['model'], settings['size'])
+            variation_data, _ = await self.inflight.do(
+                key,
+                lambda: self._create_variation(settings['base_url'], photo_file, variation_params)
             )
             
-            if not response.data:
+            if not variation_data:
                 await response_message.edit_text("❌ Не удалось создать вариацию изображения")
                 return
-                
-            variation_url = response.data[0].url
-            
-            # Download and send the variation
-            async with aiohttp.ClientSession() as session:
-                async with session.get(variation_url) as resp:
-                    if resp.status != 200:
-                        await response_message.edit_text("❌ Не удалось загрузить вариацию")
-                        return
-                    
-                    variation_data = await resp.read()
                     
             # Delete the "generating" message
             await response_message.delete()
@@ -311,23 +409,6 @@ class ChatHandler:
         try:
             # Get user settings
             settings = await self.get_image_settings(update.effective_user.id)
-            if not settings:
-                await update.message.reply_text("❌ Настройки изображения не найдены.")
-                return
-
-            # Download the image
-            async with aiohttp.ClientSession() as session:
-                async with session.get(image_file.file_path) as response:
-                    if response.status != 200:
-                        await update.message.reply_text("❌ Ошибка при загрузке изображения.")
-                        return
-                    image_data = await response.read()
-
-            # Process image to correct format if needed
-            image = Image.open(io.BytesIO(image_data))
-            output = io.BytesIO()
-            image.save(output, format='PNG')
-            output.seek(0)
 
             # Send initial message
             processing_message = await update.message.reply_text(
@@ -336,28 +417,31 @@ class ChatHandler:
             )
 
             # Create image variation with text prompt
-            response = await self.openai_client.images.create_variation(
-                image=output,
-                model=settings.model,
-                n=1,
-                size=settings.size,
-                quality=settings.quality,
-                style=settings.style,
-                prompt=text_prompt  # Include the text prompt
+            variation_params = {
+                "model": settings['model'],
+                "n": 1,
+                "size": settings['size'],
+                "quality": settings['quality'],
+                "style": settings['style'],
+                "prompt": text_prompt  # Include the text prompt
+            }
+            key = (
+                'combined', settings['base_url'], photo.file_unique_id, normalize_prompt(text_prompt),
+                settings['model'], settings['size'], settings['quality'], settings['style']
+            )
+            image_data, _ = await self.inflight.do(
+                key,
+                lambda: self._create_variation(settings['base_url'], image_file, variation_params)
             )
 
             # Send the generated image
-            image_url = response.data[0].url
-            async with aiohttp.ClientSession() as session:
-                async with session.get(image_url) as response:
-                    if response.status == 200:
-                        image_data = await response.read()
-                        await update.message.reply_photo(
-                            photo=BytesIO(image_data),
-                            caption=f"🎨 Сгенерированное изображение на основе фото и текста:\n{text_prompt}"
-                        )
-                    else:
-                        await update.message.reply_text("❌ Ошибка при получении сгенерированного изображения.")
+            if image_data:
+                await update.message.reply_photo(
+                    photo=BytesIO(image_data),
+                    caption=f"🎨 Сгенерированное изображение на основе фото и текста:\n{text_prompt}"
+                )
+            else:
+                await update.message.reply_text("❌ Ошибка при получении сгенерированного изображения.")
 
             # Delete processing message
             await processing_message.delete()
@@ -1,55 +1,186 @@
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import ContextTypes, ConversationHandler, CommandHandler, CallbackQueryHandler
-from utils.database import User, Message, init_db
-from sqlalchemy.orm import Session
+from utils.database import User, Message, run_read, run_write
+from sqlalchemy import delete, func, select, tuple_, update as sql_update
 from datetime import datetime, timedelta
-import logging
+from typing import Optional, Tuple
+import asyncio
+import os
+import time
+from utils.logging_config import setup_logging
+from utils.tracing import start_span
+from utils.search import index_message, search_messages
+from utils.export import EXPORT_FORMATS, EXPORT_MAX_UPLOAD_BYTES, build_export, file_size
 
 # States
 HISTORY_MENU, CONFIRM_CLEAR = range(2)
 
-logger = logging.getLogger(__name__)
-Session = init_db()
+# Telegram rejects messages longer than this
+MAX_MESSAGE_LENGTH = 4096
+HISTORY_PAGE_SIZE = 10
+# Longer messages are cut in the /history listing
+HISTORY_PREVIEW_CHARS = 300
+SEARCH_PAGE_SIZE = 5
+
+EPOCH = datetime(1970, 1, 1)
+
+# Cleared history is deleted in batches this size, pausing between them so
+# other writers are not locked out
+HISTORY_DELETE_BATCH = int(os.getenv('HISTORY_DELETE_BATCH', '1000'))
+HISTORY_DELETE_PAUSE = float(os.getenv('HISTORY_DELETE_PAUSE', '0.05'))
+# Minimum seconds between progress edits of the confirmation message
+PROGRESS_EDIT_INTERVAL = 2.0
+
+logger = setup_logging(__name__)
+
+def encode_cursor(message: Message) -> str:
+    """Pack a message's (timestamp, id) position into callback data"""
+    return f"{(message.timestamp - EPOCH) // timedelta(microseconds=1)}:{message.id}"
+
+def decode_cursor(cursor: str) -> Tuple[datetime, int]:
+    micros, message_id = cursor.split(':')
+    return EPOCH + timedelta(microseconds=int(micros)), int(message_id)
+
+def format_history(messages, max_length: int = MAX_MESSAGE_LENGTH) -> Tuple[str, int]:
+    """Build the /history message text within max_length.
+
+    Returns the text and how many messages it shows; messages that do not
+    fit are left for the next page.
+    """
+    parts = ["📋 Ваши сообщения:\n\n"]
+    length = len(parts[0])
+    shown = 0
+    for msg in messages:
+        content = msg.content or ""
+        if len(content) > HISTORY_PREVIEW_CHARS:
+            content = content[:HISTORY_PREVIEW_CHARS].rstrip() + "…"
+        date = msg.timestamp.strftime("%d.%m.%Y %H:%M")
+        prefix = "❓" if msg.role == 'user' else "💡"
+        entry = f"🕒 {date}\n{prefix} {content}\n\n"
+        if length + len(entry) > max_length:
+            break
+        parts.append(entry)
+        length += len(entry)
+        shown += 1
+    return ''.join(parts), shown
+
+def format_search_results(query: str, results, max_length: int = MAX_MESSAGE_LENGTH) -> str:
+    """Build the /search results text within max_length"""
+    parts = [f"🔎 Результаты по запросу «{query[:100]}»:\n\n"]
+    length = len(parts[0])
+    for result in results:
+        date = result.timestamp.strftime("%d.%m.%Y %H:%M")
+        prefix = "❓" if result.role == 'user' else "💡"
+        entry = f"🕒 {date}\n{prefix} {result.snippet}\n\n"
+        if length + len(entry) > max_length:
+            break
+        parts.append(entry)
+        length += len(entry)
+    return ''.join(parts)
 
 class HistoryHandler:
+    def __init__(self):
+        # Users with an /export_history being built, one export each at a time
+        self._exports_running = set()
+
+    async def get_history_page(self, user_id: int, limit: int = HISTORY_PAGE_SIZE,
+                               before: Optional[str] = None, after: Optional[str] = None) -> Tuple[list, bool]:
+        """Get one page of history, newest first, older than `before` or newer than `after`.
+
+        Returns the messages and whether there are more in the paging direction.
+        Each page is a single range scan of the (user_id, timestamp, id) index;
+        messages up to the user's history cutoff are being cleared and skipped.
+        """
+        messages = await run_read(self._query_history_page, user_id, limit, before, after)
+        has_more = len(messages) > limit
+        messages = messages[:limit]
+        if after:
+            messages.reverse()
+        return messages, has_more
+
+    def _query_history_page(self, session, user_id: int, limit: int,
+                            before: Optional[str], after: Optional[str]) -> list:
+        position = tuple_(Message.timestamp, Message.id)
+        query = session.query(Message)\
+            .join(User, Message.user_id == User.id)\
+            .filter(User.telegram_id == user_id)\
+            .filter(Message.id > func.coalesce(User.history_cutoff_id, 0))
+        if after:
+            query = query.filter(position > tuple_(*decode_cursor(after)))\
+                .order_by(Message.timestamp.asc(), Message.id.asc())
+        else:
+            if before:
+                query = query.filter(position < tuple_(*decode_cursor(before)))
+            query = query.order_by(Message.timestamp.desc(), Message.id.desc())
+        # One extra row tells whether another page exists
+        return query.limit(limit + 1).all()
+
     async def get_user_history(self, user_id: int, limit: int = 10) -> list:
         """Get user's message history"""
-        with Session() as session:
-            user = session.query(User).filter_by(telegram_id=user_id).first()
-            if not user:
-                return []
-            
-            messages = session.query(Message)\
-                .filter_by(user_id=user.id)\
-                .order_by(Message.timestamp.desc())\
-                .limit(limit)\
-                .all()
-            
-            return messages
+        messages, _ = await self.get_history_page(user_id, limit)
+        return messages
 
-    async def show_history(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        """Show message history"""
-        messages = await self.get_user_history(update.effective_user.id)
-        
+    async def _render_page(self, user_id: int, before: Optional[str] = None, after: Optional[str] = None):
+        """Return the text and keyboard for a history page, or None if it is empty"""
+        messages, has_more = await self.get_history_page(user_id, before=before, after=after)
         if not messages:
-            await update.message.reply_text("📭 История сообщений пуста")
-            return
+            return None
+        history_text, shown = format_history(messages)
+        # Paging from a cursor implies a page exists on the other side
+        has_older = has_more if not after else True
+        has_newer = bool(before) or bool(after and has_more)
+        if shown < len(messages):
+            # Messages that did not fit are shown on the older page
+            has_older = True
+            messages = messages[:shown]
         
-        history_text = "📋 Ваши последние сообщения:\n\n"
-        for msg in messages:
-            date = msg.timestamp.strftime("%d.%m.%Y %H:%M")
-            prefix = "❓" if msg.role == 'user' else "💡"
-            history_text += f"🕒 {date}\n{prefix} {msg.content}\n\n"
-        
-        keyboard = [
+        navigation = []
+        if has_older:
+            navigation.append(InlineKeyboardButton(
+                "⬅️ Раньше", callback_data=f"history_older:{encode_cursor(messages[-1])}"
+            ))
+        if has_newer:
+            navigation.append(InlineKeyboardButton(
+                "Позже ➡️", callback_data=f"history_newer:{encode_cursor(messages[0])}"
+            ))
+        keyboard = [navigation] if navigation else []
+        keyboard += [
             [InlineKeyboardButton("🗑️ Очистить историю", callback_data="clear_history")],
             [InlineKeyboardButton("❌ Закрыть", callback_data="close_history")]
         ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
+        return history_text, InlineKeyboardMarkup(keyboard)
+
+    async def show_history(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Show the newest page of message history"""
+        page = await self._render_page(update.effective_user.id)
         
+        if not page:
+            await update.message.reply_text("📭 История сообщений пуста")
+            return
+        
+        history_text, reply_markup = page
         await update.message.reply_text(history_text, reply_markup=reply_markup)
         return HISTORY_MENU
 
+    async def show_history_page(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Move to an older or newer history page"""
+        query = update.callback_query
+        await query.answer()
+        
+        direction, cursor = query.data.split(':', 1)
+        if direction == 'history_older':
+            page = await self._render_page(query.from_user.id, before=cursor)
+        else:
+            page = await self._render_page(query.from_user.id, after=cursor)
+        
+        if not page:
+            await query.edit_message_text("📭 История сообщений пуста")
+            return ConversationHandler.END
+        
+        history_text, reply_markup = page
+        await query.edit_message_text(history_text, reply_markup=reply_markup)
+        return HISTORY_MENU
+
     async def confirm_clear(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Show clear history confirmation"""
         query = update.callback_query
@@ -71,55 +202,284 @@ class HistoryHandler:
         return CONFIRM_CLEAR
 
     async def clear_history(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        """Clear user's message history"""
+        """Hide the user's history at once and delete it in the background"""
         query = update.callback_query
         await query.answer()
         
-        with Session() as session:
-            user = session.query(User).filter_by(telegram_id=query.from_user.id).first()
-            if user:
-                session.query(Message).filter_by(user_id=user.id).delete()
-                session.commit()
+        cleared = await run_write(self._set_history_cutoff, query.from_user.id)
+        if not cleared:
+            await query.edit_message_text("✅ История сообщений очищена")
+            return ConversationHandler.END
         
-        await query.edit_message_text("✅ История сообщений очищена")
+        user_db_id, cutoff_id, total = cleared
+        await query.edit_message_text(f"🗑️ История скрыта, удаляю сообщения: 0 из {total}")
+        context.application.create_task(
+            self._purge_history(query, user_db_id, cutoff_id, total),
+            update=update
+        )
         return ConversationHandler.END
 
+    def _set_history_cutoff(self, session, user_id: int) -> Optional[Tuple[int, int, int]]:
+        """Mark all current messages as cleared; returns (user row id, cutoff id, count)"""
+        user = session.query(User).filter_by(telegram_id=user_id).first()
+        if not user:
+            return None
+        cutoff_id, total = session.query(func.max(Message.id), func.count(Message.id))\
+            .filter(Message.user_id == user.id)\
+            .filter(Message.id > func.coalesce(user.history_cutoff_id, 0))\
+            .one()
+        if not cutoff_id:
+            return None
+        user.history_cutoff_id = cutoff_id
+        return user.id, cutoff_id, total
+
+    def _delete_history_batch(self, session, user_db_id: int, cutoff_id: int) -> int:
+        """Delete the oldest batch of cleared messages; returns how many were deleted"""
+        batch = select(Message.id)\
+            .where(Message.user_id == user_db_id, Message.id <= cutoff_id)\
+            .order_by(Message.id)\
+            .limit(HISTORY_DELETE_BATCH)
+        deleted = session.execute(
+            delete(Message).where(Message.id.in_(batch)).execution_options(synchronize_session=False)
+        ).rowcount
+        if deleted < HISTORY_DELETE_BATCH:
+            # Done. The cutoff is lifted in the same transaction as the last
+            # delete: SQLite may reuse ids of deleted rows, and new messages
+            # must not fall under a stale cutoff. A newer /clear_history
+            # has its own cutoff and keeps it.
+            session.execute(
+                sql_update(User)
+                .where(User.id == user_db_id, User.history_cutoff_id == cutoff_id)
+                .values(history_cutoff_id=None)
+            )
+        return deleted
+
+    def _pending_purges(self, session) -> list:
+        return session.query(User.id, User.history_cutoff_id)\
+            .filter(User.history_cutoff_id.isnot(None))\
+            .all()
+
+    async def resume_purges(self, context: ContextTypes.DEFAULT_TYPE):
+        """Job: keep deleting history that was cleared before a restart"""
+        pending = await run_read(self._pending_purges)
+        for user_db_id, cutoff_id in pending:
+            context.application.create_task(self._purge_history(None, user_db_id, cutoff_id))
+
+    async def _purge_history(self, query, user_db_id: int, cutoff_id: int, total: int = 0):
+        """Delete cleared messages in batches, reporting progress on the confirmation message if given"""
+        deleted_total = 0
+        last_edit = time.monotonic()
+        try:
+            while True:
+                # Each batch is its own short write, so other writes interleave
+                deleted = await run_write(self._delete_history_batch, user_db_id, cutoff_id)
+                deleted_total += deleted
+                if deleted < HISTORY_DELETE_BATCH:
+                    break
+                if query and time.monotonic() - last_edit >= PROGRESS_EDIT_INTERVAL:
+                    last_edit = time.monotonic()
+                    await query.edit_message_text(
+                        f"🗑️ История скрыта, удаляю сообщения: {deleted_total} из {total}"
+                    )
+                await asyncio.sleep(HISTORY_DELETE_PAUSE)
+        except Exception as e:
+            # The cutoff stays in place, so the history remains hidden
+            logger.error(f"Error deleting history of user {user_db_id}: {e}")
+            raise
+        if query:
+            await query.edit_message_text("✅ История сообщений очищена")
+
+    async def _search_page(self, user_id: int, query: str, offset: int):
+        """Return the text and keyboard for a page of search results, or None if nothing matched"""
+        results, has_more = await run_read(search_messages, user_id, query, offset, SEARCH_PAGE_SIZE)
+        if not results:
+            return None
+        
+        navigation = []
+        if offset > 0:
+            navigation.append(InlineKeyboardButton(
+                "⬅️ Назад", callback_data=f"search_page:{max(offset - SEARCH_PAGE_SIZE, 0)}"
+            ))
+        if has_more:
+            navigation.append(InlineKeyboardButton(
+                "Дальше ➡️", callback_data=f"search_page:{offset + SEARCH_PAGE_SIZE}"
+            ))
+        reply_markup = InlineKeyboardMarkup([navigation]) if navigation else None
+        return format_search_results(query, results), reply_markup
+
+    async def search(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Handle /search <words>: ranked full-text search over the user's history"""
+        query = ' '.join(context.args or []).strip()
+        if not query:
+            await update.message.reply_text("ℹ️ Использование: /search <слова для поиска>")
+            return
+        
+        # Callback data is limited to 64 bytes, so the query stays in user_data
+        context.user_data['search_query'] = query
+        with start_span('history.search'):
+            page = await self._search_page(update.effective_user.id, query, 0)
+        if not page:
+            await update.message.reply_text(f"🔍 По запросу «{query[:100]}» ничего не найдено")
+            return
+        
+        results_text, reply_markup = page
+        await update.message.reply_text(results_text, reply_markup=reply_markup)
+
+    async def search_page(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Show another page of the last /search"""
+        query = update.callback_query
+        await query.answer()
+        
+        search_query = context.user_data.get('search_query')
+        if not search_query:
+            await query.edit_message_text("⌛ Поиск устарел, повторите /search")
+            return
+        
+        offset = int(query.data.split(':', 1)[1])
+        with start_span('history.search', offset=offset):
+            page = await self._search_page(query.from_user.id, search_query, offset)
+        if not page:
+            await query.edit_message_text(f"🔍 По запросу «{search_query[:100]}» ничего не найдено")
+            return
+        
+        results_text, reply_markup = page
+        await query.edit_message_text(results_text, reply_markup=reply_markup)
+
+    def get_search_handlers(self) -> list:
+        """Return handlers for /search and its paging buttons"""
+        return [
+            CommandHandler('search', self.search),
+            CallbackQueryHandler(self.search_page, pattern="^search_page:"),
+        ]
+
+    async def export_history(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Handle /export_history [jsonl|md]: send the history as a file, built in the background"""
+        fmt = (context.args[0].lower().lstrip('.') if context.args else 'jsonl')
+        if fmt == 'markdown':
+            fmt = 'md'
+        if fmt not in EXPORT_FORMATS:
+            await update.message.reply_text("ℹ️ Использование: /export_history [jsonl|md]")
+            return
+        
+        user_id = update.effective_user.id
+        if user_id in self._exports_running:
+            await update.message.reply_text("⏳ Экспорт уже готовится, дождитесь файла")
+            return
+        
+        # Claimed before the first await so a repeated command cannot start a second export;
+        # from here on _send_export releases it
+        self._exports_running.add(user_id)
+        try:
+            status = await update.message.reply_text("⏳ Готовлю экспорт истории...")
+            context.application.create_task(
+                self._send_export(context, update.effective_chat.id, user_id, fmt, status),
+                update=update
+            )
+        except BaseException:
+            self._exports_running.discard(user_id)
+            raise
+
+    async def _send_export(self, context: ContextTypes.DEFAULT_TYPE, chat_id: int,
+                           user_id: int, fmt: str, status):
+        """Build the export off the event loop and upload it"""
+        export = None
+        try:
+            with start_span('history.export', format=fmt):
+                export, suffix, count = await run_read(build_export, user_id, fmt)
+            if export is None:
+                await status.edit_text("📭 История сообщений пуста")
+                return
+            if file_size(export) > EXPORT_MAX_UPLOAD_BYTES:
+                await status.edit_text("❌ История слишком большая для отправки файлом")
+                return
+            await context.bot.send_document(
+                chat_id=chat_id,
+                document=export,
+                filename=f"history_{user_id}_{datetime.utcnow():%Y%m%d}.{suffix}",
+                caption=f"📤 Экспорт истории, сообщений: {count}"
+            )
+            await status.delete()
+        except Exception as e:
+            logger.error(f"Error exporting history of user {user_id}: {e}", exc_info=True)
+            await status.edit_text("❌ Не удалось экспортировать историю. Попробуйте позже")
+        finally:
+            if export is not None:
+                export.close()
+            self._exports_running.discard(user_id)
+
+    async def stale_menu(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Answer a button of a /history menu whose conversation has timed out"""
+        query = update.callback_query
+        await query.answer()
+        await query.edit_message_text("⌛ Меню устарело, откройте /history заново")
+
+    def get_page_handlers(self) -> list:
+        """Return handlers for /history buttons pressed after the conversation ended.
+
+        Pages are addressed by cursor, so paging keeps working; the clear
+        buttons need the conversation and are answered as stale. Register
+        after the conversation handler, which takes these buttons while active.
+        """
+        return [
+            CallbackQueryHandler(self.show_history_page, pattern="^history_(older|newer):"),
+            CallbackQueryHandler(self.cancel, pattern="^close_history$"),
+            CallbackQueryHandler(self.stale_menu, pattern="^(clear_history|confirm_clear_(yes|no))$"),
+        ]
+
+    def get_export_handlers(self) -> list:
+        """Return handlers for /export_history"""
+        return [CommandHandler('export_history', self.export_history)]
+
     async def cancel(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Cancel the conversation"""
         query = update.callback_query
-        await query.answer()
-        await query.edit_message_text("❌ Операция отменена")
+        if query:
+            await query.answer()
+            await query.edit_message_text("❌ Операция отменена")
         return ConversationHandler.END
 
     def get_conversation_handler(self):
         """Return conversation handler for history management"""
         return ConversationHandler(
-            entry_points=[CommandHandler('clear_history', self.show_clear_history_menu)],
+            entry_points=[
+                CommandHandler('history', self.show_history),
+                CommandHandler('clear_history', self.show_history),
+            ],
             states={
+                HISTORY_MENU: [
+                    CallbackQueryHandler(self.show_history_page, pattern="^history_(older|newer):"),
+                    CallbackQueryHandler(self.confirm_clear, pattern="^clear_history$"),
+                    CallbackQueryHandler(self.cancel, pattern="^close_history$"),
+                ],
                 CONFIRM_CLEAR: [
-                    CallbackQueryHandler(self.handle_clear_history, pattern="^clear_"),
-                    CallbackQueryHandler(self.cancel_clear, pattern="^cancel_clear$"),
+                    CallbackQueryHandler(self.clear_history, pattern="^confirm_clear_yes$"),
+                    CallbackQueryHandler(self.cancel, pattern="^confirm_clear_no$"),
                 ],
             },
-            fallbacks=[CommandHandler('cancel', self.cancel_clear)],
+            fallbacks=[CommandHandler('cancel', self.cancel)],
             allow_reentry=True,
             name="history_conversation",
             persistent=True,
             per_chat=True,
             per_user=True,
-            per_message=True,
+            # Commands start this conversation, so it cannot be tracked per message
+            per_message=False,
             conversation_timeout=300  # 5 minutes timeout
         )
 
     async def save_message(self, user_id: int, content: str, role: str = 'user'):
         """Save message to history"""
-        with Session() as session:
-            user = session.query(User).filter_by(telegram_id=user_id).first()
-            if not user:
-                user = User(telegram_id=user_id)
-                session.add(user)
-                session.commit()
-            
-            message = Message(user_id=user.id, content=content, role=role)
-            session.add(message)
-            session.commit() 
\ No newline at end of file
+        with start_span('history.save', role=role):
+            await run_write(self._save_message, user_id, content, role)
+
+    def _save_message(self, session, user_id: int, content: str, role: str):
+        user = session.query(User).filter_by(telegram_id=user_id).first()
+        if not user:
+            user = User(telegram_id=user_id)
+            session.add(user)
+            session.flush()
+        
+        message = Message(user_id=user.id, content=content, role=role)
+        session.add(message)
+        session.flush()
+        index_message(session, message.id, user.id, content)
@@ -7,17 +7,15 @@ from telegram.ext import (
     MessageHandler,
     filters
 )
-from utils.database import User, ImageSettings, init_db
-from sqlalchemy.orm import Session
-import logging
+from utils.settings_store import image_settings
+from utils.logging_config import setup_logging
 import telegram.error
 
 # States for image settings conversation
 (IMAGE_MAIN_MENU, IMAGE_BASE_URL, IMAGE_MODEL, 
  IMAGE_SIZE, IMAGE_QUALITY, IMAGE_STYLE) = range(6)
 
-logger = logging.getLogger(__name__)
-Session = init_db()
+logger = setup_logging(__name__)
 
 class ImageSettingsHandler:
     def __init__(self):
@@ -45,38 +43,9 @@ class ImageSettingsHandler:
             "anime": "Аниме"
         }
 
-    async def get_or_create_settings(self, user_id: int) -> dict:
-        """Get or create image settings"""
-        with Session() as session:
-            user = session.query(User).filter_by(telegram_id=user_id).first()
-            if not user:
-                user = User(telegram_id=user_id)
-                session.add(user)
-                session.commit()
-            
-            settings = session.query(ImageSettings).filter_by(user_id=user.id).first()
-            if not settings:
-                settings = ImageSettings(
-                    user_id=user.id,
-                    base_url="https://api.openai.com/v1",
-                    model="dall-e-3",
-                    size="1024x1024",
-                    quality="standard",
-                    style="natural",
-                    hdr=False
-                )
-                session.add(settings)
-                session.commit()
-                session.refresh(settings)
-            
-            return {
-                'base_url': settings.base_url,
-                'model': settings.model,
-                'size': settings.size,
-                'quality': settings.quality,
-                'style': settings.style,
-                'hdr': settings.hdr
-            }
+    async def get_settings(self, user_id: int) -> dict:
+        """Get image settings, defaults included"""
+        return await image_settings.get(user_id)
 
     async def image_settings_menu(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Show main image settings menu"""
@@ -100,7 +69,7 @@ class ImageSettingsHandler:
         ]
         reply_markup = InlineKeyboardMarkup(keyboard)
         
-        settings = await self.get_or_create_settings(user_id)
+        settings = await self.get_settings(user_id)
         text = (
             "🖼 Настройки генерации изображений:\n\n"
             f"🌐 URL: {settings['base_url']}\n"
@@ -199,22 +168,9 @@ class ImageSettingsHandler:
         await query.answer()
         
         try:
-            with Session() as session:
-                user = session.query(User).filter_by(telegram_id=query.from_user.id).first()
-                if not user:
-                    user = User(telegram_id=query.from_user.id)
-                    session.add(user)
-                    session.commit()
-                
-                settings = session.query(ImageSettings).filter_by(user_id=user.id).first()
-                if not settings:
-                    settings = ImageSettings(user_id=user.id)
-                    session.add(settings)
-                
-                # Toggle HDR setting
-                settings.hdr = not settings.hdr
-                session.commit()
-                logger.debug(f"Toggled HDR to {settings.hdr} for user {query.from_user.id}")
+            settings = await image_settings.get(query.from_user.id)
+            settings = await image_settings.update(query.from_user.id, hdr=not settings['hdr'])
+            logger.debug("Toggled HDR to %s for user %s", settings['hdr'], query.from_user.id)
             
             # Return to the main menu with updated settings
             return await self.image_settings_menu(query, context)
@@ -234,30 +190,10 @@ class ImageSettingsHandler:
         value = '_'.join(data.split('_')[2:])
         
         try:
-            with Session() as session:
-                user = session.query(User).filter_by(telegram_id=query.from_user.id).first()
-                if not user:
-                    user = User(telegram_id=query.from_user.id)
-                    session.add(user)
-                    session.commit()
-                
-                settings = session.query(ImageSettings).filter_by(user_id=user.id).first()
-                if not settings:
-                    settings = ImageSettings(user_id=user.id)
-                    session.add(settings)
-                
-                # Update the appropriate setting
-                if setting_type == 'model':
-                    settings.model = value
-                elif setting_type == 'size':
-                    settings.size = value
-                elif setting_type == 'quality':
-                    settings.quality = value
-                elif setting_type == 'style':
-                    settings.style = value
-                
-                session.commit()
-                logger.debug(f"Updated {setting_type} to {value} for user {query.from_user.id}")
+            # Update the appropriate setting
+            if setting_type in ('model', 'size', 'quality', 'style'):
+                await image_settings.update(query.from_user.id, **{setting_type: value})
+                logger.debug("Updated %s to %s for user %s", setting_type, value, query.from_user.id)
             
             return await self.image_settings_menu(query, context)
         
@@ -278,21 +214,8 @@ class ImageSettingsHandler:
         new_url = update.message.text
         
         try:
-            with Session() as session:
-                user = session.query(User).filter_by(telegram_id=update.effective_user.id).first()
-                if not user:
-                    user = User(telegram_id=update.effective_user.id)
-                    session.add(user)
-                    session.commit()
-                
-                settings = session.query(ImageSettings).filter_by(user_id=user.id).first()
-                if not settings:
-                    settings = ImageSettings(user_id=user.id)
-                    session.add(settings)
-                
-                settings.base_url = new_url
-                session.commit()
-                logger.debug(f"Updated base URL to {new_url} for user {update.effective_user.id}")
+            await image_settings.update(update.effective_user.id, base_url=new_url)
+            logger.debug("Updated base URL to %s for user %s", new_url, update.effective_user.id)
             
             await update.message.reply_text(f"✅ Base URL обновлен на: {new_url}")
             return await self.image_settings_menu(update, context)
@@ -312,34 +235,41 @@ class ImageSettingsHandler:
                     CallbackQueryHandler(self.select_image_size, pattern="^select_image_size$"),
                     CallbackQueryHandler(self.select_image_quality, pattern="^select_image_quality$"),
                     CallbackQueryHandler(self.select_image_style, pattern="^select_image_style$"),
-                    CallbackQueryHandler(self.handle_setting_update, pattern="^toggle_hdr$"),
+                    CallbackQueryHandler(self.handle_base_url_start, pattern="^edit_image_base_url$"),
+                    CallbackQueryHandler(self.toggle_hdr, pattern="^toggle_hdr$"),
+                    CallbackQueryHandler(self.cancel, pattern="^close_image_settings$"),
+                ],
+                IMAGE_BASE_URL: [
+                    MessageHandler(filters.TEXT & ~filters.COMMAND, self.handle_base_url),
+                    CallbackQueryHandler(self.image_settings_menu, pattern="^back_to_image_menu$"),
                 ],
                 IMAGE_MODEL: [
                     CallbackQueryHandler(self.handle_setting_update, pattern="^set_model_"),
-                    CallbackQueryHandler(self.image_settings_menu, pattern="^back_to_image_settings$"),
+                    CallbackQueryHandler(self.image_settings_menu, pattern="^back_to_image_menu$"),
                 ],
                 IMAGE_SIZE: [
                     CallbackQueryHandler(self.handle_setting_update, pattern="^set_size_"),
-                    CallbackQueryHandler(self.image_settings_menu, pattern="^back_to_image_settings$"),
+                    CallbackQueryHandler(self.image_settings_menu, pattern="^back_to_image_menu$"),
                 ],
                 IMAGE_QUALITY: [
                     CallbackQueryHandler(self.handle_setting_update, pattern="^set_quality_"),
-                    CallbackQueryHandler(self.image_settings_menu, pattern="^back_to_image_settings$"),
+                    CallbackQueryHandler(self.image_settings_menu, pattern="^back_to_image_menu$"),
                 ],
                 IMAGE_STYLE: [
                     CallbackQueryHandler(self.handle_setting_update, pattern="^set_style_"),
-                    CallbackQueryHandler(self.image_settings_menu, pattern="^back_to_image_settings$"),
+                    CallbackQueryHandler(self.image_settings_menu, pattern="^back_to_image_menu$"),
                 ],
             },
             fallbacks=[
-                CallbackQueryHandler(self.image_settings_menu, pattern="^close_image_settings$"),
+                CallbackQueryHandler(self.cancel, pattern="^close_image_settings$"),
             ],
             allow_reentry=True,
             name="image_settings_conversation",
             persistent=True,
             per_chat=True,
             per_user=True,
-            per_message=True,
+            # Entered by a command, so state is kept per user and chat, not per menu message
+            per_message=False,
             conversation_timeout=300  # 5 minutes timeout
         )
 
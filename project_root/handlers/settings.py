@@ -1,22 +1,16 @@
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, CallbackQuery
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import ContextTypes, ConversationHandler, CommandHandler, CallbackQueryHandler, MessageHandler, filters
-from utils.database import User, UserSettings, init_db
-from sqlalchemy.orm import Session
-import logging
+from utils.settings_store import text_settings, image_settings
 from utils.logging_config import setup_logging, log_function_call
-import os
 import telegram.error
 import json
 from io import BytesIO
-import aiohttp
 
 # States for text model settings conversation
 (MAIN_MENU, MODEL_SETTINGS, BASE_URL, MODEL_SELECTION, 
  CUSTOM_MODEL, TEMPERATURE, MAX_TOKENS, ASSISTANT_URL) = range(8)
 
-# Initialize logging with just the filename
-logger = setup_logging(__name__, 'settings.log')
-Session = init_db()
+logger = setup_logging(__name__)
 
 class SettingsHandler:
     def __init__(self):
@@ -29,36 +23,12 @@ class SettingsHandler:
         }
 
     @log_function_call(logger)
-    async def get_or_create_settings(self, user_id: int) -> dict:
-        """Get or create user settings"""
+    async def get_settings(self, user_id: int) -> dict:
+        """Get user settings, defaults included"""
         try:
-            with Session() as session:
-                user = session.query(User).filter_by(telegram_id=user_id).first()
-                if not user:
-                    user = User(telegram_id=user_id)
-                    session.add(user)
-                    session.commit()
-                
-                settings = session.query(UserSettings).filter_by(user_id=user.id).first()
-                if not settings:
-                    settings = UserSettings(user_id=user.id)
-                    session.add(settings)
-                    session.commit()
-                
-                # Refresh the session to ensure all attributes are loaded
-                session.refresh(settings)
-                
-                # Create a dictionary of settings values
-                settings_dict = {
-                    'base_url': settings.base_url,
-                    'model': settings.model,
-                    'temperature': settings.temperature,
-                    'max_tokens': settings.max_tokens,
-                    'use_assistant': settings.use_assistant,
-                    'assistant_url': settings.assistant_url
-                }
-                logger.debug(f"Settings for user {user_id}: {settings_dict}")
-                return settings_dict
+            settings = await text_settings.get(user_id)
+            logger.debug("Settings for user %s: %s", user_id, settings)
+            return settings
         except Exception as e:
             logger.error(f"Error getting settings for user {user_id}: {e}", exc_info=True)
             raise
@@ -87,7 +57,7 @@ class SettingsHandler:
         ]
         reply_markup = InlineKeyboardMarkup(keyboard)
         
-        settings = await self.get_or_create_settings(user_id)
+        settings = await self.get_settings(user_id)
         text = (
             "⚙️ Текущие настройки:\n\n"
             f"🌐 URL: {settings['base_url']}\n"
@@ -151,21 +121,8 @@ class SettingsHandler:
         model = query.data.replace("model_", "")
         
         try:
-            with Session() as session:
-                user = session.query(User).filter_by(telegram_id=query.from_user.id).first()
-                if not user:
-                    user = User(telegram_id=query.from_user.id)
-                    session.add(user)
-                    session.commit()
-                
-                settings = session.query(UserSettings).filter_by(user_id=user.id).first()
-                if not settings:
-                    settings = UserSettings(user_id=user.id)
-                    session.add(settings)
-                
-                settings.model = model
-                session.commit()
-                logger.debug(f"Updated model to {model} for user {query.from_user.id}")
+            await text_settings.update(query.from_user.id, model=model)
+            logger.debug("Updated model to %s for user %s", model, query.from_user.id)
             
             return await self.settings_menu(update.callback_query, context)
             
@@ -199,10 +156,7 @@ class SettingsHandler:
         user_id = update.effective_user.id
         new_url = update.message.text
         
-        with Session() as session:
-            settings = await self.get_or_create_settings(user_id)
-            settings.base_url = new_url
-            session.commit()
+        await text_settings.update(user_id, base_url=new_url)
         
         await update.message.reply_text(f"✅ Base URL обновлен на: {new_url}")
         return await self.settings_menu(update, context)
@@ -215,22 +169,8 @@ class SettingsHandler:
         
         temp = float(query.data.replace("temp_", ""))
         try:
-            with Session() as session:
-                user = session.query(User).filter_by(telegram_id=query.from_user.id).first()
-                if not user:
-                    user = User(telegram_id=query.from_user.id)
-                    session.add(user)
-                    session.commit()
-                
-                settings = session.query(UserSettings).filter_by(user_id=user.id).first()
-                if not settings:
-                    settings = UserSettings(user_id=user.id)
-                    session.add(settings)
-                
-                # Update temperature directly in the database
-                settings.temperature = temp
-                session.commit()
-                logger.debug(f"Updated temperature to {temp} for user {query.from_user.id}")
+            await text_settings.update(query.from_user.id, temperature=temp)
+            logger.debug("Updated temperature to %s for user %s", temp, query.from_user.id)
             
             return await self.settings_menu(query, context)
             
@@ -248,22 +188,8 @@ class SettingsHandler:
                 await update.message.reply_text("⚠️ Минимальное значение токенов: 150")
                 return MAX_TOKENS
             
-            with Session() as session:
-                user = session.query(User).filter_by(telegram_id=update.effective_user.id).first()
-                if not user:
-                    user = User(telegram_id=update.effective_user.id)
-                    session.add(user)
-                    session.commit()
-                
-                settings = session.query(UserSettings).filter_by(user_id=user.id).first()
-                if not settings:
-                    settings = UserSettings(user_id=user.id)
-                    session.add(settings)
-                
-                # Update max_tokens directly in the database
-                settings.max_tokens = tokens
-                session.commit()
-                logger.debug(f"Updated max_tokens to {tokens} for user {update.effective_user.id}")
+            await text_settings.update(update.effective_user.id, max_tokens=tokens)
+            logger.debug("Updated max_tokens to %s for user %s", tokens, update.effective_user.id)
             
             await update.message.reply_text(f"✅ Максимальное количество токенов установлено: {tokens}")
             return await self.settings_menu(update, context)
@@ -282,11 +208,7 @@ class SettingsHandler:
         user_id = update.effective_user.id
         assistant_url = update.message.text
         
-        with Session() as session:
-            settings = await self.get_or_create_settings(user_id)
-            settings.assistant_url = assistant_url
-            settings.use_assistant = True
-            session.commit()
+        await text_settings.update(user_id, assistant_url=assistant_url, use_assistant=True)
         
         await update.message.reply_text(f"✅ URL ассистента установлен: {assistant_url}")
         return await self.settings_menu(update, context)
@@ -297,22 +219,8 @@ class SettingsHandler:
         model_name = update.message.text
         
         try:
-            with Session() as session:
-                user = session.query(User).filter_by(telegram_id=update.effective_user.id).first()
-                if not user:
-                    user = User(telegram_id=update.effective_user.id)
-                    session.add(user)
-                    session.commit()
-                
-                settings = session.query(UserSettings).filter_by(user_id=user.id).first()
-                if not settings:
-                    settings = UserSettings(user_id=user.id)
-                    session.add(settings)
-                
-                # Update model directly in the database
-                settings.model = model_name
-                session.commit()
-                logger.debug(f"Updated model to {model_name} for user {update.effective_user.id}")
+            await text_settings.update(update.effective_user.id, model=model_name)
+            logger.debug("Updated model to %s for user %s", model_name, update.effective_user.id)
             
             await update.message.reply_text(f"✅ Модель установлена: {model_name}")
             return await self.settings_menu(update, context)
@@ -420,45 +328,31 @@ class SettingsHandler:
             persistent=True,
             per_chat=True,
             per_user=True,
-            per_message=True,
+            # Entered by a command, so state is kept per user and chat, not per menu message
+            per_message=False,
             conversation_timeout=300  # 5 minutes timeout
         )
 
-    async def handle_setting_update(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        """Handle settings updates"""
-        # Existing code...
-
     async def export_settings(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Export user settings to JSON"""
         user_id = update.effective_user.id
-        
-        with Session() as session:
-            user = session.query(User).filter_by(telegram_id=user_id).first()
-            if not user:
-                await update.message.reply_text("❌ Настройки не найдены.")
-                return
-
-            # Get text and image settings
-            text_settings = session.query(UserSettings).filter_by(user_id=user.id).first()
-            image_settings = session.query(ImageSettings).filter_by(user_id=user.id).first()
 
-            if not text_settings and not image_settings:
-                await update.message.reply_text("❌ Настройки не найдены.")
-                return
-
-            # Create settings dictionary
-            settings_dict = {
-                "text_settings": text_settings.to_dict() if text_settings else None,
-                "image_settings": image_settings.to_dict() if image_settings else None
-            }
+        # Only what the user changed, so importing does not pin today's defaults
+        settings_dict = {
+            "text_settings": await text_settings.get_overrides(user_id),
+            "image_settings": await image_settings.get_overrides(user_id)
+        }
+        if not settings_dict["text_settings"] and not settings_dict["image_settings"]:
+            await update.message.reply_text("ℹ️ Вы используете настройки по умолчанию, экспортировать нечего.")
+            return
 
-            # Convert to JSON and send as file
-            settings_json = json.dumps(settings_dict, indent=2, ensure_ascii=False)
-            await update.message.reply_document(
-                document=BytesIO(settings_json.encode()),
-                filename=f"settings_{user_id}.json",
-                caption="📤 Ваши настройки экспортированы."
-            )
+        # Convert to JSON and send as file
+        settings_json = json.dumps(settings_dict, indent=2, ensure_ascii=False)
+        await update.message.reply_document(
+            document=BytesIO(settings_json.encode()),
+            filename=f"settings_{user_id}.json",
+            caption="📤 Ваши настройки экспортированы."
+        )
 
     async def import_settings(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Import user settings from JSON file"""
@@ -470,6 +364,7 @@ class SettingsHandler:
 
         try:
             file = await context.bot.get_file(update.message.document.file_id)
+            import aiohttp
             async with aiohttp.ClientSession() as session:
                 async with session.get(file.file_path) as response:
                     if response.status != 200:
@@ -481,36 +376,13 @@ class SettingsHandler:
             settings_dict = json.loads(settings_json)
             user_id = update.effective_user.id
 
-            with Session() as session:
-                user = session.query(User).filter_by(telegram_id=user_id).first()
-                if not user:
-                    user = User(telegram_id=user_id)
-                    session.add(user)
-                    session.commit()
-
-                # Update text settings
-                if settings_dict.get("text_settings"):
-                    text_settings = session.query(UserSettings).filter_by(user_id=user.id).first()
-                    if not text_settings:
-                        text_settings = UserSettings(user_id=user.id)
-                        session.add(text_settings)
-                    
-                    for key, value in settings_dict["text_settings"].items():
-                        if hasattr(text_settings, key):
-                            setattr(text_settings, key, value)
-
-                # Update image settings
-                if settings_dict.get("image_settings"):
-                    image_settings = session.query(ImageSettings).filter_by(user_id=user.id).first()
-                    if not image_settings:
-                        image_settings = ImageSettings(user_id=user.id)
-                        session.add(image_settings)
-                    
-                    for key, value in settings_dict["image_settings"].items():
-                        if hasattr(image_settings, key):
-                            setattr(image_settings, key, value)
-
-                session.commit()
+            for section, store in (("text_settings", text_settings), ("image_settings", image_settings)):
+                values = settings_dict.get(section)
+                if values:
+                    # Keys that are not settings are ignored
+                    await store.update(user_id, **{
+                        key: value for key, value in values.items() if key in store.fields
+                    })
 
             await update.message.reply_text("✅ Настройки успешно импортированы.")
 
@@ -523,8 +395,6 @@ class SettingsHandler:
     def get_handlers(self):
         """Return handlers for settings management"""
         return [
-            CommandHandler("settings", self.show_settings_menu),
             CommandHandler("export_settings", self.export_settings),
             CommandHandler("import_settings", self.import_settings),
-            # ... existing handlers ...
         ]
\ No newline at end of file
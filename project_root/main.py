@@ -0,0 +1,37 @@
+"""Run the Telegram bot and the HTTP API in one process and one event loop.
+
+Sharing the loop lets /health report the bot's real state and saves the
+memory and import time of a second interpreter.
+"""
+import asyncio
+import os
+import uvicorn
+from api import app, health_checker
+from bot import TelegramBot, LOGS_DIR
+from utils.logging_config import configure_logging, setup_logging
+
+logger = setup_logging(__name__)
+
+async def serve():
+    bot = TelegramBot()
+    health_checker.bot = bot
+    server = uvicorn.Server(uvicorn.Config(
+        app,
+        host="0.0.0.0",
+        port=int(os.getenv("PORT", "3000")),
+        # Use the process-wide logging pipeline instead of uvicorn's own handlers
+        log_config=None
+    ))
+    await bot.start_polling()
+    try:
+        # Returns once uvicorn receives SIGINT/SIGTERM
+        await server.serve()
+    finally:
+        await bot.stop()
+
+if __name__ == "__main__":
+    configure_logging(os.path.join(LOGS_DIR, 'bot.log'))
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        logger.info("Stopped by user")
@@ -0,0 +1,131 @@
+"""Maintenance commands for the bot's database.
+
+Usage (from project_root):
+    python manage.py prune-history
+    python manage.py import-archive archive/messages/2025-01-*.jsonl.gz
+    python manage.py rebuild-search-index
+    python manage.py compress-history
+    python manage.py compact-settings
+    python manage.py export-settings settings.jsonl.gz
+    python manage.py import-settings settings.jsonl.gz
+"""
+import argparse
+import asyncio
+import os
+import sys
+from dotenv import load_dotenv
+
+# Settings are read from the environment when the modules below are imported
+if os.path.exists('.env'):
+    load_dotenv()
+
+from utils.database import init_db, compress_messages, MESSAGE_COMPRESSION_THRESHOLD  # noqa: E402
+from utils import retention  # noqa: E402
+from utils.search import rebuild_search_index  # noqa: E402
+from utils import settings_store  # noqa: E402
+from utils import bulk_settings  # noqa: E402
+
+def prune_history(args):
+    """Apply the history retention policy now"""
+    if not retention.retention_enabled():
+        sys.exit("Set HISTORY_MAX_AGE_DAYS and/or HISTORY_MAX_ROWS_PER_USER to prune history")
+    deleted = asyncio.run(retention.prune_history())
+    archived = f", archived to {retention.HISTORY_ARCHIVE_DIR}" if retention.HISTORY_ARCHIVE_DIR else ""
+    print(f"Pruned {deleted} messages{archived}")
+
+def import_archive(args):
+    """Load archived messages back into the database"""
+    imported, skipped, cleared = retention.import_archive(init_db(), args.paths)
+    print(f"Imported {imported} messages, skipped {skipped} already present")
+    if cleared:
+        print(f"Not restored: {cleared} messages the users cleared with /clear_history after archiving")
+
+def rebuild_search(args):
+    """Rebuild the /search full-text index from the messages table"""
+    indexed = rebuild_search_index(init_db())
+    print(f"Indexed {indexed} messages")
+
+def compress_history(args):
+    """Compress stored messages over MESSAGE_COMPRESSION_THRESHOLD bytes"""
+    if MESSAGE_COMPRESSION_THRESHOLD <= 0:
+        sys.exit("MESSAGE_COMPRESSION_THRESHOLD is 0, compression is disabled")
+    
+    def progress(last_id, compressed):
+        print(f"  up to message {last_id}: {compressed} compressed", end='\r', flush=True)
+    
+    compressed = compress_messages(init_db(), args.batch_size, progress)
+    print(f"\nCompressed {compressed} messages")
+
+def compact_settings(args):
+    """Drop stored settings that equal the defaults, keeping only real overrides"""
+    for name, store in (('user_settings', settings_store.text_settings),
+                        ('image_settings', settings_store.image_settings)):
+        kept, deleted = store.compact(init_db(), args.batch_size)
+        print(f"{name}: kept {kept} rows with overrides, deleted {deleted} rows of defaults")
+
+def export_settings(args):
+    """Write all users and their settings to a JSONL file (.gz to compress)"""
+    with bulk_settings.open_stream(args.path, 'w') as out:
+        exported = bulk_settings.export_settings(init_db(), out, args.batch_size)
+    print(f"Exported {exported} users to {args.path}")
+
+def import_settings(args):
+    """Create or update users and their settings from an export-settings file"""
+    errors = []
+    
+    def progress(imported):
+        print(f"  {imported} users imported", end='\r', flush=True)
+    
+    with bulk_settings.open_stream(args.path, 'r') as stream:
+        try:
+            imported = bulk_settings.import_settings(
+                init_db(), bulk_settings.read_records(stream, errors, args.strict), args.batch_size, progress
+            )
+        except bulk_settings.RecordError as e:
+            sys.exit(f"\nImport stopped, batches before the error were committed: {e}")
+    print(f"\nImported {imported} users, skipped {len(errors)} invalid lines")
+    for line, reason in errors[:20]:
+        print(f"  line {line}: {reason}")
+    if len(errors) > 20:
+        print(f"  ... {len(errors) - 20} more")
+    # A running bot caches resolved settings for SETTINGS_CACHE_TTL seconds
+    print(f"Running bots apply the changes within {settings_store.SETTINGS_CACHE_TTL:.0f} seconds")
+
+def main():
+    parser = argparse.ArgumentParser(description="Bot database maintenance")
+    commands = parser.add_subparsers(dest='command', required=True)
+    
+    prune = commands.add_parser('prune-history', help=prune_history.__doc__)
+    prune.set_defaults(func=prune_history)
+    
+    restore = commands.add_parser('import-archive', help=import_archive.__doc__)
+    restore.add_argument('paths', nargs='+', help='archive files (*.jsonl.gz)')
+    restore.set_defaults(func=import_archive)
+    
+    rebuild = commands.add_parser('rebuild-search-index', help=rebuild_search.__doc__)
+    rebuild.set_defaults(func=rebuild_search)
+    
+    compress = commands.add_parser('compress-history', help=compress_history.__doc__)
+    compress.add_argument('--batch-size', type=int, default=500, help='messages per transaction')
+    compress.set_defaults(func=compress_history)
+    
+    compact = commands.add_parser('compact-settings', help=compact_settings.__doc__)
+    compact.add_argument('--batch-size', type=int, default=500, help='rows per transaction')
+    compact.set_defaults(func=compact_settings)
+    
+    dump = commands.add_parser('export-settings', help=export_settings.__doc__)
+    dump.add_argument('path', help='output file (*.jsonl or *.jsonl.gz)')
+    dump.add_argument('--batch-size', type=int, default=1000, help='rows fetched at a time')
+    dump.set_defaults(func=export_settings)
+    
+    load = commands.add_parser('import-settings', help=import_settings.__doc__)
+    load.add_argument('path', help='file written by export-settings')
+    load.add_argument('--batch-size', type=int, default=1000, help='users per transaction')
+    load.add_argument('--strict', action='store_true', help='stop at the first invalid line')
+    load.set_defaults(func=import_settings)
+    
+    args = parser.parse_args()
+    args.func(args)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,20 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+# Project modules open the database on import, so point them at a scratch
+# file before any of them is loaded
+_scratch = tempfile.mkdtemp(prefix='bot-tests-')
+os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(_scratch, 'bot.db')}"
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def session_factory(tmp_path, monkeypatch):
+    """A fresh database per test, with the database workers stopped afterwards"""
+    from utils.database import init_db, shutdown_workers
+    monkeypatch.setenv('DATABASE_URL', f"sqlite:///{tmp_path / 'bot.db'}")
+    yield init_db()
+    shutdown_workers()
@@ -0,0 +1,82 @@
+from types import SimpleNamespace
+
+import pytest
+from telegram import Message, Update
+
+from utils.addressing import ADDRESSED_TO_BOT, addressed_text, strip_bot_mention
+from utils.metrics import GROUP_MESSAGES_TOTAL
+
+BOT = SimpleNamespace(username='mybot', id=42)
+
+
+def message(text=None, chat_type='group', entities=(), reply_from=None, caption=None) -> Message:
+    data = {
+        'message_id': 1, 'date': 0,
+        'chat': {'id': -100, 'type': chat_type},
+        'from': {'id': 7, 'is_bot': False, 'first_name': 'Ann'},
+    }
+    key = 'caption' if caption is not None else 'text'
+    data[key] = caption if caption is not None else text
+    if entities:
+        data[f"{key}_entities" if key == 'caption' else 'entities'] = list(entities)
+    if reply_from is not None:
+        data['reply_to_message'] = {
+            'message_id': 0, 'date': 0, 'chat': data['chat'], 'text': 'earlier',
+            'from': {'id': reply_from, 'is_bot': True, 'first_name': 'Bot'},
+        }
+    return Message.de_json(data, BOT)
+
+
+def update(message: Message) -> Update:
+    return Update(update_id=1, message=message)
+
+
+def mention(offset: int, length: int) -> dict:
+    return {'type': 'mention', 'offset': offset, 'length': length}
+
+
+def counted(outcome: str) -> float:
+    return GROUP_MESSAGES_TOTAL.labels(outcome=outcome)._value.get()
+
+
+@pytest.mark.parametrize('text, expected', [
+    ('@mybot hi', 'hi'),
+    ('@mybot', ''),
+    ('@mybot, what time is it?', ', what time is it?'),
+    # Other bots whose names start with ours
+    ('@mybotx hi', None),
+    ('@mybot_helper hi', None),
+    ('hi @mybot', None),
+])
+def test_strip_bot_mention_at_start(text, expected):
+    assert strip_bot_mention(text, None, 'mybot') == expected
+
+
+def test_strip_bot_mention_matches_whole_mention_entities():
+    text = 'hey @mybotx and @mybot please'
+    assert strip_bot_mention(text, [SimpleNamespace(type='mention', offset=4, length=7)], 'mybot') is None
+    entities = [SimpleNamespace(type='mention', offset=4, length=7),
+                SimpleNamespace(type='mention', offset=16, length=6)]
+    assert strip_bot_mention(text, entities, 'mybot') == 'hey @mybotx and  please'
+
+
+def test_addressed_text_for_group_messages():
+    assert addressed_text(message('@mybot hi', entities=[mention(0, 6)]), 'mybot', 42) == 'hi'
+    assert addressed_text(message('@mybotx hi', entities=[mention(0, 7)]), 'mybot', 42) is None
+    assert addressed_text(message('thanks!', reply_from=42), 'mybot', 42) == 'thanks!'
+    assert addressed_text(message('thanks!', reply_from=99), 'mybot', 42) is None
+    assert addressed_text(message(caption='@mybot what is this?'), 'mybot', 42) == 'what is this?'
+    text_mention = {'type': 'text_mention', 'offset': 0, 'length': 3,
+                    'user': {'id': 42, 'is_bot': True, 'first_name': 'Bot'}}
+    assert addressed_text(message('Bot, hello', entities=[text_mention]), 'mybot', 42) == ', hello'
+
+
+def test_filter_passes_private_chats_and_addressed_group_messages():
+    handled, dropped = counted('handled'), counted('dropped')
+    assert ADDRESSED_TO_BOT.check_update(update(message('anything', chat_type='private')))
+    assert ADDRESSED_TO_BOT.check_update(update(message('@mybot hi')))
+    assert not ADDRESSED_TO_BOT.check_update(update(message('@mybotx hi')))
+    assert not ADDRESSED_TO_BOT.check_update(update(message('just chatting')))
+    # Private messages are not counted
+    assert counted('handled') - handled == 1
+    assert counted('dropped') - dropped == 2
@@ -0,0 +1,103 @@
+import io
+import json
+
+import pytest
+
+from utils import bulk_settings
+from utils.bulk_settings import RecordError, export_settings, import_settings, parse_record, read_records
+from utils.database import ImageSettings, User, UserSettings
+
+USERS = [
+    {'telegram_id': 4901, 'username': 'alice', 'first_name': 'Alice',
+     'created_at': '2024-01-02T03:04:05',
+     'settings': {'model': 'gpt-4o', 'temperature': 0.2},
+     'image_settings': {'size': '1792x1024'}},
+    {'telegram_id': 4902, 'first_name': 'Bob', 'created_at': '2024-02-03T04:05:06',
+     'settings': {'use_assistant': True, 'assistant_url': 'https://assistant.example/v1'}},
+    {'telegram_id': 4903, 'created_at': '2024-03-04T05:06:07'},
+]
+
+
+def to_jsonl(records) -> str:
+    return ''.join(json.dumps(record, ensure_ascii=False) + '\n' for record in records)
+
+
+def load(session_factory, data: str, batch_size: int = 2) -> int:
+    errors = []
+    count = import_settings(session_factory, read_records(io.StringIO(data), errors), batch_size)
+    assert errors == []
+    return count
+
+
+def dump(session_factory) -> list:
+    out = io.StringIO()
+    export_settings(session_factory, out, batch_size=2)
+    return [json.loads(line) for line in out.getvalue().splitlines()]
+
+
+def table_sizes(session_factory) -> tuple:
+    with session_factory() as session:
+        return tuple(session.query(model).count() for model in (User, UserSettings, ImageSettings))
+
+
+def test_export_import_round_trip(session_factory):
+    assert load(session_factory, to_jsonl(USERS)) == 3
+    assert dump(session_factory) == USERS
+    assert table_sizes(session_factory) == (3, 2, 1)
+
+
+def test_import_is_idempotent(session_factory):
+    load(session_factory, to_jsonl(USERS))
+    exported = dump(session_factory)
+    load(session_factory, to_jsonl(exported))
+    assert dump(session_factory) == exported
+    assert table_sizes(session_factory) == (3, 2, 1)
+
+
+def test_import_updates_merges_and_resets(session_factory):
+    load(session_factory, to_jsonl(USERS))
+    load(session_factory, to_jsonl([
+        # Profile fields missing from the line keep their stored values
+        {'telegram_id': 4901, 'last_name': 'Liddell', 'settings': {'model': 'gpt-4o-mini'}},
+        # An empty section resets the user to the defaults
+        {'telegram_id': 4902, 'settings': {}},
+    ]))
+    alice, bob, _ = dump(session_factory)
+    assert alice['username'] == 'alice' and alice['last_name'] == 'Liddell'
+    assert alice['settings'] == {'model': 'gpt-4o-mini'}
+    assert alice['image_settings'] == {'size': '1792x1024'}
+    assert 'settings' not in bob
+
+
+def test_values_equal_to_the_defaults_are_not_stored(session_factory):
+    defaults = bulk_settings.DEFAULT_TEXT_SETTINGS
+    load(session_factory, to_jsonl([
+        {'telegram_id': 4904, 'settings': {'model': defaults['model'], 'max_tokens': defaults['max_tokens']}},
+    ]))
+    assert table_sizes(session_factory) == (1, 0, 0)
+
+
+def test_the_last_line_for_a_user_wins(session_factory):
+    load(session_factory, to_jsonl([
+        {'telegram_id': 4905, 'settings': {'model': 'first'}},
+        {'telegram_id': 4905, 'settings': {'model': 'second'}},
+    ]), batch_size=10)
+    assert dump(session_factory)[0]['settings'] == {'model': 'second'}
+
+
+def test_invalid_lines_are_reported_and_skipped():
+    errors = []
+    data = to_jsonl([
+        {'telegram_id': 1},
+        {'telegram_id': 'one'},
+        {'telegram_id': 2, 'settings': {'temperature': 5}},
+        {'telegram_id': 3, 'settings': {'colour': 'red'}},
+    ]) + 'not json\n\n'
+    records = list(read_records(io.StringIO(data), errors))
+    assert [record['telegram_id'] for record in records] == [1]
+    assert [number for number, _ in errors] == [2, 3, 4, 5]
+
+    with pytest.raises(RecordError, match='line 2'):
+        list(read_records(io.StringIO(data), [], strict=True))
+    with pytest.raises(RecordError):
+        parse_record('{"telegram_id": true}')
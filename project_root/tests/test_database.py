@@ -0,0 +1,34 @@
+import pytest
+from sqlalchemy import create_engine, text
+from sqlalchemy.exc import OperationalError
+
+import utils.database  # noqa: F401  registers the query timing listeners
+from utils.metrics import DB_QUERY_SECONDS
+
+
+def histogram(operation: str) -> dict:
+    """Sample values of the query latency histogram for one operation"""
+    samples = {}
+    for metric in DB_QUERY_SECONDS.collect():
+        for sample in metric.samples:
+            if sample.labels.get('operation') == operation:
+                key = sample.name if 'le' not in sample.labels else f"le={sample.labels['le']}"
+                samples[key] = sample.value
+    return samples
+
+
+def test_only_completed_statements_are_timed():
+    engine = create_engine('sqlite://')
+    with engine.connect() as conn:
+        conn.execute(text('SELECT 1'))
+        before = histogram('select')
+        for _ in range(3):
+            with pytest.raises(OperationalError):
+                conn.execute(text('SELECT * FROM missing_table'))
+        assert histogram('select') == before
+
+        conn.execute(text('SELECT 1'))
+        after = histogram('select')
+    assert after['bot_db_query_seconds_count'] == before['bot_db_query_seconds_count'] + 1
+    # Timed from its own start, not from one of the failed statements
+    assert after['le=1.0'] == before['le=1.0'] + 1
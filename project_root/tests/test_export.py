@@ -0,0 +1,77 @@
+import gzip
+import json
+from datetime import datetime, timedelta
+
+import utils.database as database
+import utils.export as export
+from utils.database import Message, User
+from utils.export import build_export
+
+
+def add_user(session_factory, telegram_id: int, contents, cutoff_after: int = 0) -> None:
+    """Store messages a minute apart; the first cutoff_after are cleared"""
+    with session_factory() as session:
+        user = User(telegram_id=telegram_id)
+        session.add(user)
+        session.flush()
+        messages = [
+            Message(user_id=user.id, role='user' if n % 2 == 0 else 'assistant', content=content,
+                    timestamp=datetime(2024, 5, 1) + timedelta(minutes=n))
+            for n, content in enumerate(contents)
+        ]
+        session.add_all(messages)
+        session.flush()
+        if cutoff_after:
+            user.history_cutoff_id = messages[cutoff_after - 1].id
+        session.commit()
+
+
+def read_export(session_factory, telegram_id: int, fmt: str):
+    with session_factory() as session:
+        file, suffix, count = build_export(session, telegram_id, fmt)
+    if file is None:
+        return None, suffix, count
+    with file:
+        data = file.read()
+    if suffix.endswith('.gz'):
+        data = gzip.decompress(data)
+    return data.decode('utf-8'), suffix, count
+
+
+def test_cleared_history_is_left_out(session_factory):
+    add_user(session_factory, 4801, ['old question', 'old answer', 'new question'], cutoff_after=2)
+    text, suffix, count = read_export(session_factory, 4801, 'jsonl')
+    assert (suffix, count) == ('jsonl', 1)
+    assert [json.loads(line)['content'] for line in text.splitlines()] == ['new question']
+
+
+def test_nothing_to_export(session_factory):
+    add_user(session_factory, 4802, ['cleared'], cutoff_after=1)
+    assert read_export(session_factory, 4802, 'md') == (None, 'md', 0)
+    assert read_export(session_factory, 4899, 'jsonl') == (None, 'jsonl', 0)
+
+
+def test_compressed_messages_are_exported_as_text(session_factory, monkeypatch):
+    monkeypatch.setattr(database, 'MESSAGE_COMPRESSION_THRESHOLD', 64)
+    long_answer = 'Длинный ответ с подробностями. ' * 20
+    add_user(session_factory, 4803, ['short question', long_answer])
+    with session_factory() as session:
+        assert session.query(Message).filter(Message._content.is_(None)).count() == 1
+
+    text, _, count = read_export(session_factory, 4803, 'md')
+    assert count == 2
+    assert text.startswith('# История сообщений\n\n')
+    assert '### 01.05.2024 00:00 · Вы\n\nshort question\n\n' in text
+    assert f"### 01.05.2024 00:01 · Бот\n\n{long_answer}\n\n" in text
+
+
+def test_large_exports_are_gzipped_and_streamed_in_batches(session_factory, monkeypatch):
+    monkeypatch.setattr(export, 'EXPORT_GZIP_BYTES', 1024)
+    monkeypatch.setattr(export, 'EXPORT_SPOOL_BYTES', 512)
+    monkeypatch.setattr(export, 'EXPORT_BATCH', 7)
+    contents = [f"message {n} " * 10 for n in range(50)]
+    add_user(session_factory, 4804, contents)
+
+    text, suffix, count = read_export(session_factory, 4804, 'jsonl')
+    assert (suffix, count) == ('jsonl.gz', 50)
+    assert [json.loads(line)['content'] for line in text.splitlines()] == contents
@@ -0,0 +1,139 @@
+import asyncio
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+from handlers import history
+from handlers.history import HistoryHandler, encode_cursor, format_history
+from utils.database import Message, User, run_write
+
+STARTED = datetime(2024, 3, 1, 12, 0)
+
+
+def add_messages(session_factory, telegram_id: int, timestamps) -> list:
+    """Store a message per timestamp in the given order; returns their ids"""
+    with session_factory() as session:
+        user = User(telegram_id=telegram_id)
+        session.add(user)
+        session.flush()
+        messages = [Message(user_id=user.id, role='user', content=f"message {n}", timestamp=timestamp)
+                    for n, timestamp in enumerate(timestamps)]
+        session.add_all(messages)
+        session.commit()
+        return [message.id for message in messages]
+
+
+def walk_pages(handler: HistoryHandler, telegram_id: int, limit: int) -> list:
+    """Page from the newest message to the oldest and back; returns the ids of every page"""
+    async def walk():
+        pages = []
+        messages, has_more = await handler.get_history_page(telegram_id, limit)
+        pages.append([message.id for message in messages])
+        while has_more:
+            messages, has_more = await handler.get_history_page(
+                telegram_id, limit, before=encode_cursor(messages[-1])
+            )
+            pages.append([message.id for message in messages])
+        while True:
+            messages, has_more = await handler.get_history_page(
+                telegram_id, limit, after=encode_cursor(messages[0])
+            )
+            if not messages:
+                break
+            pages.append([message.id for message in messages])
+            if not has_more:
+                break
+        return pages
+    return asyncio.run(walk())
+
+
+def test_pages_cover_every_message_once_across_timestamp_ties(session_factory):
+    # Pairs of messages share a timestamp, and ids do not follow time order
+    timestamps = [STARTED + timedelta(minutes=minute) for minute in (3, 1, 3, 2, 1, 2, 0)]
+    ids = add_messages(session_factory, 4101, timestamps)
+    newest_first = [message_id for _, message_id in sorted(zip(timestamps, ids), reverse=True)]
+
+    pages = walk_pages(HistoryHandler(), 4101, limit=2)
+    older = pages[:4]
+    assert [len(page) for page in older] == [2, 2, 2, 1]
+    assert sum(older, []) == newest_first
+    # Paging back towards the newest returns the same pages, still newest first
+    assert pages[4:] == [older[2], older[1], older[0]]
+
+
+def test_cursor_round_trips_microseconds(session_factory):
+    timestamps = [STARTED + timedelta(microseconds=micros) for micros in (1, 1, 2)]
+    ids = add_messages(session_factory, 4102, timestamps)
+    pages = walk_pages(HistoryHandler(), 4102, limit=1)
+    assert sum(pages[:3], []) == [ids[2], ids[1], ids[0]]
+
+
+def test_format_history_stops_before_the_length_limit():
+    messages = [SimpleNamespace(content='x' * 1000, role='user', timestamp=STARTED) for _ in range(5)]
+    text, shown = format_history(messages, max_length=900)
+    assert len(text) <= 900
+    # Previews are cut, so two fit and the rest are left for the next page
+    assert shown == 2
+    assert text.count('…') == 2
+
+
+def clear(handler: HistoryHandler, telegram_id: int):
+    return asyncio.run(run_write(handler._set_history_cutoff, telegram_id))
+
+
+def visible(handler: HistoryHandler, telegram_id: int) -> list:
+    messages, _ = asyncio.run(handler.get_history_page(telegram_id, limit=100))
+    return [message.content for message in messages]
+
+
+def test_clear_history_hides_messages_at_once(session_factory):
+    handler = HistoryHandler()
+    ids = add_messages(session_factory, 4201, [STARTED + timedelta(minutes=n) for n in range(3)])
+
+    user_db_id, cutoff_id, total = clear(handler, 4201)
+    assert (cutoff_id, total) == (ids[-1], 3)
+    assert visible(handler, 4201) == []
+
+    asyncio.run(handler.save_message(4201, 'after clearing'))
+    assert visible(handler, 4201) == ['after clearing']
+    # Nothing new to clear
+    assert clear(handler, 4201)[2] == 1
+    assert clear(handler, 4201) is None
+
+
+def test_purge_deletes_in_batches_and_lifts_the_cutoff(session_factory, monkeypatch):
+    monkeypatch.setattr(history, 'HISTORY_DELETE_BATCH', 2)
+    monkeypatch.setattr(history, 'HISTORY_DELETE_PAUSE', 0)
+    handler = HistoryHandler()
+    add_messages(session_factory, 4202, [STARTED + timedelta(minutes=n) for n in range(5)])
+    user_db_id, cutoff_id, _ = clear(handler, 4202)
+    asyncio.run(handler.save_message(4202, 'kept'))
+
+    batches = []
+    delete_batch = handler._delete_history_batch
+
+    def counting_delete(session, *args):
+        batches.append(delete_batch(session, *args))
+        return batches[-1]
+
+    monkeypatch.setattr(handler, '_delete_history_batch', counting_delete)
+    asyncio.run(handler._purge_history(None, user_db_id, cutoff_id))
+
+    assert batches == [2, 2, 1]
+    with session_factory() as session:
+        assert session.get(User, user_db_id).history_cutoff_id is None
+        assert [message.content for message in session.query(Message).filter_by(user_id=user_db_id)] == ['kept']
+    assert visible(handler, 4202) == ['kept']
+
+
+def test_purge_keeps_a_newer_cutoff(session_factory, monkeypatch):
+    monkeypatch.setattr(history, 'HISTORY_DELETE_PAUSE', 0)
+    handler = HistoryHandler()
+    add_messages(session_factory, 4203, [STARTED, STARTED + timedelta(minutes=1)])
+    user_db_id, first_cutoff, _ = clear(handler, 4203)
+    asyncio.run(handler.save_message(4203, 'cleared again'))
+    _, second_cutoff, _ = clear(handler, 4203)
+
+    asyncio.run(handler._purge_history(None, user_db_id, first_cutoff))
+    with session_factory() as session:
+        assert session.get(User, user_db_id).history_cutoff_id == second_cutoff
+    assert visible(handler, 4203) == []
@@ -0,0 +1,40 @@
+import logging
+
+from utils import logging_config
+
+
+def test_set_debug_mode_switches_every_project_logger():
+    registered = logging_config.setup_logging('handlers.example')
+    plain = logging.getLogger('handlers.plain_example')
+    third_party = logging.getLogger('httpx_example')
+    enabled = logging_config.is_debug_mode()
+    try:
+        logging_config.set_debug_mode(True)
+        assert registered.level == plain.level == logging.DEBUG
+        assert third_party.level == logging.NOTSET
+
+        logging_config.set_debug_mode(False)
+        assert registered.level == plain.level == logging.INFO
+    finally:
+        logging_config.set_debug_mode(enabled)
+
+
+def test_tracing_enables_debug_only_for_project_loggers():
+    project = logging_config.setup_logging('handlers.traced_example')
+    third_party = logging.getLogger('httpx_traced_example')
+    third_party.setLevel(logging.WARNING)
+    token = logging_config._trace_active.set(True)
+    try:
+        assert project.isEnabledFor(logging.DEBUG)
+        assert not third_party.isEnabledFor(logging.DEBUG)
+
+        project.disabled = True
+        assert not project.isEnabledFor(logging.ERROR)
+        project.disabled = False
+
+        logging.disable(logging.CRITICAL)
+        assert not project.isEnabledFor(logging.DEBUG)
+    finally:
+        logging.disable(logging.NOTSET)
+        logging_config._trace_active.reset(token)
+    assert not project.isEnabledFor(logging.DEBUG) or logging_config.is_debug_mode()
@@ -0,0 +1,124 @@
+import asyncio
+
+import pytest
+
+from handlers.chat import ChatHandler
+from utils.providers import ProviderEndpoint, ProviderRouter
+from utils.resilience import CircuitOpenError
+
+POOL_MODEL = 'gpt-4o-mini'
+
+
+def make_router(*base_urls) -> ProviderRouter:
+    return ProviderRouter({POOL_MODEL: [ProviderEndpoint(base_url=url) for url in base_urls]}, alpha=0.5)
+
+
+def urls(endpoints) -> list:
+    return [endpoint.base_url for endpoint in endpoints]
+
+
+def test_models_without_a_pool_use_the_users_endpoint():
+    router = make_router('https://a.example/v1')
+    assert urls(router.candidates('other-model', 'https://mine.example/v1')) == ['https://mine.example/v1']
+
+
+def test_candidates_are_ordered_by_latency():
+    router = make_router('https://a.example/v1', 'https://b.example/v1')
+    slow, fast = router.pools[POOL_MODEL]
+    router.record_success(slow, 2.0)
+    router.record_success(fast, 0.3)
+    assert urls(router.candidates(POOL_MODEL, 'https://a.example/v1')) == [
+        'https://b.example/v1', 'https://a.example/v1'
+    ]
+
+
+def test_errors_push_an_endpoint_down_and_the_users_endpoint_competes():
+    router = make_router('https://a.example/v1', 'https://b.example/v1')
+    first, second = router.pools[POOL_MODEL]
+    router.record_success(first, 0.2)
+    router.record_success(second, 0.5)
+    router.record_failure(first)
+    candidates = router.candidates(POOL_MODEL, 'https://mine.example/v1')
+    # The user's endpoint has no samples yet, so it is tried first
+    assert urls(candidates) == ['https://mine.example/v1', 'https://b.example/v1', 'https://a.example/v1']
+
+
+def test_from_env_reads_pools(monkeypatch):
+    monkeypatch.setenv('PROVIDER_POOLS', '{"m": [{"base_url": "https://a.example/v1", "model": "vendor/m"}]}')
+    monkeypatch.delenv('PROVIDER_POOLS_FILE', raising=False)
+    router = ProviderRouter.from_env()
+    assert [(e.base_url, e.model) for e in router.pools['m']] == [('https://a.example/v1', 'vendor/m')]
+
+    monkeypatch.setenv('PROVIDER_POOLS', 'not json')
+    assert ProviderRouter.from_env().pools == {}
+
+
+class FakeUpstream:
+    """Streams chunks per base_url, or raises the configured error before the first one"""
+
+    def __init__(self, behaviour):
+        self.behaviour = behaviour
+        self.attempts = []
+
+    def client(self, base_url, api_key=None):
+        return None
+
+    async def stream(self, base_url, create, max_retries=None):
+        self.attempts.append(base_url)
+        outcome = self.behaviour[base_url]
+        if isinstance(outcome, BaseException):
+            raise outcome
+        for chunk in outcome:
+            yield chunk
+
+
+def collect(handler: ChatHandler) -> list:
+    async def run():
+        settings = {'model': POOL_MODEL, 'base_url': 'https://a.example/v1'}
+        return [chunk async for chunk in handler._completion_chunks(settings, 'hi')]
+    return asyncio.run(run())
+
+
+def test_failover_to_the_next_endpoint_before_the_first_token():
+    handler = ChatHandler(history_handler=None)
+    handler.router = make_router('https://a.example/v1', 'https://b.example/v1')
+    handler.upstream = FakeUpstream({
+        'https://a.example/v1': asyncio.TimeoutError(),
+        'https://b.example/v1': ['Hel', 'lo'],
+    })
+
+    assert collect(handler) == ['Hel', 'lo']
+    assert handler.upstream.attempts == ['https://a.example/v1', 'https://b.example/v1']
+    failed, served = handler.router.pools[POOL_MODEL]
+    assert failed.error_ewma > 0 and served.ttft_ewma is not None
+    # The failed endpoint is now tried last
+    assert urls(handler.router.candidates(POOL_MODEL, 'https://a.example/v1'))[0] == 'https://b.example/v1'
+
+
+def test_open_circuit_fails_over_without_counting_an_error():
+    handler = ChatHandler(history_handler=None)
+    handler.router = make_router('https://a.example/v1', 'https://b.example/v1')
+    handler.upstream = FakeUpstream({
+        'https://a.example/v1': CircuitOpenError('https://a.example/v1', 10),
+        'https://b.example/v1': ['ok'],
+    })
+
+    assert collect(handler) == ['ok']
+    assert handler.router.pools[POOL_MODEL][0].error_ewma == 0
+
+
+def test_non_retryable_errors_and_the_last_endpoint_failure_propagate():
+    handler = ChatHandler(history_handler=None)
+    handler.router = make_router('https://a.example/v1', 'https://b.example/v1')
+    handler.upstream = FakeUpstream({'https://a.example/v1': ValueError('bad request')})
+    with pytest.raises(ValueError):
+        collect(handler)
+    assert handler.upstream.attempts == ['https://a.example/v1']
+
+    handler.router = make_router('https://a.example/v1', 'https://b.example/v1')
+    handler.upstream = FakeUpstream({
+        'https://a.example/v1': asyncio.TimeoutError(),
+        'https://b.example/v1': asyncio.TimeoutError(),
+    })
+    with pytest.raises(asyncio.TimeoutError):
+        collect(handler)
@@ -0,0 +1,50 @@
+import asyncio
+
+import pytest
+
+from utils.resilience import CircuitBreaker, UpstreamResilience
+
+
+def half_open(resilience: UpstreamResilience, base_url: str) -> CircuitBreaker:
+    breaker = resilience.breaker(base_url)
+    breaker.reset_timeout = 0
+    for _ in range(breaker.failure_threshold):
+        breaker.record_failure()
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    return breaker
+
+
+async def cancel_probe(resilience: UpstreamResilience, base_url: str, start_call):
+    task = asyncio.ensure_future(start_call())
+    await asyncio.sleep(0.01)
+    task.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await task
+
+
+def test_cancelled_call_releases_half_open_probe():
+    resilience = UpstreamResilience()
+    base_url = 'https://upstream.example/v1'
+    breaker = half_open(resilience, base_url)
+
+    async def hang():
+        await asyncio.Event().wait()
+
+    asyncio.run(cancel_probe(resilience, base_url, lambda: resilience.call(base_url, hang)))
+    assert breaker.allow_request()
+
+
+def test_cancelled_stream_releases_half_open_probe():
+    resilience = UpstreamResilience()
+    base_url = 'https://upstream.example/v1'
+    breaker = half_open(resilience, base_url)
+
+    async def hang():
+        await asyncio.Event().wait()
+
+    async def consume():
+        async for _ in resilience.stream(base_url, hang):
+            pass
+
+    asyncio.run(cancel_probe(resilience, base_url, consume))
+    assert breaker.allow_request()
@@ -0,0 +1,95 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import pytest
+
+from utils import retention
+from utils.database import Message, User
+from utils.search import search_messages
+
+
+@pytest.fixture
+def archive_dir(tmp_path, monkeypatch):
+    path = tmp_path / 'archive'
+    monkeypatch.setattr(retention, 'HISTORY_MAX_AGE_DAYS', 0)
+    monkeypatch.setattr(retention, 'HISTORY_MAX_ROWS_PER_USER', 3)
+    monkeypatch.setattr(retention, 'HISTORY_ARCHIVE_DIR', str(path))
+    monkeypatch.setattr(retention, 'HISTORY_PRUNE_BATCH', 2)
+    monkeypatch.setattr(retention, 'HISTORY_PRUNE_PAUSE', 0)
+    return path
+
+
+def add_history(session_factory, telegram_id: int, contents) -> int:
+    """Store one message per content, a minute apart; returns the user's row id"""
+    started = datetime(2024, 1, 1)
+    with session_factory() as session:
+        user = User(telegram_id=telegram_id)
+        session.add(user)
+        session.flush()
+        for minute, content in enumerate(contents):
+            session.add(Message(user_id=user.id, role='user', content=content,
+                                timestamp=started + timedelta(minutes=minute)))
+        session.commit()
+        return user.id
+
+
+def stored_contents(session_factory, user_db_id: int) -> list:
+    with session_factory() as session:
+        messages = session.query(Message).filter_by(user_id=user_db_id)\
+            .order_by(Message.timestamp, Message.id).all()
+        return [message.content for message in messages]
+
+
+def archives(archive_dir) -> list:
+    return sorted(str(path) for path in (archive_dir / 'messages').glob('*.jsonl.gz'))
+
+
+def test_prune_keeps_the_newest_rows_and_archives_the_rest(session_factory, archive_dir):
+    user_db_id = add_history(session_factory, 4301, [f"message {n}" for n in range(7)])
+
+    assert asyncio.run(retention.prune_history()) == 4
+    assert stored_contents(session_factory, user_db_id) == ["message 4", "message 5", "message 6"]
+    archived = [record['content'] for path in archives(archive_dir) for record in retention.read_archive(path)]
+    assert archived == [f"message {n}" for n in range(4)]
+
+
+def test_reimport_is_idempotent_when_ids_were_reassigned(session_factory, archive_dir):
+    user_db_id = add_history(session_factory, 4302, [f"message {n}" for n in range(5)])
+    asyncio.run(retention.prune_history())
+    paths = archives(archive_dir)
+
+    # The pruned ids get reused by other rows, so the import assigns new ones
+    with session_factory() as session:
+        for record in (record for path in paths for record in retention.read_archive(path)):
+            session.add(Message(id=record['id'], user_id=user_db_id, role='assistant',
+                                content='reply', timestamp=datetime(2025, 1, 1)))
+        session.commit()
+
+    assert retention.import_archive(session_factory, paths) == (2, 0, 0)
+    assert retention.import_archive(session_factory, paths) == (0, 2, 0)
+    assert stored_contents(session_factory, user_db_id).count("message 0") == 1
+
+
+def test_import_does_not_restore_cleared_history(session_factory, archive_dir):
+    user_db_id = add_history(session_factory, 4303, [f"message {n}" for n in range(5)])
+    asyncio.run(retention.prune_history())
+    # The user clears their history after it was archived
+    with session_factory() as session:
+        user = session.get(User, user_db_id)
+        user.history_cutoff_id = session.query(Message.id).filter_by(user_id=user_db_id)\
+            .order_by(Message.id.desc()).limit(1).scalar()
+        session.commit()
+
+    assert retention.import_archive(session_factory, archives(archive_dir)) == (0, 0, 2)
+
+
+def test_pruned_history_is_searchable_after_import(session_factory, archive_dir):
+    add_history(session_factory, 4401, ["starting the quarterly report"] + [f"message {n}" for n in range(4)])
+    asyncio.run(retention.prune_history())
+    with session_factory() as session:
+        assert search_messages(session, 4401, "quarterly")[0] == []
+
+    retention.import_archive(session_factory, archives(archive_dir))
+    with session_factory() as session:
+        results, _ = search_messages(session, 4401, "quarterly")
+    assert len(results) == 1 and "quarterly" in results[0].snippet
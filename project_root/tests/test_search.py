@@ -0,0 +1,75 @@
+from sqlalchemy import inspect, text
+
+import utils.database as database
+from utils.database import Message, User
+from utils.search import SNIPPET_END, SNIPPET_START, index_message, make_snippet, search_messages
+
+
+def save(session, telegram_id: int, contents) -> list:
+    user = session.query(User).filter_by(telegram_id=telegram_id).first()
+    if user is None:
+        user = User(telegram_id=telegram_id)
+        session.add(user)
+        session.flush()
+    messages = []
+    for content in contents:
+        message = Message(user_id=user.id, role='user', content=content)
+        session.add(message)
+        session.flush()
+        index_message(session, message.id, user.id, content)
+        messages.append(message)
+    session.commit()
+    return messages
+
+
+def check_index(session):
+    # Raises if the contentless index was given text it did not hold
+    session.execute(text("INSERT INTO message_search (message_search, rank) VALUES ('integrity-check', 0)"))
+
+
+def test_index_keeps_no_copy_of_the_text(session_factory):
+    with session_factory() as session:
+        tables = inspect(session.get_bind()).get_table_names()
+    assert 'message_search' in tables
+    assert 'message_search_content' not in tables
+
+
+def test_snippets_come_from_compressed_messages(session_factory, monkeypatch):
+    monkeypatch.setattr(database, 'MESSAGE_COMPRESSION_THRESHOLD', 64)
+    long_answer = 'Отчёт за квартал. ' + 'Подробности по продажам. ' * 20 + 'Итог: рост выручки.'
+    with session_factory() as session:
+        message, = save(session, 4501, [long_answer])
+        assert message.content_format == database.COMPRESSION_FORMAT_ZLIB
+        results, has_more = search_messages(session, 4501, 'выручки')
+    assert not has_more
+    assert [result.message_id for result in results] == [message.id]
+    assert f"{SNIPPET_START}выручки{SNIPPET_END}" in results[0].snippet
+
+
+def test_deleted_messages_leave_the_index(session_factory, monkeypatch):
+    monkeypatch.setattr(database, 'MESSAGE_COMPRESSION_THRESHOLD', 64)
+    with session_factory() as session:
+        plain, compressed = save(session, 4502, ['short note about invoices', 'invoices ' * 40])
+        # Never indexed, e.g. written by an older version
+        unindexed = Message(user_id=plain.user_id, role='user', content='invoices by hand')
+        session.add(unindexed)
+        session.commit()
+
+        session.query(Message).filter(Message.id.in_([plain.id, compressed.id, unindexed.id]))\
+            .delete(synchronize_session=False)
+        session.commit()
+        check_index(session)
+        assert search_messages(session, 4502, 'invoices') == ([], False)
+
+
+def test_make_snippet_marks_words_and_prefixes():
+    assert make_snippet('Café crème brûlée', 'cafe') == f"{SNIPPET_START}Café{SNIPPET_END} crème brûlée"
+    assert make_snippet('hello world', 'wor') == f"hello {SNIPPET_START}world{SNIPPET_END}"
+    # A match inside a word's prefix counts only for the last query word
+    assert make_snippet('worldwide', 'wor hello') == 'worldwide'
+
+
+def test_make_snippet_shows_a_window_around_the_first_match():
+    content = ' '.join(f"w{n}" for n in range(40)) + ' target ' + ' '.join(f"v{n}" for n in range(40))
+    snippet = make_snippet(content, 'target', size=5)
+    assert snippet == f"…w38 w39 {SNIPPET_START}target{SNIPPET_END} v0 v1…"
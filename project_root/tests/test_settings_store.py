@@ -0,0 +1,88 @@
+import asyncio
+
+import pytest
+
+from utils.database import User, UserSettings
+from utils.settings_store import DEFAULT_TEXT_SETTINGS, SettingsStore
+
+
+@pytest.fixture
+def store(session_factory):
+    return SettingsStore(UserSettings, DEFAULT_TEXT_SETTINGS, cache_size=2, cache_ttl=60)
+
+
+def stored_rows(session_factory) -> list:
+    with session_factory() as session:
+        return [
+            {field: getattr(row, field) for field in DEFAULT_TEXT_SETTINGS}
+            for row in session.query(UserSettings).order_by(UserSettings.id)
+        ]
+
+
+def test_reading_settings_writes_nothing(store, session_factory):
+    assert asyncio.run(store.get(4701)) == DEFAULT_TEXT_SETTINGS
+    assert stored_rows(session_factory) == []
+
+
+def test_only_overrides_are_stored(store, session_factory):
+    settings = asyncio.run(store.update(4702, model='gpt-4o', temperature=DEFAULT_TEXT_SETTINGS['temperature']))
+    assert settings == {**DEFAULT_TEXT_SETTINGS, 'model': 'gpt-4o'}
+    row, = stored_rows(session_factory)
+    assert row['model'] == 'gpt-4o'
+    assert row['temperature'] is None
+    assert asyncio.run(store.get_overrides(4702)) == {'model': 'gpt-4o'}
+
+
+def test_resetting_the_last_override_deletes_the_row(store, session_factory):
+    asyncio.run(store.update(4703, max_tokens=42))
+    assert asyncio.run(store.update(4703, max_tokens=DEFAULT_TEXT_SETTINGS['max_tokens'])) == DEFAULT_TEXT_SETTINGS
+    assert stored_rows(session_factory) == []
+
+    asyncio.run(store.update(4703, model='gpt-4o', max_tokens=42))
+    assert asyncio.run(store.reset(4703)) == DEFAULT_TEXT_SETTINGS
+    assert stored_rows(session_factory) == []
+
+
+def test_unknown_settings_are_rejected(store):
+    with pytest.raises(ValueError):
+        asyncio.run(store.update(4704, colour='red'))
+
+
+def test_returned_settings_are_copies(store):
+    settings = asyncio.run(store.get(4705))
+    settings['model'] = 'changed by caller'
+    assert asyncio.run(store.get(4705))['model'] == DEFAULT_TEXT_SETTINGS['model']
+
+
+def test_cache_is_bounded_and_expires(store, monkeypatch):
+    for telegram_id in (4706, 4707, 4708):
+        asyncio.run(store.get(telegram_id))
+    assert list(store._cache) == [4707, 4708]
+
+    loads = []
+    load_overrides = store._load_overrides
+
+    def counting_load(session, telegram_id):
+        loads.append(telegram_id)
+        return load_overrides(session, telegram_id)
+
+    monkeypatch.setattr(store, '_load_overrides', counting_load)
+    asyncio.run(store.get(4708))
+    assert loads == []
+    store.cache_ttl = 0
+    asyncio.run(store.get(4708))
+    assert loads == [4708]
+
+
+def test_compact_clears_stored_defaults(store, session_factory):
+    with session_factory() as session:
+        users = [User(telegram_id=telegram_id) for telegram_id in (4709, 4710)]
+        session.add_all(users)
+        session.flush()
+        # Rows written when every value was stored
+        session.add(UserSettings(user_id=users[0].id, **DEFAULT_TEXT_SETTINGS))
+        session.add(UserSettings(user_id=users[1].id, **{**DEFAULT_TEXT_SETTINGS, 'model': 'gpt-4o'}))
+        session.commit()
+
+    assert store.compact(session_factory, batch_size=1) == (1, 1)
+    assert stored_rows(session_factory) == [{**{field: None for field in DEFAULT_TEXT_SETTINGS}, 'model': 'gpt-4o'}]
@@ -0,0 +1,123 @@
+import asyncio
+
+import pytest
+
+from utils.singleflight import SingleFlight, normalize_prompt
+
+
+def test_normalize_prompt_collapses_whitespace():
+    assert normalize_prompt("  what   is\nlife ") == "what is life"
+    assert normalize_prompt(None) == ""
+
+
+def test_concurrent_calls_share_one_upstream_call():
+    async def scenario():
+        flight = SingleFlight()
+        calls = 0
+        release = asyncio.Event()
+
+        async def upstream():
+            nonlocal calls
+            calls += 1
+            await release.wait()
+            return 'answer'
+
+        tasks = [asyncio.ensure_future(flight.do('key', upstream)) for _ in range(3)]
+        await asyncio.sleep(0)
+        assert flight.in_flight() == 1
+        release.set()
+        results = await asyncio.gather(*tasks)
+        return calls, results, flight.in_flight()
+
+    calls, results, in_flight = asyncio.run(scenario())
+    assert calls == 1
+    assert sorted(results, key=lambda result: result[1]) == [
+        ('answer', False), ('answer', True), ('answer', True)
+    ]
+    assert in_flight == 0
+
+
+def test_different_keys_do_not_share():
+    async def scenario():
+        flight = SingleFlight()
+
+        async def upstream(value):
+            await asyncio.sleep(0)
+            return value
+
+        return await asyncio.gather(
+            flight.do('a', lambda: upstream(1)),
+            flight.do('b', lambda: upstream(2)),
+        )
+
+    assert asyncio.run(scenario()) == [(1, False), (2, False)]
+
+
+def test_leader_error_reaches_followers_and_the_key_is_released():
+    async def scenario():
+        flight = SingleFlight()
+
+        async def failing():
+            await asyncio.sleep(0.01)
+            raise ValueError('upstream failed')
+
+        results = await asyncio.gather(
+            flight.do('key', failing), flight.do('key', failing), return_exceptions=True
+        )
+        retried = await flight.do('key', lambda: asyncio.sleep(0, result='ok'))
+        return results, retried
+
+    results, retried = asyncio.run(scenario())
+    assert all(isinstance(result, ValueError) for result in results)
+    assert retried == ('ok', False)
+
+
+def test_cancelled_follower_leaves_the_leader_running():
+    async def scenario():
+        flight = SingleFlight()
+        release = asyncio.Event()
+
+        async def upstream():
+            await release.wait()
+            return 'answer'
+
+        leader = asyncio.ensure_future(flight.do('key', upstream))
+        await asyncio.sleep(0)
+        follower = asyncio.ensure_future(flight.do('key', upstream))
+        await asyncio.sleep(0)
+        follower.cancel()
+        release.set()
+        with pytest.raises(asyncio.CancelledError):
+            await follower
+        return await leader
+
+    assert asyncio.run(scenario()) == ('answer', False)
+
+
+def test_followers_take_over_when_the_leader_is_cancelled():
+    async def scenario():
+        flight = SingleFlight()
+        calls = 0
+
+        async def upstream():
+            nonlocal calls
+            calls += 1
+            if calls == 1:
+                await asyncio.Event().wait()
+            await asyncio.sleep(0.01)
+            return 'answer'
+
+        leader = asyncio.ensure_future(flight.do('key', upstream))
+        await asyncio.sleep(0)
+        followers = [asyncio.ensure_future(flight.do('key', upstream)) for _ in range(2)]
+        await asyncio.sleep(0)
+        leader.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await leader
+        results = await asyncio.gather(*followers)
+        return calls, results
+
+    calls, results = asyncio.run(scenario())
+    # One follower runs the call again, the other shares its result
+    assert calls == 2
+    assert sorted(results, key=lambda result: result[1]) == [('answer', False), ('answer', True)]
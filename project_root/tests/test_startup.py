@@ -0,0 +1,17 @@
+import os
+
+from benchmarks.bench_startup import LAZY_MODULES, import_profile
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_bot_import_stays_within_budget_and_lazy(monkeypatch):
+    # import_profile puts the working directory on PYTHONPATH of the fresh interpreter
+    monkeypatch.chdir(PROJECT_ROOT)
+    profile = import_profile('bot')
+
+    eager = {name.split('.')[0] for name in profile} & set(LAZY_MODULES)
+    assert not eager, f"imported at startup but should be lazy: {sorted(eager)}"
+
+    budget_ms = float(os.getenv('STARTUP_IMPORT_BUDGET_MS', '2000'))
+    assert profile['bot'][1] / 1000 <= budget_ms
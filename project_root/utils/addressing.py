@@ -0,0 +1,73 @@
+from typing import Optional
+from telegram import Message
+from telegram.ext.filters import MessageFilter
+from utils.metrics import GROUP_MESSAGES_TOTAL
+
+# Chats where every message is meant for the bot
+DIRECT_CHAT_TYPES = ('private', 'channel')
+
+
+def strip_bot_mention(message_text: str, entities, bot_username: str) -> Optional[str]:
+    """Return a group message's text without the bot mention, or None if the bot is not mentioned"""
+    mention = f"@{bot_username}"
+
+    # Check for direct mention at start; "@botname_other" is another user
+    if message_text.startswith(mention) and not _continues_username(message_text, len(mention)):
+        return message_text[len(mention):].strip()
+
+    # Check for mentions in entities, which cover the whole username
+    for entity in entities or ():
+        if entity.type == "mention":
+            end = entity.offset + entity.length
+            if message_text[entity.offset:end] == mention:
+                return (message_text[:entity.offset] + message_text[end:]).strip()
+    return None
+
+
+def _continues_username(text: str, position: int) -> bool:
+    """Whether text[position] could be part of a Telegram username"""
+    return position < len(text) and (text[position].isalnum() or text[position] == '_')
+
+
+def addressed_text(message, bot_username: str, bot_id: int) -> Optional[str]:
+    """Text of a group message addressed to the bot, without the mention; None if not addressed.
+
+    A message is addressed to the bot when it mentions @bot_username (at
+    the start or anywhere as a mention entity), mentions the bot by
+    text_mention, or replies to one of the bot's messages. Photo captions
+    count as the message text.
+    """
+    text = message.text or message.caption or ""
+    entities = message.entities or message.caption_entities
+    stripped = strip_bot_mention(text, entities, bot_username)
+    if stripped is not None:
+        return stripped
+    for entity in entities or ():
+        if entity.type == "text_mention" and entity.user and entity.user.id == bot_id:
+            return (text[:entity.offset] + text[entity.offset + entity.length:]).strip()
+    reply = message.reply_to_message
+    if reply is not None and reply.from_user is not None and reply.from_user.id == bot_id:
+        return text.strip()
+    return None
+
+
+class AddressedToBot(MessageFilter):
+    """Pass private messages and group messages addressed to the bot.
+
+    Runs while PTB matches handlers, so unaddressed group chatter never
+    reaches the handler callback. Group messages are counted as handled or
+    dropped in bot_group_messages_total.
+    """
+
+    __slots__ = ()
+
+    def filter(self, message: Message) -> bool:
+        if message.chat.type in DIRECT_CHAT_TYPES:
+            return True
+        bot = message.get_bot()
+        addressed = addressed_text(message, bot.username, bot.id) is not None
+        GROUP_MESSAGES_TOTAL.labels(outcome='handled' if addressed else 'dropped').inc()
+        return addressed
+
+
+ADDRESSED_TO_BOT = AddressedToBot(name='AddressedToBot')
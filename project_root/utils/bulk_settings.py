@@ -0,0 +1,239 @@
+import gzip
+import json
+from datetime import datetime
+from typing import IO, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+from sqlalchemy import func, select, update
+from sqlalchemy.dialects import postgresql, sqlite
+from utils.database import ImageSettings, User, UserSettings
+from utils.helpers import validate_max_tokens, validate_model_name, validate_temperature, validate_url
+from utils.settings_store import DEFAULT_IMAGE_SETTINGS, DEFAULT_TEXT_SETTINGS
+
+# One JSON object per user, keyed by telegram_id since row ids differ between
+# deployments:
+#   {"telegram_id": 1, "username": ..., "first_name": ..., "last_name": ...,
+#    "created_at": ..., "settings": {...}, "image_settings": {...}}
+# Settings hold only the user's overrides. On import a missing section is
+# left alone and an empty one resets the user to the defaults.
+PROFILE_FIELDS = ('username', 'first_name', 'last_name')
+SECTIONS = {
+    'settings': (UserSettings, DEFAULT_TEXT_SETTINGS),
+    'image_settings': (ImageSettings, DEFAULT_IMAGE_SETTINGS),
+}
+
+
+def _non_empty_string(value) -> bool:
+    return isinstance(value, str) and bool(value.strip())
+
+
+def _is_bool(value) -> bool:
+    return isinstance(value, bool)
+
+
+VALIDATORS: Dict[str, Dict[str, Callable]] = {
+    'settings': {
+        'base_url': validate_url,
+        'model': validate_model_name,
+        'temperature': lambda value: not isinstance(value, bool) and validate_temperature(value),
+        'max_tokens': lambda value: not isinstance(value, bool) and validate_max_tokens(value),
+        'assistant_url': validate_url,
+        'use_assistant': _is_bool,
+    },
+    'image_settings': {
+        'base_url': validate_url,
+        'model': validate_model_name,
+        'size': _non_empty_string,
+        'quality': _non_empty_string,
+        'style': _non_empty_string,
+        'hdr': _is_bool,
+    },
+}
+
+
+class RecordError(ValueError):
+    """A line of the import file that cannot be applied"""
+
+
+def open_stream(path: str, mode: str) -> IO[str]:
+    """Open a JSONL file for text I/O; *.gz is gzipped"""
+    if path.endswith('.gz'):
+        return gzip.open(path, mode + 't', encoding='utf-8', newline='\n')
+    return open(path, mode, encoding='utf-8', newline='\n')
+
+
+def export_settings(session_factory, out: IO[str], batch_size: int = 1000) -> int:
+    """Write every user with their settings overrides as JSONL; returns the user count"""
+    text_fields = tuple(DEFAULT_TEXT_SETTINGS)
+    image_fields = tuple(DEFAULT_IMAGE_SETTINGS)
+    text_columns = [getattr(UserSettings, field).label(f"s_{field}") for field in text_fields]
+    image_columns = [getattr(ImageSettings, field).label(f"i_{field}") for field in image_fields]
+    statement = select(
+        User.telegram_id, User.username, User.first_name, User.last_name, User.created_at,
+        UserSettings.id.label('s_id'), *text_columns,
+        ImageSettings.id.label('i_id'), *image_columns,
+    )\
+        .outerjoin(UserSettings, UserSettings.user_id == User.id)\
+        .outerjoin(ImageSettings, ImageSettings.user_id == User.id)\
+        .where(User.telegram_id.isnot(None))\
+        .order_by(User.id)\
+        .execution_options(yield_per=batch_size)
+
+    count = 0
+    with session_factory() as session:
+        for row in session.execute(statement).mappings():
+            record = {'telegram_id': row['telegram_id']}
+            record.update((field, row[field]) for field in PROFILE_FIELDS if row[field] is not None)
+            if row['created_at'] is not None:
+                record['created_at'] = row['created_at'].isoformat()
+            if row['s_id'] is not None:
+                record['settings'] = {
+                    field: row[f"s_{field}"] for field in text_fields if row[f"s_{field}"] is not None
+                }
+            if row['i_id'] is not None:
+                record['image_settings'] = {
+                    field: row[f"i_{field}"] for field in image_fields if row[f"i_{field}"] is not None
+                }
+            out.write(json.dumps(record, ensure_ascii=False) + '\n')
+            count += 1
+    out.flush()
+    return count
+
+
+def parse_record(line: str) -> dict:
+    """Parse and validate one line; raises RecordError"""
+    try:
+        record = json.loads(line)
+    except json.JSONDecodeError as e:
+        raise RecordError(f"invalid JSON: {e}")
+    if not isinstance(record, dict):
+        raise RecordError("expected a JSON object")
+    telegram_id = record.get('telegram_id')
+    if not isinstance(telegram_id, int) or isinstance(telegram_id, bool):
+        raise RecordError("telegram_id must be an integer")
+    for field in PROFILE_FIELDS:
+        if record.get(field) is not None and not isinstance(record[field], str):
+            raise RecordError(f"{field} must be a string")
+    if record.get('created_at') is not None:
+        try:
+            record['created_at'] = datetime.fromisoformat(record['created_at'])
+        except (TypeError, ValueError):
+            raise RecordError("created_at must be an ISO 8601 timestamp")
+    for section, validators in VALIDATORS.items():
+        values = record.get(section)
+        if values is None:
+            continue
+        if not isinstance(values, dict):
+            raise RecordError(f"{section} must be an object")
+        unknown = set(values) - set(validators)
+        if unknown:
+            raise RecordError(f"{section}: unknown settings {', '.join(sorted(unknown))}")
+        for field, value in values.items():
+            if value is not None and not validators[field](value):
+                raise RecordError(f"{section}.{field}: invalid value {value!r}")
+    return record
+
+
+def read_records(stream: IO[str], errors: List[Tuple[int, str]], strict: bool = False) -> Iterator[dict]:
+    """Yield valid records; invalid lines are collected in errors as (line number, reason)"""
+    for number, line in enumerate(stream, 1):
+        if not line.strip():
+            continue
+        try:
+            yield parse_record(line)
+        except RecordError as e:
+            if strict:
+                raise RecordError(f"line {number}: {e}")
+            errors.append((number, str(e)))
+
+
+def _insert(dialect: str, table):
+    if dialect == 'sqlite':
+        return sqlite.insert(table)
+    if dialect == 'postgresql':
+        return postgresql.insert(table)
+    return None
+
+
+def _upsert(session, table, rows: List[dict], key: str, columns: Iterable[str], keep_existing: bool = False):
+    """Insert rows, updating columns of rows whose key already exists.
+
+    With keep_existing a NULL in the incoming row keeps the stored value.
+    """
+    if not rows:
+        return
+    columns = list(columns)
+    insert = _insert(session.get_bind().dialect.name, table)
+    if insert is not None:
+        excluded = insert.excluded
+        values = {
+            column: func.coalesce(excluded[column], table.c[column]) if keep_existing else excluded[column]
+            for column in columns
+        }
+        session.execute(insert.on_conflict_do_update(index_elements=[key], set_=values), rows)
+        return
+    # Other databases: update, then insert what was not there
+    existing = set(session.scalars(select(table.c[key]).where(table.c[key].in_([row[key] for row in rows]))))
+    for row in rows:
+        if row[key] in existing:
+            values = {column: row[column] for column in columns
+                      if not (keep_existing and row[column] is None)}
+            session.execute(update(table).where(table.c[key] == row[key]).values(**values))
+        else:
+            session.execute(table.insert().values(**row))
+
+
+def _apply_batch(session, records: List[dict]):
+    users = User.__table__
+    # The last line wins when a user appears twice in one batch
+    by_user = {record['telegram_id']: record for record in records}
+    _upsert(session, users, [
+        {
+            'telegram_id': telegram_id,
+            'created_at': record.get('created_at') or datetime.utcnow(),
+            **{field: record.get(field) for field in PROFILE_FIELDS},
+        }
+        for telegram_id, record in by_user.items()
+    ], 'telegram_id', PROFILE_FIELDS, keep_existing=True)
+    user_ids = dict(session.execute(
+        select(User.telegram_id, User.id).where(User.telegram_id.in_(list(by_user)))
+    ).all())
+
+    for section, (model, defaults) in SECTIONS.items():
+        table = model.__table__
+        upserts, resets = [], []
+        for telegram_id, record in by_user.items():
+            values = record.get(section)
+            if values is None:
+                continue
+            # Stored sparsely, as the settings store does
+            overrides = {field: value for field, value in values.items()
+                         if value is not None and value != defaults[field]}
+            if overrides:
+                upserts.append({'user_id': user_ids[telegram_id],
+                                **{field: overrides.get(field) for field in defaults}})
+            else:
+                resets.append(user_ids[telegram_id])
+        _upsert(session, table, upserts, 'user_id', defaults)
+        if resets:
+            session.execute(table.delete().where(table.c.user_id.in_(resets)))
+
+
+def import_settings(session_factory, records: Iterable[dict], batch_size: int = 1000,
+                    progress: Optional[Callable[[int], None]] = None) -> int:
+    """Upsert users and their settings, one transaction per batch; returns the record count"""
+    imported = 0
+    batch = []
+    with session_factory() as session:
+        for record in records:
+            batch.append(record)
+            if len(batch) >= batch_size:
+                with session.begin():
+                    _apply_batch(session, batch)
+                imported += len(batch)
+                batch = []
+                if progress:
+                    progress(imported)
+        if batch:
+            with session.begin():
+                _apply_batch(session, batch)
+            imported += len(batch)
+    return imported
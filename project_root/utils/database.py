@@ -1,11 +1,35 @@
-from sqlalchemy import create_engine, Column, Integer, String, Float, Boolean, ForeignKey, DateTime
+from sqlalchemy import func, create_engine, Column, Integer, String, Float, Boolean, ForeignKey, DateTime, Index, LargeBinary, event, inspect, text
+from sqlalchemy.engine import Engine, make_url
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, relationship
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+import asyncio
+import functools
 import os
+import sqlite3
+import time
+import zlib
+from utils.metrics import DB_QUERY_SECONDS
 
 Base = declarative_base()
 
+# Default OpenAI-compatible endpoint for users who have not set their own
+DEFAULT_BASE_URL = os.getenv('OPENAI_BASE_URL', 'https://api.openai.com/v1')
+
+# Message content at least this many UTF-8 bytes is stored zlib-compressed; 0 disables
+MESSAGE_COMPRESSION_THRESHOLD = int(os.getenv('MESSAGE_COMPRESSION_THRESHOLD', '1024'))
+COMPRESSION_FORMAT_ZLIB = 'zlib'
+
+# SQLite file databases run in WAL mode with one writer thread and a pool of
+# read-only connections unless this is turned off
+SQLITE_PRODUCTION_MODE = os.getenv('SQLITE_PRODUCTION_MODE', 'True').lower() == 'true'
+# More readers mostly compete with the writer thread for the GIL
+SQLITE_READ_CONNECTIONS = int(os.getenv('SQLITE_READ_CONNECTIONS', '2'))
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv('SQLITE_BUSY_TIMEOUT_MS', '5000'))
+SQLITE_CACHE_SIZE_KB = int(os.getenv('SQLITE_CACHE_SIZE_KB', '20000'))
+SQLITE_MMAP_SIZE = int(os.getenv('SQLITE_MMAP_SIZE', str(256 * 1024 * 1024)))
+
 class User(Base):
     __tablename__ = 'users'
     
@@ -15,6 +39,8 @@ class User(Base):
     first_name = Column(String)
     last_name = Column(String, nullable=True)
     created_at = Column(DateTime, default=datetime.utcnow)
+    # Messages with id up to this are cleared and hidden while they are deleted
+    history_cutoff_id = Column(Integer, nullable=True)
     
     # Relationships
     messages = relationship("Message", back_populates="user")
@@ -26,24 +52,75 @@ class Message(Base):
     
     id = Column(Integer, primary_key=True)
     user_id = Column(Integer, ForeignKey('users.id'))
-    content = Column(String)
+    # Plain text; NULL when the content is stored compressed
+    _content = Column('content', String)
+    # NULL for plain text, 'zlib' when content_compressed holds the text
+    content_format = Column(String, nullable=True)
+    content_compressed = Column(LargeBinary, nullable=True)
     role = Column(String)  # 'user' or 'assistant'
     timestamp = Column(DateTime, default=datetime.utcnow)
     
     # Relationship
     user = relationship("User", back_populates="messages")
+    
+    @property
+    def content(self):
+        """Message text, decompressed on first read"""
+        if self.content_format != COMPRESSION_FORMAT_ZLIB:
+            return self._content
+        cached = self.__dict__.get('_decompressed')
+        if cached is None:
+            cached = zlib.decompress(self.content_compressed).decode('utf-8')
+            self.__dict__['_decompressed'] = cached
+        return cached
+    
+    @content.setter
+    def content(self, value):
+        self.__dict__.pop('_decompressed', None)
+        compressed = compress_content(value)
+        if compressed is None:
+            self._content = value
+            self.content_format = None
+            self.content_compressed = None
+        else:
+            self._content = None
+            self.content_format = COMPRESSION_FORMAT_ZLIB
+            self.content_compressed = compressed
+    
+    # Keyset pagination of a user's history walks (timestamp, id)
+    __table_args__ = (
+        Index('ix_messages_user_timestamp_id', 'user_id', 'timestamp', 'id'),
+    )
+
+def compress_content(value):
+    """zlib-compress text over the threshold; None when it should stay plain"""
+    if value is None or MESSAGE_COMPRESSION_THRESHOLD <= 0:
+        return None
+    encoded = value.encode('utf-8')
+    if len(encoded) < MESSAGE_COMPRESSION_THRESHOLD:
+        return None
+    compressed = zlib.compress(encoded, 6)
+    # Incompressible text is cheaper to keep as is
+    return compressed if len(compressed) < len(encoded) else None
+
+def stored_text(content, content_format, content_compressed):
+    """Message text from its stored columns; SQLite calls it as message_text()"""
+    if content_format != COMPRESSION_FORMAT_ZLIB:
+        return content
+    return zlib.decompress(content_compressed).decode('utf-8')
 
 class UserSettings(Base):
     __tablename__ = 'user_settings'
     
     id = Column(Integer, primary_key=True)
     user_id = Column(Integer, ForeignKey('users.id'), unique=True)
-    base_url = Column(String, default="https://api.openai.com/v1")
-    model = Column(String, default="gpt-3.5-turbo")
-    temperature = Column(Float, default=0.7)
-    max_tokens = Column(Integer, default=1000)
+    # NULL inherits the default from utils.settings_store
+    base_url = Column(String, nullable=True)
+    model = Column(String, nullable=True)
+    temperature = Column(Float, nullable=True)
+    max_tokens = Column(Integer, nullable=True)
     assistant_url = Column(String, nullable=True)
-    use_assistant = Column(Boolean, default=False)
+    use_assistant = Column(Boolean, nullable=True)
     
     # Relationship
     user = relationship("User", back_populates="settings")
@@ -53,19 +130,234 @@ class ImageSettings(Base):
     
     id = Column(Integer, primary_key=True)
     user_id = Column(Integer, ForeignKey('users.id'), unique=True)
-    base_url = Column(String, default="https://api.openai.com/v1")
-    model = Column(String, default="dall-e-3")
-    size = Column(String, default="1024x1024")
-    quality = Column(String, default="standard")
-    style = Column(String, default="natural")
-    hdr = Column(Boolean, default=False)
+    # NULL inherits the default from utils.settings_store
+    base_url = Column(String, nullable=True)
+    model = Column(String, nullable=True)
+    size = Column(String, nullable=True)
+    quality = Column(String, nullable=True)
+    style = Column(String, nullable=True)
+    hdr = Column(Boolean, nullable=True)
     
     # Relationship
     user = relationship("User", back_populates="image_settings")
 
+# Query metrics for every engine created in the process
+@event.listens_for(Engine, "before_cursor_execute")
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    # Kept on the execution context so a statement that fails leaves nothing behind
+    if context is not None:
+        context._query_start = time.perf_counter()
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = getattr(context, '_query_start', None)
+    if started is None:
+        return
+    operation = statement.lstrip().split(None, 1)[0].lower() if statement.strip() else 'unknown'
+    DB_QUERY_SECONDS.labels(operation=operation).observe(time.perf_counter() - started)
+
+# The search index's delete trigger needs the text of compressed messages
+@event.listens_for(Engine, "connect")
+def _register_sqlite_functions(dbapi_connection, connection_record):
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        dbapi_connection.create_function('message_text', 3, stored_text, deterministic=True)
+
+# One engine and session factory per database URL, shared by all handlers
+_session_factories = {}
+
+def add_missing_columns(engine):
+    """Add model columns that existing tables lack.
+
+    A lightweight stand-in for migrations: new columns must be nullable or
+    have a Python-side default, since existing rows get NULL.
+    """
+    inspector = inspect(engine)
+    existing_tables = set(inspector.get_table_names())
+    with engine.begin() as connection:
+        for table in Base.metadata.sorted_tables:
+            if table.name not in existing_tables:
+                continue
+            present = {column['name'] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in present:
+                    continue
+                column_type = column.type.compile(dialect=engine.dialect)
+                connection.execute(text(f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}'))
+
+def create_schema(engine):
+    """Create missing tables, columns and indexes"""
+    Base.metadata.create_all(engine)
+    add_missing_columns(engine)
+    # create_all only adds indexes along with new tables
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(engine, checkfirst=True)
+    from utils.search import create_search_schema
+    create_search_schema(engine)
+
+def is_sqlite_file(database_url: str) -> bool:
+    url = make_url(database_url)
+    return url.get_backend_name() == 'sqlite' and url.database not in (None, '', ':memory:')
+
+def _apply_sqlite_pragmas(engine, read_only: bool = False):
+    @event.listens_for(engine, "connect")
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        if not read_only:
+            # WAL lets readers proceed while the writer commits
+            cursor.execute("PRAGMA journal_mode=WAL")
+            # Durable at checkpoints; a power loss can drop the last commits, never corrupt
+            cursor.execute("PRAGMA synchronous=NORMAL")
+        else:
+            cursor.execute("PRAGMA query_only=ON")
+        cursor.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}")
+        cursor.execute(f"PRAGMA cache_size=-{SQLITE_CACHE_SIZE_KB}")
+        cursor.execute(f"PRAGMA mmap_size={SQLITE_MMAP_SIZE}")
+        cursor.execute("PRAGMA temp_store=MEMORY")
+        cursor.close()
+
+def _create_engine(database_url: str):
+    if SQLITE_PRODUCTION_MODE and is_sqlite_file(database_url):
+        # Connections are handed between the writer and reader threads
+        engine = create_engine(database_url, connect_args={'check_same_thread': False})
+        _apply_sqlite_pragmas(engine)
+        return engine
+    return create_engine(database_url)
+
 # Database initialization
 def init_db():
     database_url = os.getenv('DATABASE_URL', 'sqlite:///bot.db')
-    engine = create_engine(database_url)
-    Base.metadata.create_all(engine)
-    return sessionmaker(bind=engine) 
\ No newline at end of file
+    if database_url not in _session_factories:
+        engine = _create_engine(database_url)
+        create_schema(engine)
+        _session_factories[database_url] = sessionmaker(bind=engine)
+    return _session_factories[database_url]
+
+class DatabaseWorkers:
+    """Run blocking database work off the event loop.
+
+    For SQLite files in production mode every write goes through one
+    dedicated thread, so writers never contend for the database lock, and
+    reads use a separate pool of read-only connections that WAL lets run
+    alongside it. Other databases run both on the default thread pool.
+    """
+
+    def __init__(self, database_url: str):
+        self.session_factory = init_db()
+        self.single_writer = SQLITE_PRODUCTION_MODE and is_sqlite_file(database_url)
+        self._writer = None
+        self._readers = None
+        self.read_session_factory = self.session_factory
+        if self.single_writer:
+            self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='db-writer')
+            self._readers = ThreadPoolExecutor(
+                max_workers=SQLITE_READ_CONNECTIONS, thread_name_prefix='db-reader'
+            )
+            url = make_url(database_url)
+            read_engine = create_engine(
+                f"sqlite:///file:{url.database}?mode=ro&uri=true",
+                pool_size=SQLITE_READ_CONNECTIONS,
+                max_overflow=0,
+                connect_args={'check_same_thread': False}
+            )
+            _apply_sqlite_pragmas(read_engine, read_only=True)
+            self.read_session_factory = sessionmaker(bind=read_engine)
+        # Written objects are returned to callers after commit
+        self.write_session_factory = sessionmaker(
+            bind=self.session_factory.kw['bind'], expire_on_commit=False
+        )
+
+    async def run_write(self, fn, *args):
+        """Call fn(session, *args) in the writer and commit"""
+        return await self._run(self._writer, self._write, fn, args)
+
+    async def run_read(self, fn, *args):
+        """Call fn(session, *args) with a read-only session"""
+        return await self._run(self._readers, self._read, fn, args)
+
+    async def _run(self, executor, call, fn, args):
+        if executor is None:
+            return await asyncio.to_thread(call, fn, args)
+        return await asyncio.get_running_loop().run_in_executor(
+            executor, functools.partial(call, fn, args)
+        )
+
+    def _write(self, fn, args):
+        with self.write_session_factory() as session:
+            result = fn(session, *args)
+            session.commit()
+            return result
+
+    def _read(self, fn, args):
+        with self.read_session_factory() as session:
+            return fn(session, *args)
+
+    def shutdown(self):
+        for executor in (self._writer, self._readers):
+            if executor:
+                executor.shutdown(wait=True)
+
+_workers = {}
+
+def get_workers() -> DatabaseWorkers:
+    database_url = os.getenv('DATABASE_URL', 'sqlite:///bot.db')
+    if database_url not in _workers:
+        _workers[database_url] = DatabaseWorkers(database_url)
+    return _workers[database_url]
+
+def shutdown_workers():
+    """Finish queued writes and stop the database threads"""
+    while _workers:
+        _, workers = _workers.popitem()
+        workers.shutdown()
+
+async def run_write(fn, *args):
+    """Run fn(session, *args) as a database write off the event loop"""
+    return await get_workers().run_write(fn, *args)
+
+async def run_read(fn, *args):
+    """Run fn(session, *args) as a database read off the event loop"""
+    return await get_workers().run_read(fn, *args)
+
+def compress_messages(session_factory, batch_size: int = 500, progress=None) -> int:
+    """Compress stored plain-text messages over the threshold, in id order batches.
+
+    Returns how many messages were compressed. Safe to interrupt and rerun.
+    """
+    if MESSAGE_COMPRESSION_THRESHOLD <= 0:
+        return 0
+    compressed = 0
+    last_id = 0
+    with session_factory() as session:
+        while True:
+            # A character is at most 4 UTF-8 bytes, so this keeps every row
+            # that can reach the threshold; shorter ones stay plain below
+            messages = session.query(Message)\
+                .filter(Message.id > last_id)\
+                .filter(Message.content_format.is_(None))\
+                .filter(func.length(Message._content) >= MESSAGE_COMPRESSION_THRESHOLD // 4)\
+                .order_by(Message.id)\
+                .limit(batch_size)\
+                .all()
+            if not messages:
+                return compressed
+            for message in messages:
+                message.content = message._content
+                if message.content_format == COMPRESSION_FORMAT_ZLIB:
+                    compressed += 1
+            last_id = messages[-1].id
+            session.commit()
+            session.expunge_all()
+            if progress:
+                progress(last_id, compressed)
+
+def check_database(session_factory) -> dict:
+    """Run a trivial query and report the connection pool state"""
+    engine = session_factory.kw['bind']
+    started = time.perf_counter()
+    with engine.connect() as connection:
+        connection.execute(text('SELECT 1'))
+    return {
+        'ping_ms': round((time.perf_counter() - started) * 1000, 2),
+        'pool': engine.pool.status(),
+    }
@@ -0,0 +1,108 @@
+import gzip
+import io
+import json
+import os
+import shutil
+import tempfile
+from typing import IO, Optional, Tuple
+from sqlalchemy import func, select
+from utils.database import Message, User
+
+EXPORT_FORMATS = ('jsonl', 'md')
+# Rows fetched per round trip; with yield_per Postgres uses a server-side cursor
+EXPORT_BATCH = int(os.getenv('EXPORT_BATCH', '500'))
+# The export is built in memory up to this size, then spills to a temp file
+EXPORT_SPOOL_BYTES = int(os.getenv('EXPORT_SPOOL_BYTES', str(1024 * 1024)))
+# Exports larger than this are gzipped before upload
+EXPORT_GZIP_BYTES = int(os.getenv('EXPORT_GZIP_BYTES', str(5 * 1024 * 1024)))
+# Bot API limit for documents sent by bots
+EXPORT_MAX_UPLOAD_BYTES = 50 * 1024 * 1024
+
+ROLE_TITLES = {'user': 'Вы', 'assistant': 'Бот'}
+
+
+def export_record(message: Message) -> dict:
+    return {
+        'id': message.id,
+        'role': message.role,
+        'content': message.content,
+        'timestamp': message.timestamp.isoformat() if message.timestamp else None,
+    }
+
+
+def markdown_entry(message: Message) -> str:
+    date = message.timestamp.strftime("%d.%m.%Y %H:%M") if message.timestamp else '—'
+    title = ROLE_TITLES.get(message.role, message.role)
+    return f"### {date} · {title}\n\n{message.content or ''}\n\n"
+
+
+def write_export(session, telegram_id: int, fmt: str, out: IO[bytes]) -> int:
+    """Stream the user's visible history into out, oldest first; returns the message count.
+
+    Rows are fetched EXPORT_BATCH at a time and encoded as they arrive, so
+    memory use does not depend on the size of the history. History hidden by
+    /clear_history is left out.
+    """
+    user = session.query(User.id, User.history_cutoff_id).filter_by(telegram_id=telegram_id).first()
+    if user is None:
+        return 0
+    statement = select(Message)\
+        .where(Message.user_id == user.id)\
+        .where(Message.id > func.coalesce(user.history_cutoff_id, 0))\
+        .order_by(Message.timestamp, Message.id)\
+        .execution_options(yield_per=EXPORT_BATCH)
+
+    text = io.TextIOWrapper(out, encoding='utf-8', newline='\n', write_through=True)
+    if fmt == 'md':
+        text.write("# История сообщений\n\n")
+    count = 0
+    # The identity map holds loaded messages weakly, so each batch is freed
+    # once it has been written
+    for message in session.scalars(statement):
+        if fmt == 'md':
+            text.write(markdown_entry(message))
+        else:
+            text.write(json.dumps(export_record(message), ensure_ascii=False) + '\n')
+        count += 1
+    text.flush()
+    # Leave out open for the caller
+    text.detach()
+    return count
+
+
+def build_export(session, telegram_id: int, fmt: str) -> Tuple[Optional[IO[bytes]], str, int]:
+    """Write the export to a spooled temp file, gzipped when it is large.
+
+    Returns (file positioned at the start, filename suffix, message count);
+    the file is None when there is nothing to export. The caller closes it.
+    """
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError(f"Unknown export format: {fmt}")
+    raw = tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL_BYTES)
+    try:
+        count = write_export(session, telegram_id, fmt, raw)
+    except Exception:
+        raw.close()
+        raise
+    if not count:
+        raw.close()
+        return None, fmt, 0
+
+    size = raw.tell()
+    raw.seek(0)
+    if size <= EXPORT_GZIP_BYTES:
+        return raw, fmt, count
+
+    compressed = tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL_BYTES)
+    with raw, gzip.GzipFile(fileobj=compressed, mode='wb') as archive:
+        shutil.copyfileobj(raw, archive)
+    compressed.seek(0)
+    return compressed, f"{fmt}.gz", count
+
+
+def file_size(file: IO[bytes]) -> int:
+    position = file.tell()
+    file.seek(0, os.SEEK_END)
+    size = file.tell()
+    file.seek(position)
+    return size
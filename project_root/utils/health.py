@@ -0,0 +1,111 @@
+import asyncio
+import os
+import time
+from typing import Awaitable, Callable, Dict, Tuple
+from utils.database import init_db, check_database
+from utils.resilience import CircuitBreaker, upstream
+from utils.singleflight import SingleFlight
+
+# Probes within this many seconds get the previous result
+HEALTH_CACHE_SECONDS = float(os.getenv('HEALTH_CACHE_SECONDS', '5'))
+# getUpdates long-polls for at most ~10s, so a longer silence means polling is stuck
+HEALTH_POLL_STALE_SECONDS = float(os.getenv('HEALTH_POLL_STALE_SECONDS', '60'))
+HEALTH_MAX_LOOP_LAG = float(os.getenv('HEALTH_MAX_LOOP_LAG', '2'))
+HEALTH_DB_TIMEOUT = float(os.getenv('HEALTH_DB_TIMEOUT', '2'))
+
+REQUIRED_ENV_VARS = ("TELEGRAM_BOT_TOKEN", "OPENAI_API_KEY")
+
+OK, DEGRADED, FAIL = 'ok', 'degraded', 'fail'
+
+
+class HealthChecker:
+    """Liveness and readiness checks with cached results.
+
+    Liveness fails when polling has stopped or stalled, so the process
+    should be restarted. Readiness additionally pings the database and
+    checks event loop lag; open upstream circuits only mark it degraded.
+    """
+
+    def __init__(self, bot=None, ttl: float = HEALTH_CACHE_SECONDS):
+        self.bot = bot  # TelegramBot when running in the same process (main.py)
+        self.ttl = ttl
+        self._cache: Dict[str, Tuple[float, dict]] = {}
+        self._inflight = SingleFlight()
+        self._session_factory = None
+
+    async def liveness(self) -> dict:
+        return await self._cached('live', self._check_liveness)
+
+    async def readiness(self) -> dict:
+        return await self._cached('ready', self._check_readiness)
+
+    async def _cached(self, name: str, check: Callable[[], Awaitable[dict]]) -> dict:
+        cached = self._cache.get(name)
+        if cached and time.monotonic() - cached[0] < self.ttl:
+            return cached[1]
+        # Concurrent probes share one check
+        result, _ = await self._inflight.do(name, check)
+        self._cache[name] = (time.monotonic(), result)
+        return result
+
+    async def _check_liveness(self) -> dict:
+        checks = {}
+        if self.bot is not None:
+            checks['bot'] = self._bot_check()
+        return _summary(checks)
+
+    async def _check_readiness(self) -> dict:
+        missing = [var for var in REQUIRED_ENV_VARS if not os.getenv(var)]
+        checks = {
+            'config': {'status': FAIL, 'missing': missing} if missing else {'status': OK},
+            'database': await self._database_check(),
+            'upstream': self._upstream_check(),
+        }
+        if self.bot is not None:
+            checks['bot'] = self._bot_check()
+            checks['event_loop'] = self._loop_check()
+        return _summary(checks)
+
+    def _bot_check(self) -> dict:
+        details = self.bot.health()
+        stale = (details['seconds_since_poll'] is not None
+                 and details['seconds_since_poll'] > HEALTH_POLL_STALE_SECONDS)
+        ok = details['running'] and details['polling'] and not stale
+        return {'status': OK if ok else FAIL, 'mode': 'polling', **details}
+
+    def _loop_check(self) -> dict:
+        watchdog = self.bot.watchdog
+        heartbeat_age = watchdog.seconds_since_heartbeat()
+        ok = watchdog.last_lag <= HEALTH_MAX_LOOP_LAG and heartbeat_age <= HEALTH_POLL_STALE_SECONDS
+        return {
+            'status': OK if ok else FAIL,
+            'lag_seconds': round(watchdog.last_lag, 3),
+            'max_lag_seconds': round(watchdog.max_lag, 3),
+            'seconds_since_heartbeat': round(heartbeat_age, 2),
+        }
+
+    async def _database_check(self) -> dict:
+        try:
+            # The ping is blocking I/O and a locked database must not stall the loop
+            details = await asyncio.wait_for(asyncio.to_thread(self._ping_database), HEALTH_DB_TIMEOUT)
+        except asyncio.TimeoutError:
+            return {'status': FAIL, 'error': f"no response in {HEALTH_DB_TIMEOUT}s"}
+        except Exception as e:
+            return {'status': FAIL, 'error': f"{type(e).__name__}: {e}"}
+        return {'status': OK, **details}
+
+    def _ping_database(self) -> dict:
+        if self._session_factory is None:
+            self._session_factory = init_db()
+        return check_database(self._session_factory)
+
+    def _upstream_check(self) -> dict:
+        circuits = upstream.circuit_states()
+        degraded = any(state != CircuitBreaker.CLOSED for state in circuits.values())
+        return {'status': DEGRADED if degraded else OK, 'circuits': circuits}
+
+
+def _summary(checks: Dict[str, dict]) -> dict:
+    statuses = {check['status'] for check in checks.values()}
+    status = FAIL if FAIL in statuses else DEGRADED if DEGRADED in statuses else OK
+    return {'status': status, 'checked_at': round(time.time(), 3), 'checks': checks}
@@ -1,59 +1,126 @@
+import atexit
+import functools
+import json
 import logging
 import os
-from logging.handlers import RotatingFileHandler
+import queue
+import random
+from contextvars import ContextVar
+from logging.handlers import RotatingFileHandler, QueueHandler, QueueListener
 import sys
 from pathlib import Path
 import tempfile
+from typing import List, Optional, Set
 
 # Debug mode flag from environment variable
 DEBUG_MODE = os.getenv('DEBUG_MODE', 'False').lower() == 'true'
+# 'text' (default) or 'json' for one JSON object per line
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'text').lower()
+# Records beyond this many waiting to be written are dropped
+LOG_QUEUE_SIZE = int(os.getenv('LOG_QUEUE_SIZE', '10000'))
 
-def setup_logging(name: str, log_file: str = None) -> logging.Logger:
-    """Setup logging configuration"""
-    logger = logging.getLogger(name)
-    
-    # Set base logging level
-    base_level = logging.DEBUG if DEBUG_MODE else logging.INFO
-    logger.setLevel(base_level)
+# Sampled per-update tracing: debug output for a fraction of updates or for chosen users
+TRACE_SAMPLE_RATE = float(os.getenv('TRACE_SAMPLE_RATE', '0'))
+TRACE_USER_IDS: Set[int] = {
+    int(user_id) for user_id in os.getenv('TRACE_USER_IDS', '').split(',') if user_id.strip()
+}
+
+_listener: Optional[QueueListener] = None
+_queue_handler: Optional['DroppingQueueHandler'] = None
+# Top-level names (packages, scripts) of loggers made by setup_logging; every
+# logger under them follows the project level, however it was created
+_project_roots: Set[str] = set()
+# Set for the task handling a traced update; each update runs in its own task
+_trace_active: ContextVar[bool] = ContextVar('trace_active', default=False)
+
+class TraceAwareLogger(logging.Logger):
+    """Project logger that emits every level while the current update is being traced"""
+
+    def isEnabledFor(self, level: int) -> bool:
+        if self.disabled or level <= self.manager.disable:
+            return False
+        if _trace_active.get() and self.name.split('.', 1)[0] in _project_roots:
+            return True
+        return super().isEnabledFor(level)
+
+logging.setLoggerClass(TraceAwareLogger)
+
+class DroppingQueueHandler(QueueHandler):
+    """QueueHandler that drops records instead of blocking when the queue is full"""
+
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+class JsonFormatter(logging.Formatter):
+    """Format records as single-line JSON objects"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'location': f"{record.filename}:{record.lineno}",
+            'message': record.getMessage(),
+        }
+        if record.exc_info:
+            entry['exc_info'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+def _resolve_log_file(log_file: str) -> str:
+    """Pick a writable location for the log file"""
+    # Always use temp directory for log files in production
+    if not DEBUG_MODE:
+        return os.path.join(tempfile.gettempdir(), os.path.basename(log_file))
+    # In debug mode, try to use specified path first
+    log_dir = os.path.dirname(log_file)
+    if log_dir:
+        try:
+            Path(log_dir).mkdir(parents=True, exist_ok=True)
+        except (OSError, PermissionError):
+            # Fallback to temp directory
+            return os.path.join(tempfile.gettempdir(), os.path.basename(log_file))
+    return log_file
+
+def configure_logging(log_file: Optional[str] = None) -> None:
+    """Configure the process-wide logging pipeline once, at startup.
+
+    Loggers only put records on a bounded in-memory queue; a QueueListener
+    thread does the console and file I/O, including rotation, off the event loop.
+    """
+    global _listener, _queue_handler
+    if _listener is not None:
+        return
     
+    # Handlers accept every level; loggers do the filtering so the level
+    # can be changed at runtime with set_debug_mode
     # Create formatters
-    detailed_formatter = logging.Formatter(
-        '%(asctime)s - %(name)s - %(levelname)s - [%(filename)s:%(lineno)d] - %(message)s'
-    )
-    simple_formatter = logging.Formatter(
-        '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-    )
+    if LOG_FORMAT == 'json':
+        detailed_formatter = simple_formatter = JsonFormatter()
+    else:
+        detailed_formatter = logging.Formatter(
+            '%(asctime)s - %(name)s - %(levelname)s - [%(filename)s:%(lineno)d] - %(message)s'
+        )
+        simple_formatter = logging.Formatter(
+            '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+        )
     
     # Console handler
     console_handler = logging.StreamHandler(sys.stdout)
-    console_handler.setFormatter(simple_formatter)
-    console_handler.setLevel(logging.INFO)
-    logger.addHandler(console_handler)
-    
-    # Debug console handler (only active in debug mode)
-    if DEBUG_MODE:
-        debug_console_handler = logging.StreamHandler(sys.stdout)
-        debug_console_handler.setFormatter(detailed_formatter)
-        debug_console_handler.setLevel(logging.DEBUG)
-        debug_console_handler.addFilter(lambda record: record.levelno == logging.DEBUG)
-        logger.addHandler(debug_console_handler)
+    console_handler.setFormatter(detailed_formatter if DEBUG_MODE else simple_formatter)
+    handlers = [console_handler]
     
     # File handler (if log_file is specified)
+    file_error = None
     if log_file:
         try:
-            # Always use temp directory for log files in production
-            if not DEBUG_MODE:
-                log_file = os.path.join(tempfile.gettempdir(), os.path.basename(log_file))
-            else:
-                # In debug mode, try to use specified path first
-                log_dir = os.path.dirname(log_file)
-                if log_dir:
-                    try:
-                        Path(log_dir).mkdir(parents=True, exist_ok=True)
-                    except (OSError, PermissionError):
-                        # Fallback to temp directory
-                        log_file = os.path.join(tempfile.gettempdir(), os.path.basename(log_file))
-            
+            log_file = _resolve_log_file(log_file)
             file_handler = RotatingFileHandler(
                 log_file,
                 maxBytes=10*1024*1024,  # 10MB
@@ -62,36 +129,130 @@ def setup_logging(name: str, log_file: str = None) -> logging.Logger:
                 encoding='utf-8'
             )
             file_handler.setFormatter(detailed_formatter)
-            file_handler.setLevel(logging.DEBUG if DEBUG_MODE else logging.INFO)
-            logger.addHandler(file_handler)
-            
-            logger.debug(f"Logging to file: {log_file}")
-            
+            handlers.append(file_handler)
         except Exception as e:
             # If we can't set up file logging, log to console only
-            logger.warning(f"Failed to set up file logging: {e}. Continuing with console logging only.")
+            file_error = e
+    
+    _queue_handler = DroppingQueueHandler(queue.Queue(maxsize=LOG_QUEUE_SIZE))
+    root = logging.getLogger()
+    # Third-party libraries (httpx logs every request at INFO) stay at WARNING;
+    # project loggers get their level from setup_logging
+    root.setLevel(logging.WARNING)
+    root.addHandler(_queue_handler)
+    
+    _listener = QueueListener(_queue_handler.queue, *handlers, respect_handler_level=True)
+    _listener.start()
+    # Flush queued records on interpreter exit
+    atexit.register(_listener.stop)
     
+    logger = logging.getLogger(__name__)
+    if file_error:
+        logger.warning(f"Failed to set up file logging: {file_error}. Continuing with console logging only.")
+    else:
+        logger.debug("Logging to file: %s", log_file)
+
+def dropped_log_records() -> int:
+    """Number of records dropped because the log queue was full"""
+    return _queue_handler.dropped if _queue_handler else 0
+
+def setup_logging(name: str) -> logging.Logger:
+    """Get a module logger; handlers live on the root logger set up by configure_logging"""
+    logger = logging.getLogger(name)
+    logger.setLevel(_project_level())
+    _project_roots.add(name.split('.', 1)[0])
     return logger
 
+def _project_level() -> int:
+    return logging.DEBUG if DEBUG_MODE else logging.INFO
+
+def project_loggers() -> List[logging.Logger]:
+    """Existing loggers that belong to the project"""
+    return [
+        logger for name, logger in logging.Logger.manager.loggerDict.items()
+        if isinstance(logger, logging.Logger) and name.split('.', 1)[0] in _project_roots
+    ]
+
+def is_debug_mode() -> bool:
+    """Current debug mode, which may have been changed at runtime"""
+    return DEBUG_MODE
+
+def set_debug_mode(enabled: bool) -> None:
+    """Switch project loggers between DEBUG and INFO without a restart"""
+    global DEBUG_MODE
+    DEBUG_MODE = enabled
+    level = _project_level()
+    for logger in project_loggers():
+        logger.setLevel(level)
+
+def set_trace_sample_rate(rate: float) -> None:
+    """Trace this fraction (0..1) of updates"""
+    global TRACE_SAMPLE_RATE
+    TRACE_SAMPLE_RATE = min(max(rate, 0.0), 1.0)
+
+def toggle_trace_user(user_id: int) -> bool:
+    """Start or stop tracing every update from user_id; returns whether it is now traced"""
+    if user_id in TRACE_USER_IDS:
+        TRACE_USER_IDS.discard(user_id)
+        return False
+    TRACE_USER_IDS.add(user_id)
+    return True
+
+def reset_tracing() -> None:
+    """Turn off sampled and per-user tracing"""
+    set_trace_sample_rate(0.0)
+    TRACE_USER_IDS.clear()
+
+def start_update_trace(user_id: Optional[int]) -> bool:
+    """Decide whether the update handled by the current task is traced"""
+    traced = (user_id in TRACE_USER_IDS) or (
+        TRACE_SAMPLE_RATE > 0 and random.random() < TRACE_SAMPLE_RATE
+    )
+    if traced:
+        _trace_active.set(True)
+    return traced
+
+def trace_active() -> bool:
+    return _trace_active.get()
+
+def debug_enabled(logger: logging.Logger) -> bool:
+    """Check before building expensive debug-only messages"""
+    return logger.isEnabledFor(logging.DEBUG)
+
+class LazyMessage:
+    """Defer building a log argument until a handler actually formats the record"""
+    __slots__ = ('func',)
+
+    def __init__(self, func):
+        self.func = func
+
+    def __str__(self):
+        return str(self.func())
+
 def log_function_call(logger: logging.Logger):
-    """Decorator to log function calls"""
+    """Decorator to log function calls.
+
+    When debug output is off for the current update the call goes straight
+    through without touching its arguments; exceptions still propagate to the
+    application error handler.
+    """
     def decorator(func):
+        func_name = func.__name__
+
+        @functools.wraps(func)
         async def wrapper(*args, **kwargs):
-            func_name = func.__name__
-            logger.debug(
-                f"Calling {func_name} with args: {args}, kwargs: {kwargs}"
-            )
+            if not (DEBUG_MODE or _trace_active.get()):
+                return await func(*args, **kwargs)
+            logger.debug("Calling %s with args: %r, kwargs: %r", func_name, args, kwargs)
             try:
                 result = await func(*args, **kwargs)
-                logger.debug(
-                    f"{func_name} completed successfully"
-                )
+                logger.debug("%s completed successfully", func_name)
                 return result
             except Exception as e:
                 logger.error(
-                    f"Error in {func_name}: {str(e)}",
+                    "Error in %s: %s", func_name, e,
                     exc_info=DEBUG_MODE
                 )
                 raise
         return wrapper
-    return decorator 
\ No newline at end of file
+    return decorator
@@ -0,0 +1,126 @@
+import functools
+import os
+from prometheus_client import CollectorRegistry, Counter, Histogram, REGISTRY, generate_latest, CONTENT_TYPE_LATEST
+
+# main.py serves /metrics from the bot's own process. When bot.py and api.py are
+# run separately, set PROMETHEUS_MULTIPROC_DIR so each process writes its samples
+# there and /metrics aggregates them.
+MULTIPROCESS_DIR = os.getenv('PROMETHEUS_MULTIPROC_DIR')
+
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+STREAM_PHASE_SECONDS = Histogram(
+    'bot_stream_phase_seconds',
+    'Time spent in each phase of a streamed chat reply',
+    ['phase'],
+    buckets=LATENCY_BUCKETS
+)
+STREAM_TTFT_SECONDS = Histogram(
+    'bot_stream_time_to_first_token_seconds',
+    'Time from sending a chat request to receiving its first token',
+    ['model'],
+    buckets=LATENCY_BUCKETS
+)
+STREAM_TOKENS_PER_SECOND = Histogram(
+    'bot_stream_tokens_per_second',
+    'Streamed tokens per second after the first token',
+    ['model'],
+    buckets=(1, 5, 10, 20, 30, 50, 75, 100, 150, 250, 500)
+)
+STREAM_EDITS = Histogram(
+    'bot_stream_telegram_edits',
+    'Telegram message edits per streamed reply',
+    buckets=(0, 1, 2, 5, 10, 20, 50, 100)
+)
+TELEGRAM_EDIT_SECONDS = Histogram(
+    'bot_telegram_edit_seconds',
+    'Latency of editMessageText calls',
+    buckets=LATENCY_BUCKETS
+)
+STREAM_ERRORS = Counter(
+    'bot_stream_errors_total',
+    'Streamed replies that ended with an error'
+)
+
+UPDATES_TOTAL = Counter(
+    'bot_updates_total',
+    'Updates handled, by handler type',
+    ['handler']
+)
+GROUP_MESSAGES_TOTAL = Counter(
+    'bot_group_messages_total',
+    'Group messages checked for addressing, by outcome (handled or dropped)',
+    ['outcome']
+)
+HANDLER_SECONDS = Histogram(
+    'bot_handler_seconds',
+    'Time spent in handler callbacks, by handler type',
+    ['handler'],
+    buckets=LATENCY_BUCKETS
+)
+DB_QUERY_SECONDS = Histogram(
+    'bot_db_query_seconds',
+    'Database statement latency, by statement type',
+    ['operation'],
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 5)
+)
+OPENAI_REQUEST_SECONDS = Histogram(
+    'bot_openai_request_seconds',
+    'Duration of OpenAI-compatible API calls, by operation and model',
+    ['operation', 'model', 'outcome'],
+    buckets=LATENCY_BUCKETS
+)
+TELEGRAM_REQUEST_SECONDS = Histogram(
+    'bot_telegram_request_seconds',
+    'Duration of Telegram Bot API calls, by method',
+    ['method'],
+    buckets=LATENCY_BUCKETS
+)
+TELEGRAM_RATE_LIMITED = Counter(
+    'bot_telegram_rate_limited_total',
+    'Telegram Bot API calls rejected with 429, by method',
+    ['method']
+)
+EVENT_LOOP_LAG_SECONDS = Histogram(
+    'bot_event_loop_lag_seconds',
+    'Delay between a scheduled event loop wakeup and when it actually ran',
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+)
+EVENT_LOOP_STALLS = Counter(
+    'bot_event_loop_stalls_total',
+    'Times the event loop lag exceeded LOOP_LAG_THRESHOLD'
+)
+
+
+def track_handler(callback, handler: str):
+    """Wrap a handler callback so its updates are counted and timed"""
+    @functools.wraps(callback)
+    async def wrapper(*args, **kwargs):
+        UPDATES_TOTAL.labels(handler=handler).inc()
+        with HANDLER_SECONDS.labels(handler=handler).time():
+            return await callback(*args, **kwargs)
+    return wrapper
+
+
+def instrument_handler(handler, name: str):
+    """Instrument a PTB handler, recursing into conversation handlers"""
+    from telegram.ext import ConversationHandler
+    if isinstance(handler, ConversationHandler):
+        children = list(handler.entry_points) + list(handler.fallbacks)
+        for state_handlers in handler.states.values():
+            children.extend(state_handlers)
+        for child in children:
+            instrument_handler(child, name)
+    else:
+        handler.callback = track_handler(handler.callback, name)
+    return handler
+
+
+def render_metrics() -> bytes:
+    """Render all metrics in the Prometheus text format"""
+    if MULTIPROCESS_DIR:
+        from prometheus_client import multiprocess
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry)
+    return generate_latest(REGISTRY)
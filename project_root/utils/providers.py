@@ -0,0 +1,109 @@
+import json
+import os
+import time
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional
+
+from utils.logging_config import setup_logging
+
+logger = setup_logging(__name__)
+
+# Seconds added to an endpoint's score per unit of error rate
+ERROR_PENALTY = float(os.getenv('PROVIDER_ERROR_PENALTY', '10'))
+# Half-life of the error rate while an endpoint is not being used
+ERROR_HALF_LIFE = float(os.getenv('PROVIDER_ERROR_HALF_LIFE', '60'))
+
+
+@dataclass
+class ProviderEndpoint:
+    """One OpenAI-compatible endpoint and its rolling latency/error statistics"""
+    base_url: str
+    api_key_env: Optional[str] = None
+    model: Optional[str] = None  # Provider-specific model name, if it differs
+    ttft_ewma: Optional[float] = None
+    error_ewma: float = 0.0
+    updated_at: float = field(default_factory=time.monotonic)
+
+    @property
+    def api_key(self) -> Optional[str]:
+        return os.getenv(self.api_key_env) if self.api_key_env else None
+
+    def error_rate(self, now: Optional[float] = None) -> float:
+        """Error rate decayed by the time since the endpoint was last used"""
+        elapsed = (now or time.monotonic()) - self.updated_at
+        return self.error_ewma * 0.5 ** (elapsed / ERROR_HALF_LIFE)
+
+    def score(self, now: Optional[float] = None) -> float:
+        """Expected time-to-first-token in seconds, lower is better"""
+        # Endpoints without samples score 0 so they get tried once
+        return (self.ttft_ewma or 0.0) + ERROR_PENALTY * self.error_rate(now)
+
+
+class ProviderRouter:
+    """Route text models across a pool of endpoints by EWMA time-to-first-token and error rate.
+
+    Pools come from PROVIDER_POOLS (JSON) or PROVIDER_POOLS_FILE, mapping a model
+    name to its endpoints, e.g.
+    {"gpt-4o-mini": [{"base_url": "https://api.openai.com/v1"},
+                     {"base_url": "https://openrouter.ai/api/v1",
+                      "api_key_env": "OPENROUTER_API_KEY", "model": "openai/gpt-4o-mini"}]}
+    """
+
+    def __init__(self, pools: Optional[Dict[str, List[ProviderEndpoint]]] = None, alpha: float = 0.2):
+        self.pools = pools or {}
+        self.alpha = alpha
+        self._endpoints: Dict[str, ProviderEndpoint] = {}
+
+    @classmethod
+    def from_env(cls) -> 'ProviderRouter':
+        raw = os.getenv('PROVIDER_POOLS')
+        path = os.getenv('PROVIDER_POOLS_FILE')
+        try:
+            if path:
+                with open(path, encoding='utf-8') as f:
+                    raw = f.read()
+            config = json.loads(raw) if raw else {}
+            pools = {
+                model: [ProviderEndpoint(**entry) for entry in entries]
+                for model, entries in config.items()
+            }
+        except (OSError, ValueError, TypeError) as e:
+            logger.error(f"Invalid provider pool configuration: {e}")
+            pools = {}
+        return cls(pools, alpha=float(os.getenv('PROVIDER_EWMA_ALPHA', '0.2')))
+
+    def _endpoint(self, base_url: str) -> ProviderEndpoint:
+        """Endpoint stats for a base_url outside of any pool"""
+        key = base_url.rstrip('/')
+        if key not in self._endpoints:
+            self._endpoints[key] = ProviderEndpoint(base_url=base_url)
+        return self._endpoints[key]
+
+    def candidates(self, model: str, base_url: str) -> List[ProviderEndpoint]:
+        """Endpoints to try for a request, best first"""
+        pool = self.pools.get(model)
+        if not pool:
+            return [self._endpoint(base_url)]
+        endpoints = list(pool)
+        if all(e.base_url.rstrip('/') != base_url.rstrip('/') for e in pool):
+            # The user's own endpoint competes with the pool
+            endpoints.append(self._endpoint(base_url))
+        now = time.monotonic()
+        return sorted(endpoints, key=lambda e: e.score(now))
+
+    def record_success(self, endpoint: ProviderEndpoint, ttft: float):
+        now = time.monotonic()
+        endpoint.error_ewma = (1 - self.alpha) * endpoint.error_rate(now)
+        if endpoint.ttft_ewma is None:
+            endpoint.ttft_ewma = ttft
+        else:
+            endpoint.ttft_ewma = (1 - self.alpha) * endpoint.ttft_ewma + self.alpha * ttft
+        endpoint.updated_at = now
+
+    def record_failure(self, endpoint: ProviderEndpoint):
+        now = time.monotonic()
+        endpoint.error_ewma = (1 - self.alpha) * endpoint.error_rate(now) + self.alpha
+        endpoint.updated_at = now
+
+
+router = ProviderRouter.from_env()
@@ -0,0 +1,240 @@
+import asyncio
+import json
+import os
+import random
+import sys
+import time
+from dataclasses import dataclass, replace
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Optional
+
+from utils.logging_config import setup_logging
+
+logger = setup_logging(__name__)
+
+
+@dataclass(frozen=True)
+class EndpointPolicy:
+    """Timeout and retry limits for one OpenAI-compatible endpoint"""
+    connect_timeout: float = float(os.getenv('UPSTREAM_CONNECT_TIMEOUT', '10'))
+    first_token_timeout: float = float(os.getenv('UPSTREAM_FIRST_TOKEN_TIMEOUT', '30'))
+    total_timeout: float = float(os.getenv('UPSTREAM_TOTAL_TIMEOUT', '120'))
+    max_retries: int = int(os.getenv('UPSTREAM_MAX_RETRIES', '2'))
+
+
+class CircuitOpenError(Exception):
+    """Raised when calls to an endpoint are short-circuited"""
+
+    def __init__(self, base_url: str, retry_in: float):
+        self.base_url = base_url
+        self.retry_in = retry_in
+        super().__init__(
+            f"сервис {base_url} временно недоступен, повторите через {int(retry_in) + 1} сек."
+        )
+
+
+class CircuitBreaker:
+    """Consecutive-failure circuit breaker with a single half-open probe"""
+    CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half_open'
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = 0.0
+        self._state = self.CLOSED
+        self._probe_in_flight = False
+
+    @property
+    def state(self) -> str:
+        if self._state == self.OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+            self._state = self.HALF_OPEN
+        return self._state
+
+    def retry_in(self) -> float:
+        """Seconds until the next probe is allowed"""
+        return max(0.0, self.reset_timeout - (time.monotonic() - self.opened_at))
+
+    def allow_request(self) -> bool:
+        state = self.state
+        if state == self.CLOSED:
+            return True
+        if state == self.HALF_OPEN and not self._probe_in_flight:
+            self._probe_in_flight = True
+            return True
+        return False
+
+    def record_success(self):
+        self.failures = 0
+        self._probe_in_flight = False
+        self._state = self.CLOSED
+
+    def release_probe(self):
+        """Give up the half-open probe slot without an outcome, e.g. when the call was cancelled"""
+        self._probe_in_flight = False
+
+    def record_failure(self):
+        self.failures += 1
+        self._probe_in_flight = False
+        if self._state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+            self._state = self.OPEN
+            self.opened_at = time.monotonic()
+
+
+def is_retryable(exc: BaseException) -> bool:
+    """Whether an upstream error is transient (timeouts, connection errors, 429 and 5xx)"""
+    if isinstance(exc, asyncio.TimeoutError):
+        return True
+    import openai
+    if isinstance(exc, (openai.APIConnectionError, openai.APITimeoutError)):
+        return True
+    if isinstance(exc, openai.APIStatusError):
+        return exc.status_code in (408, 409, 429) or exc.status_code >= 500
+    # An aiohttp error can only occur once aiohttp has been imported
+    aiohttp = sys.modules.get('aiohttp')
+    if aiohttp is None:
+        return False
+    if isinstance(exc, aiohttp.ClientResponseError):
+        return exc.status in (408, 429) or exc.status >= 500
+    return isinstance(exc, aiohttp.ClientConnectionError)
+
+
+def backoff_delay(attempt: int, base: float = 0.5, cap: float = 8.0) -> float:
+    """Full-jitter exponential backoff"""
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
+
+
+class UpstreamResilience:
+    """Per-endpoint timeouts, jittered retries and circuit breakers for upstream calls"""
+
+    def __init__(self):
+        self.default_policy = EndpointPolicy()
+        self.failure_threshold = int(os.getenv('CIRCUIT_FAILURE_THRESHOLD', '5'))
+        self.reset_timeout = float(os.getenv('CIRCUIT_RESET_TIMEOUT', '30'))
+        self.policies: Dict[str, EndpointPolicy] = {}
+        self.breakers: Dict[str, CircuitBreaker] = {}
+        self._clients: Dict[str, Any] = {}
+
+        # Optional per-endpoint overrides, e.g.
+        # {"https://my-llm.example/v1": {"first_token_timeout": 60, "max_retries": 0}}
+        overrides = os.getenv('UPSTREAM_ENDPOINT_POLICIES')
+        if overrides:
+            try:
+                for base_url, values in json.loads(overrides).items():
+                    self.policies[base_url.rstrip('/')] = replace(self.default_policy, **values)
+            except (ValueError, TypeError) as e:
+                logger.error(f"Invalid UPSTREAM_ENDPOINT_POLICIES: {e}")
+
+    def policy(self, base_url: str) -> EndpointPolicy:
+        return self.policies.get(base_url.rstrip('/'), self.default_policy)
+
+    def breaker(self, base_url: str) -> CircuitBreaker:
+        key = base_url.rstrip('/')
+        if key not in self.breakers:
+            self.breakers[key] = CircuitBreaker(self.failure_threshold, self.reset_timeout)
+        return self.breakers[key]
+
+    def circuit_states(self) -> Dict[str, str]:
+        return {base_url: breaker.state for base_url, breaker in self.breakers.items()}
+
+    def client(self, base_url: str, api_key: Optional[str] = None):
+        """Return a cached AsyncOpenAI client for base_url with the endpoint's timeouts"""
+        api_key = api_key or os.getenv('OPENAI_API_KEY')
+        key = f"{base_url.rstrip('/')}|{api_key}"
+        if key not in self._clients:
+            import httpx
+            from openai import AsyncOpenAI
+            policy = self.policy(base_url)
+            self._clients[key] = AsyncOpenAI(
+                api_key=api_key,
+                base_url=base_url,
+                timeout=httpx.Timeout(policy.total_timeout, connect=policy.connect_timeout),
+                # Retries are handled here so they respect the circuit breaker
+                max_retries=0
+            )
+        return self._clients[key]
+
+    def _acquire(self, base_url: str) -> CircuitBreaker:
+        breaker = self.breaker(base_url)
+        if not breaker.allow_request():
+            raise CircuitOpenError(base_url, breaker.retry_in())
+        return breaker
+
+    async def call(self, base_url: str, func: Callable[[], Awaitable[Any]], idempotent: bool = False) -> Any:
+        """Run a unary upstream call under the endpoint's timeout, retry and circuit policy"""
+        policy = self.policy(base_url)
+        attempts = policy.max_retries + 1 if idempotent else 1
+        for attempt in range(attempts):
+            breaker = self._acquire(base_url)
+            try:
+                result = await asyncio.wait_for(func(), policy.total_timeout)
+            except Exception as e:
+                if not is_retryable(e):
+                    breaker.record_success()
+                    raise
+                breaker.record_failure()
+                if attempt + 1 >= attempts:
+                    raise
+                delay = backoff_delay(attempt)
+                logger.warning(f"Upstream call to {base_url} failed ({e!r}), retrying in {delay:.2f}s")
+                await asyncio.sleep(delay)
+            except BaseException:
+                # Cancelled (single-flight leader, timeout, shutdown): the next request probes instead
+                breaker.release_probe()
+                raise
+            else:
+                breaker.record_success()
+                return result
+
+    async def stream(self, base_url: str, create: Callable[[], Awaitable[Any]],
+                     max_retries: Optional[int] = None) -> AsyncIterator[Any]:
+        """Open a streaming call and yield its chunks.
+
+        Failures before the first chunk are retried since nothing has been shown
+        to the user yet; after that the stream is bounded by the total timeout.
+        """
+        policy = self.policy(base_url)
+        if max_retries is None:
+            max_retries = policy.max_retries
+        deadline = time.monotonic() + policy.total_timeout
+        attempt = 0
+        while True:
+            breaker = self._acquire(base_url)
+            try:
+                stream = await asyncio.wait_for(create(), policy.first_token_timeout)
+                iterator = stream.__aiter__()
+                first_chunk = await asyncio.wait_for(iterator.__anext__(), policy.first_token_timeout)
+            except StopAsyncIteration:
+                breaker.record_success()
+                return
+            except Exception as e:
+                if not is_retryable(e):
+                    breaker.record_success()
+                    raise
+                breaker.record_failure()
+                attempt += 1
+                if attempt > max_retries or time.monotonic() >= deadline:
+                    raise
+                delay = backoff_delay(attempt - 1)
+                logger.warning(f"Stream from {base_url} failed before first token ({e!r}), retrying in {delay:.2f}s")
+                await asyncio.sleep(delay)
+                continue
+            except BaseException:
+                breaker.release_probe()
+                raise
+            breaker.record_success()
+            break
+
+        yield first_chunk
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise asyncio.TimeoutError(f"Stream from {base_url} exceeded {policy.total_timeout}s")
+            try:
+                chunk = await asyncio.wait_for(iterator.__anext__(), remaining)
+            except StopAsyncIteration:
+                return
+            yield chunk
+
+
+# Shared by all handlers so circuit state is per process, not per handler
+upstream = UpstreamResilience()
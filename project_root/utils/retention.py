@@ -0,0 +1,232 @@
+import asyncio
+import gzip
+import json
+import os
+from collections import defaultdict
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Iterable, List, Optional, Tuple
+from sqlalchemy import func, tuple_
+from utils.database import Message, User, run_read, run_write
+from utils.search import index_message
+
+# 0 disables the corresponding limit
+HISTORY_MAX_AGE_DAYS = int(os.getenv('HISTORY_MAX_AGE_DAYS', '0'))
+HISTORY_MAX_ROWS_PER_USER = int(os.getenv('HISTORY_MAX_ROWS_PER_USER', '0'))
+# Pruned messages are archived here when set
+HISTORY_ARCHIVE_DIR = os.getenv('HISTORY_ARCHIVE_DIR')
+HISTORY_RETENTION_INTERVAL = float(os.getenv('HISTORY_RETENTION_INTERVAL', '3600'))
+HISTORY_PRUNE_BATCH = int(os.getenv('HISTORY_PRUNE_BATCH', '1000'))
+HISTORY_PRUNE_PAUSE = float(os.getenv('HISTORY_PRUNE_PAUSE', '0.05'))
+
+
+def retention_enabled() -> bool:
+    return HISTORY_MAX_AGE_DAYS > 0 or HISTORY_MAX_ROWS_PER_USER > 0
+
+
+def _expired_batch(session, limit: int) -> list:
+    """Oldest messages past the maximum age"""
+    if HISTORY_MAX_AGE_DAYS <= 0:
+        return []
+    threshold = datetime.utcnow() - timedelta(days=HISTORY_MAX_AGE_DAYS)
+    return session.query(Message, User.telegram_id, User.history_cutoff_id)\
+        .join(User, Message.user_id == User.id)\
+        .filter(Message.timestamp < threshold)\
+        .order_by(Message.id)\
+        .limit(limit)\
+        .all()
+
+
+def _over_limit_users(session) -> List[int]:
+    """Row ids of the users with more messages than the per-user limit"""
+    if HISTORY_MAX_ROWS_PER_USER <= 0:
+        return []
+    rows = session.query(Message.user_id)\
+        .group_by(Message.user_id)\
+        .having(func.count(Message.id) > HISTORY_MAX_ROWS_PER_USER)\
+        .all()
+    return [user_db_id for user_db_id, in rows]
+
+
+def _overflow_batch(session, user_db_id: int, limit: int) -> list:
+    """Oldest messages of a user beyond the per-user row limit"""
+    # Newest message that falls outside the limit; it and everything older go
+    boundary = session.query(Message.timestamp, Message.id)\
+        .filter(Message.user_id == user_db_id)\
+        .order_by(Message.timestamp.desc(), Message.id.desc())\
+        .offset(HISTORY_MAX_ROWS_PER_USER)\
+        .limit(1)\
+        .first()
+    if boundary is None:
+        return []
+    return session.query(Message, User.telegram_id, User.history_cutoff_id)\
+        .join(User, Message.user_id == User.id)\
+        .filter(Message.user_id == user_db_id)\
+        .filter(tuple_(Message.timestamp, Message.id) <= tuple_(*boundary))\
+        .order_by(Message.timestamp, Message.id)\
+        .limit(limit)\
+        .all()
+
+
+def archive_record(message: Message, telegram_id: int) -> dict:
+    return {
+        'id': message.id,
+        'telegram_id': telegram_id,
+        'role': message.role,
+        'content': message.content,
+        'timestamp': message.timestamp.isoformat() if message.timestamp else None,
+    }
+
+
+def write_archive(records: Iterable[dict], archive_dir: str) -> List[Path]:
+    """Append records to gzip JSONL files partitioned by message date.
+
+    Each call appends a new gzip member, which gzip readers treat as one stream.
+    """
+    by_date = defaultdict(list)
+    for record in records:
+        by_date[(record['timestamp'] or 'unknown')[:10]].append(record)
+    written = []
+    for date, day_records in sorted(by_date.items()):
+        path = Path(archive_dir) / 'messages' / f"{date}.jsonl.gz"
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with gzip.open(path, 'at', encoding='utf-8') as archive:
+            for record in day_records:
+                archive.write(json.dumps(record, ensure_ascii=False) + '\n')
+            archive.flush()
+            os.fsync(archive.fileno())
+        written.append(path)
+    return written
+
+
+def _collect_batch(session, limit: int, user_db_id: Optional[int] = None) -> Tuple[List[int], List[dict]]:
+    """Ids and archive records of one batch: expired messages, or one user's overflow"""
+    if user_db_id is None:
+        rows = _expired_batch(session, limit)
+    else:
+        rows = _overflow_batch(session, user_db_id, limit)
+    ids = [message.id for message, _, _ in rows]
+    # History the user cleared is deleted, not archived
+    records = [archive_record(message, telegram_id) for message, telegram_id, cutoff_id in rows
+               if message.id > (cutoff_id or 0)]
+    return ids, records
+
+
+def _delete_messages(session, ids: List[int]) -> int:
+    return session.query(Message).filter(Message.id.in_(ids)).delete(synchronize_session=False)
+
+
+async def prune_batch(limit: int, archive_dir: Optional[str], user_db_id: Optional[int] = None) -> int:
+    """Archive and delete one batch of messages outside the retention policy.
+
+    The batch is read from a read-only session and archived before the
+    delete, so the gzip and fsync work never holds the writer. Returns the
+    number of messages in the batch; 0 means nothing is left to prune.
+    """
+    ids, records = await run_read(_collect_batch, limit, user_db_id)
+    if not ids:
+        return 0
+    if archive_dir and records:
+        await asyncio.to_thread(write_archive, records, archive_dir)
+    await run_write(_delete_messages, ids)
+    return len(ids)
+
+
+async def _prune_until_done(user_db_id: Optional[int] = None) -> int:
+    total = 0
+    while True:
+        pruned = await prune_batch(HISTORY_PRUNE_BATCH, HISTORY_ARCHIVE_DIR, user_db_id)
+        total += pruned
+        if not pruned:
+            return total
+        await asyncio.sleep(HISTORY_PRUNE_PAUSE)
+
+
+async def prune_history() -> int:
+    """Prune in batches until the policy is met, yielding between batches.
+
+    Expired messages go first; users over the row limit are then found
+    once and pruned one after another.
+    """
+    total = 0
+    if HISTORY_MAX_AGE_DAYS > 0:
+        total += await _prune_until_done()
+    for user_db_id in await run_read(_over_limit_users):
+        total += await _prune_until_done(user_db_id)
+    return total
+
+
+def read_archive(path: str) -> Iterable[dict]:
+    with gzip.open(path, 'rt', encoding='utf-8') as archive:
+        for line in archive:
+            if line.strip():
+                yield json.loads(line)
+
+
+def _already_imported(session, user_db_id: int, record: dict, timestamp: Optional[datetime]) -> bool:
+    """Whether the user has a message with the record's timestamp, role and content"""
+    candidates = session.query(Message)\
+        .filter(Message.user_id == user_db_id)\
+        .filter(Message.timestamp == timestamp)\
+        .filter(Message.role == record['role'])\
+        .all()
+    return any(message.content == record['content'] for message in candidates)
+
+
+def import_archive(session_factory, paths: Iterable[str], batch_size: int = 1000) -> Tuple[int, int, int]:
+    """Re-import archived messages; returns (imported, skipped, cleared).
+
+    A message the user already has (same timestamp, role and content) was
+    imported before and is skipped, so re-running an import is safe.
+    Messages at or below the user's /clear_history cutoff were cleared
+    after they were archived; they are not restored and are counted as
+    cleared. The rest keep their original id when it is free and are
+    added to the /search index.
+    """
+    imported = skipped = cleared = 0
+    with session_factory() as session:
+        users = {}
+        pending = []
+
+        def commit_pending():
+            # Ids are known once the batch is flushed; index it in the same transaction
+            session.flush()
+            for message in pending:
+                index_message(session, message.id, message.user_id, message.content)
+            session.commit()
+            pending.clear()
+
+        for path in paths:
+            for record in read_archive(path):
+                telegram_id = record['telegram_id']
+                if telegram_id not in users:
+                    user = session.query(User).filter_by(telegram_id=telegram_id).first()
+                    if not user:
+                        user = User(telegram_id=telegram_id)
+                        session.add(user)
+                        session.flush()
+                    users[telegram_id] = (user.id, user.history_cutoff_id or 0)
+                user_db_id, cutoff_id = users[telegram_id]
+                if record['id'] <= cutoff_id:
+                    cleared += 1
+                    continue
+                timestamp = datetime.fromisoformat(record['timestamp']) if record['timestamp'] else None
+                # Autoflush makes messages added earlier in this run visible here
+                if _already_imported(session, user_db_id, record, timestamp):
+                    skipped += 1
+                    continue
+                id_taken = session.get(Message, record['id']) is not None
+                message = Message(
+                    id=None if id_taken else record['id'],
+                    user_id=user_db_id,
+                    role=record['role'],
+                    content=record['content'],
+                    timestamp=timestamp,
+                )
+                session.add(message)
+                pending.append(message)
+                imported += 1
+                if len(pending) >= batch_size:
+                    commit_pending()
+        commit_pending()
+    return imported, skipped, cleared
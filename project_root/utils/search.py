@@ -0,0 +1,255 @@
+import re
+import unicodedata
+from dataclasses import dataclass
+from datetime import datetime
+from typing import List, Optional, Tuple
+from sqlalchemy import inspect, text
+from sqlalchemy.orm import sessionmaker
+
+# Full-text index over message history. It holds only the index, not the
+# text: snippets are cut from the messages themselves, which may be stored
+# compressed. SQLite uses a contentless FTS5 table with bm25 ranking,
+# Postgres a tsvector column with a GIN index; other databases have no search.
+SEARCH_TABLE = 'message_search'
+
+SQLITE_SCHEMA = [
+    # owner holds "u<user id>" so the per-user filter is part of the FTS match
+    # instead of a post-filter over every user's hits
+    f"""CREATE VIRTUAL TABLE {SEARCH_TABLE} USING fts5(
+        content, owner, content = '', tokenize = 'unicode61 remove_diacritics 2'
+    )""",
+    # A contentless table forgets a row only when given the text it indexed;
+    # message_text() (see utils.database) decompresses it. Messages that were
+    # never indexed have no docsize row and are skipped.
+    f"""CREATE TRIGGER IF NOT EXISTS messages_search_delete AFTER DELETE ON messages
+    WHEN EXISTS (SELECT 1 FROM {SEARCH_TABLE}_docsize WHERE id = old.id) BEGIN
+        INSERT INTO {SEARCH_TABLE} ({SEARCH_TABLE}, rowid, content, owner) VALUES (
+            'delete', old.id,
+            message_text(old.content, old.content_format, old.content_compressed),
+            'u' || old.user_id
+        );
+    END""",
+]
+
+POSTGRES_SCHEMA = [
+    f"""CREATE TABLE IF NOT EXISTS {SEARCH_TABLE} (
+        message_id INTEGER PRIMARY KEY REFERENCES messages(id) ON DELETE CASCADE,
+        user_id INTEGER NOT NULL,
+        document TSVECTOR NOT NULL
+    )""",
+    f"CREATE INDEX IF NOT EXISTS ix_{SEARCH_TABLE}_document ON {SEARCH_TABLE} USING GIN (document)",
+    f"CREATE INDEX IF NOT EXISTS ix_{SEARCH_TABLE}_user ON {SEARCH_TABLE} (user_id)",
+]
+
+SNIPPET_START, SNIPPET_END = '«', '»'
+# Words shown around the first match
+SNIPPET_WORDS = 16
+# Runs of letters and digits, as the unicode61 tokenizer splits them
+WORD_RE = re.compile(r'[^\W_]+')
+
+
+@dataclass
+class SearchResult:
+    message_id: int
+    timestamp: datetime
+    role: str
+    snippet: str
+
+
+def search_supported(dialect_name: str) -> bool:
+    return dialect_name in ('sqlite', 'postgresql')
+
+
+def _search_table_outdated(engine) -> bool:
+    """Whether the search table is an older layout that kept a copy of the text"""
+    with engine.connect() as connection:
+        if engine.dialect.name == 'sqlite':
+            sql = connection.execute(
+                text("SELECT sql FROM sqlite_master WHERE name = :name"), {'name': SEARCH_TABLE}
+            ).scalar()
+            return "content = ''" not in sql
+    return any(column['name'] == 'content' for column in inspect(engine).get_columns(SEARCH_TABLE))
+
+
+def create_search_schema(engine):
+    """Create the search table and index messages saved before it existed.
+
+    A search table from before the index stopped keeping its own copy of
+    the text is replaced and rebuilt.
+    """
+    dialect = engine.dialect.name
+    if not search_supported(dialect):
+        return
+    if inspect(engine).has_table(SEARCH_TABLE):
+        if not _search_table_outdated(engine):
+            return
+        with engine.begin() as connection:
+            connection.execute(text("DROP TRIGGER IF EXISTS messages_search_delete"))
+            connection.execute(text(f"DROP TABLE {SEARCH_TABLE}"))
+    statements = SQLITE_SCHEMA if dialect == 'sqlite' else POSTGRES_SCHEMA
+    with engine.begin() as connection:
+        for statement in statements:
+            connection.execute(text(statement))
+    # Read through the model, which decompresses stored content
+    rebuild_search_index(sessionmaker(bind=engine))
+
+
+def index_message(session, message_id: int, user_db_id: int, content: Optional[str]):
+    """Add a message to the search index in the caller's transaction"""
+    if not content:
+        return
+    dialect = session.get_bind().dialect.name
+    if dialect == 'sqlite':
+        session.execute(
+            text(f"INSERT INTO {SEARCH_TABLE} (rowid, content, owner) VALUES (:id, :content, :owner)"),
+            {'id': message_id, 'content': content, 'owner': f"u{user_db_id}"}
+        )
+    elif dialect == 'postgresql':
+        session.execute(
+            text(f"INSERT INTO {SEARCH_TABLE} (message_id, user_id, document) "
+                 "VALUES (:id, :user_id, to_tsvector('simple', :content))"),
+            {'id': message_id, 'user_id': user_db_id, 'content': content}
+        )
+
+
+def _fold(word: str) -> str:
+    """Case- and diacritic-insensitive form of a word, as the index compares them"""
+    decomposed = unicodedata.normalize('NFKD', word.casefold())
+    return ''.join(char for char in decomposed if not unicodedata.combining(char))
+
+
+def make_snippet(content: str, query: str, size: int = SNIPPET_WORDS) -> str:
+    """Up to size words of content around the first match, with matches marked.
+
+    Query words match whole words; the last one also matches as a prefix.
+    """
+    words = [_fold(word) for word in WORD_RE.findall(query)]
+    tokens = list(WORD_RE.finditer(content))
+    if not tokens or not words:
+        return content
+    exact, prefix = set(words), words[-1]
+    folded = [_fold(token.group()) for token in tokens]
+    hits = {index for index, word in enumerate(folded) if word in exact or word.startswith(prefix)}
+    first = min(hits) if hits else 0
+    start = max(0, min(first - 2, len(tokens) - size))
+    end = min(len(tokens), start + size)
+
+    parts = ['…'] if start > 0 else []
+    position = tokens[start].start()
+    for index in range(start, end):
+        token = tokens[index]
+        parts.append(content[position:token.start()])
+        parts.append(f"{SNIPPET_START}{token.group()}{SNIPPET_END}" if index in hits else token.group())
+        position = token.end()
+    if end < len(tokens):
+        parts.append('…')
+    return ''.join(parts)
+
+
+def fts5_query(query: str) -> Optional[str]:
+    """Turn free text into an FTS5 expression matching all words.
+
+    Each word is quoted so FTS5 operators and punctuation in user input are
+    taken literally; the last word also matches as a prefix.
+    """
+    words = [word.replace('"', '""') for word in query.split()]
+    if not words:
+        return None
+    terms = [f'"{word}"' for word in words]
+    terms[-1] += '*'
+    return ' '.join(terms)
+
+
+def search_messages(session, telegram_id: int, query: str,
+                    offset: int = 0, limit: int = 5) -> Tuple[List[SearchResult], bool]:
+    """Rank the user's messages matching query; returns a page and whether more follow.
+
+    Messages hidden by /clear_history (up to the user's cutoff) are excluded.
+    """
+    dialect = session.get_bind().dialect.name
+    user = session.execute(
+        text("SELECT id, history_cutoff_id FROM users WHERE telegram_id = :telegram_id"),
+        {'telegram_id': telegram_id}
+    ).first()
+    if user is None or not query.strip():
+        return [], False
+    params = {'user_id': user.id, 'cutoff': user.history_cutoff_id or 0, 'limit': limit + 1, 'offset': offset}
+
+    if dialect == 'sqlite':
+        match = fts5_query(query)
+        if match is None:
+            return [], False
+        params['match'] = f'owner : "u{user.id}" AND content : ({match})'
+        statement = text(f"""
+            SELECT m.id, m.timestamp, m.role
+            FROM {SEARCH_TABLE}
+            JOIN messages m ON m.id = {SEARCH_TABLE}.rowid
+            WHERE {SEARCH_TABLE} MATCH :match AND m.id > :cutoff
+            ORDER BY bm25({SEARCH_TABLE}), m.id DESC
+            LIMIT :limit OFFSET :offset
+        """)
+    elif dialect == 'postgresql':
+        params['query'] = query
+        statement = text(f"""
+            SELECT m.id, m.timestamp, m.role
+            FROM {SEARCH_TABLE} s
+            JOIN messages m ON m.id = s.message_id,
+                 plainto_tsquery('simple', :query) q
+            WHERE s.user_id = :user_id AND s.document @@ q AND m.id > :cutoff
+            ORDER BY ts_rank_cd(s.document, q) DESC, m.id DESC
+            LIMIT :limit OFFSET :offset
+        """)
+    else:
+        return [], False
+
+    rows = session.execute(statement, params).all()
+    page = rows[:limit]
+    # Only the page's messages are loaded, through the model so compressed text is read too
+    from utils.database import Message
+    contents = {
+        message.id: message.content
+        for message in session.query(Message).filter(Message.id.in_([row.id for row in page]))
+    }
+    results = [
+        SearchResult(
+            message_id=row.id,
+            # SQLite returns the stored text for raw SQL
+            timestamp=datetime.fromisoformat(row.timestamp) if isinstance(row.timestamp, str) else row.timestamp,
+            role=row.role,
+            snippet=make_snippet(contents.get(row.id) or '', query),
+        )
+        for row in page
+    ]
+    return results, len(rows) > limit
+
+
+def rebuild_search_index(session_factory, batch_size: int = 1000) -> int:
+    """Re-index every message from the Message model; returns the count"""
+    from utils.database import Message
+    with session_factory() as session:
+        dialect = session.get_bind().dialect.name
+        if not search_supported(dialect):
+            return 0
+        if dialect == 'sqlite':
+            # The only way to empty a contentless FTS5 table
+            session.execute(text(f"INSERT INTO {SEARCH_TABLE} ({SEARCH_TABLE}) VALUES ('delete-all')"))
+        else:
+            session.execute(text(f"DELETE FROM {SEARCH_TABLE}"))
+        indexed = 0
+        last_id = 0
+        while True:
+            messages = session.query(Message)\
+                .filter(Message.id > last_id)\
+                .order_by(Message.id)\
+                .limit(batch_size)\
+                .all()
+            if not messages:
+                break
+            for message in messages:
+                index_message(session, message.id, message.user_id, message.content)
+            indexed += len(messages)
+            last_id = messages[-1].id
+            session.commit()
+            session.expunge_all()
+        session.commit()
+        return indexed
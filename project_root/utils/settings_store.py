@@ -0,0 +1,181 @@
+import os
+import time
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+from utils.database import DEFAULT_BASE_URL, ImageSettings, User, UserSettings, run_read, run_write
+
+# Settings every user starts with. Rows in user_settings and image_settings
+# only hold what a user changed: a NULL column inherits the value below, and
+# users who never opened /settings have no row at all.
+DEFAULT_TEXT_SETTINGS = {
+    'base_url': DEFAULT_BASE_URL,
+    'model': os.getenv('DEFAULT_TEXT_MODEL', 'gpt-3.5-turbo'),
+    'temperature': float(os.getenv('DEFAULT_TEMPERATURE', '0.7')),
+    'max_tokens': int(os.getenv('DEFAULT_MAX_TOKENS', '1000')),
+    'use_assistant': False,
+    'assistant_url': None,
+}
+
+DEFAULT_IMAGE_SETTINGS = {
+    'base_url': DEFAULT_BASE_URL,
+    'model': os.getenv('DEFAULT_IMAGE_MODEL', 'dall-e-3'),
+    'size': '1024x1024',
+    'quality': 'standard',
+    'style': 'natural',
+    'hdr': False,
+}
+
+# Resolved settings are cached per user; writes made by this process update
+# the cache, writes from elsewhere (manage.py) are picked up after the TTL
+SETTINGS_CACHE_SIZE = int(os.getenv('SETTINGS_CACHE_SIZE', '10000'))
+SETTINGS_CACHE_TTL = float(os.getenv('SETTINGS_CACHE_TTL', '300'))
+
+
+def resolve_settings(overrides: Dict, defaults: Dict) -> dict:
+    """Overlay a user's non-NULL overrides on the defaults"""
+    resolved = dict(defaults)
+    resolved.update((key, value) for key, value in overrides.items() if value is not None)
+    return resolved
+
+
+class SettingsStore:
+    """Per-user settings of one kind: defaults plus sparse overrides.
+
+    Reads never write. An override equal to the default is stored as NULL,
+    and a row left with only NULLs is deleted, so the table holds only
+    users who differ from the defaults.
+    """
+
+    def __init__(self, model, defaults: Dict, cache_size: int = SETTINGS_CACHE_SIZE,
+                 cache_ttl: float = SETTINGS_CACHE_TTL):
+        self.model = model
+        self.defaults = defaults
+        self.fields = tuple(defaults)
+        self.cache_size = cache_size
+        self.cache_ttl = cache_ttl
+        self._cache: 'OrderedDict[int, Tuple[float, dict]]' = OrderedDict()
+
+    async def get(self, telegram_id: int) -> dict:
+        """Resolved settings for a user; a copy the caller may modify"""
+        cached = self._cache_get(telegram_id)
+        if cached is None:
+            overrides = await run_read(self._load_overrides, telegram_id)
+            cached = resolve_settings(overrides, self.defaults)
+            self._cache_put(telegram_id, cached)
+        return dict(cached)
+
+    async def get_overrides(self, telegram_id: int) -> dict:
+        """Only the values the user set themselves"""
+        return await run_read(self._load_overrides, telegram_id)
+
+    async def update(self, telegram_id: int, **changes) -> dict:
+        """Set some settings for a user and return the resolved settings.
+
+        A value of None, or one equal to the default, resets that setting.
+        """
+        unknown = set(changes) - set(self.fields)
+        if unknown:
+            raise ValueError(f"Unknown settings: {', '.join(sorted(unknown))}")
+        overrides = await run_write(self._save_overrides, telegram_id, changes)
+        resolved = resolve_settings(overrides, self.defaults)
+        self._cache_put(telegram_id, resolved)
+        return dict(resolved)
+
+    async def reset(self, telegram_id: int) -> dict:
+        """Drop all of a user's overrides"""
+        return await self.update(telegram_id, **{field: None for field in self.fields})
+
+    def invalidate(self, telegram_id: Optional[int] = None):
+        """Forget cached settings for one user, or for everyone"""
+        if telegram_id is None:
+            self._cache.clear()
+        else:
+            self._cache.pop(telegram_id, None)
+
+    def _cache_get(self, telegram_id: int) -> Optional[dict]:
+        entry = self._cache.get(telegram_id)
+        if entry is None:
+            return None
+        stored_at, settings = entry
+        if time.monotonic() - stored_at > self.cache_ttl:
+            del self._cache[telegram_id]
+            return None
+        self._cache.move_to_end(telegram_id)
+        return settings
+
+    def _cache_put(self, telegram_id: int, settings: dict):
+        if self.cache_size <= 0:
+            return
+        self._cache[telegram_id] = (time.monotonic(), settings)
+        self._cache.move_to_end(telegram_id)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    def _row_overrides(self, row) -> dict:
+        if row is None:
+            return {}
+        values = {field: getattr(row, field) for field in self.fields}
+        return {field: value for field, value in values.items() if value is not None}
+
+    def _load_overrides(self, session, telegram_id: int) -> dict:
+        row = session.query(self.model)\
+            .join(User, self.model.user_id == User.id)\
+            .filter(User.telegram_id == telegram_id)\
+            .first()
+        return self._row_overrides(row)
+
+    def _save_overrides(self, session, telegram_id: int, changes: Dict) -> dict:
+        user = session.query(User).filter_by(telegram_id=telegram_id).first()
+        if not user:
+            user = User(telegram_id=telegram_id)
+            session.add(user)
+            session.flush()
+        row = session.query(self.model).filter_by(user_id=user.id).first()
+        if row is None:
+            row = self.model(user_id=user.id)
+            session.add(row)
+        for field, value in changes.items():
+            setattr(row, field, None if value == self.defaults[field] else value)
+        overrides = self._row_overrides(row)
+        if not overrides:
+            if row in session.new:
+                session.expunge(row)
+            else:
+                session.delete(row)
+        return overrides
+
+    def compact(self, session_factory, batch_size: int = 500) -> Tuple[int, int]:
+        """Reset stored values equal to the defaults and drop rows left empty.
+
+        Rows written before settings were sparse hold every value; returns
+        (rows kept, rows deleted).
+        """
+        kept = deleted = 0
+        last_id = 0
+        with session_factory() as session:
+            while True:
+                rows = session.query(self.model)\
+                    .filter(self.model.id > last_id)\
+                    .order_by(self.model.id)\
+                    .limit(batch_size)\
+                    .all()
+                if not rows:
+                    break
+                for row in rows:
+                    for field in self.fields:
+                        if getattr(row, field) == self.defaults[field]:
+                            setattr(row, field, None)
+                    if self._row_overrides(row):
+                        kept += 1
+                    else:
+                        session.delete(row)
+                        deleted += 1
+                last_id = rows[-1].id
+                session.commit()
+                session.expunge_all()
+        self.invalidate()
+        return kept, deleted
+
+
+text_settings = SettingsStore(UserSettings, DEFAULT_TEXT_SETTINGS)
+image_settings = SettingsStore(ImageSettings, DEFAULT_IMAGE_SETTINGS)
@@ -0,0 +1,60 @@
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, Hashable, Tuple
+
+
+def normalize_prompt(text: str) -> str:
+    """Normalize prompt text so trivially different requests share a key"""
+    return ' '.join((text or '').split())
+
+
+class _LeaderCancelled(Exception):
+    """The call a follower was waiting for was cancelled"""
+
+
+class SingleFlight:
+    """Deduplicate concurrent calls that share the same key.
+
+    The first caller for a key runs the upstream call; callers arriving while
+    it is still in flight wait for the same future instead of issuing their own.
+    """
+
+    def __init__(self):
+        self._calls: Dict[Hashable, asyncio.Future] = {}
+
+    def in_flight(self) -> int:
+        """Number of upstream calls currently running"""
+        return len(self._calls)
+
+    async def do(self, key: Hashable, func: Callable[[], Awaitable[Any]]) -> Tuple[Any, bool]:
+        """Run func once per key; returns (result, shared)"""
+        while True:
+            future = self._calls.get(key)
+            if future is None:
+                break
+            try:
+                # Shield so a cancelled follower does not cancel the leader's call
+                return await asyncio.shield(future), True
+            except _LeaderCancelled:
+                # The first follower to wake up runs the call in the leader's place
+                continue
+
+        future = asyncio.get_running_loop().create_future()
+        self._calls[key] = future
+        try:
+            result = await func()
+        except asyncio.CancelledError:
+            # Cancelling the future would cancel every follower too
+            future.set_exception(_LeaderCancelled())
+            future.exception()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # Mark the exception as retrieved in case nobody else was waiting
+            future.exception()
+            raise
+        else:
+            future.set_result(result)
+            return result, False
+        finally:
+            if self._calls.get(key) is future:
+                del self._calls[key]
@@ -0,0 +1,26 @@
+import time
+from typing import Optional
+from telegram.request import HTTPXRequest
+from utils.metrics import TELEGRAM_REQUEST_SECONDS, TELEGRAM_RATE_LIMITED
+
+
+class InstrumentedRequest(HTTPXRequest):
+    """HTTPXRequest that records Bot API call latency and 429 responses"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Monotonic time of the last response; for the getUpdates request this
+        # tells whether polling is still making progress
+        self.last_response_at: Optional[float] = None
+
+    async def do_request(self, url: str, method: str, *args, **kwargs):
+        api_method = url.rsplit('/', 1)[-1]
+        started = time.perf_counter()
+        try:
+            code, payload = await super().do_request(url, method, *args, **kwargs)
+            self.last_response_at = time.monotonic()
+        finally:
+            TELEGRAM_REQUEST_SECONDS.labels(method=api_method).observe(time.perf_counter() - started)
+        if code == 429:
+            TELEGRAM_RATE_LIMITED.labels(method=api_method).inc()
+        return code, payload
@@ -0,0 +1,145 @@
+import json
+import logging
+import os
+import queue
+import random
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from logging.handlers import QueueListener
+from typing import Any, Dict, Iterator, Optional
+from utils.logging_config import DroppingQueueHandler, trace_active
+
+# Spans are written as OTLP/JSON lines (one ExportTraceServiceRequest per line),
+# which an OpenTelemetry collector's otlpjsonfile receiver can ingest
+TRACING_EXPORT_FILE = os.getenv('TRACING_EXPORT_FILE')
+SPAN_SAMPLE_RATE = float(os.getenv('SPAN_SAMPLE_RATE', '1'))
+SERVICE_NAME = os.getenv('TRACING_SERVICE_NAME', 'gpt-telegram-bot')
+
+_current_span: ContextVar[Optional['Span']] = ContextVar('current_span', default=None)
+
+
+class Span:
+    """A timed operation within a trace"""
+    __slots__ = ('name', 'trace_id', 'span_id', 'parent_id', 'sampled',
+                 'start_ns', 'end_ns', 'attributes', 'error')
+
+    def __init__(self, name: str, parent: Optional['Span'] = None, sampled: bool = True):
+        self.name = name
+        self.trace_id = parent.trace_id if parent else f"{random.getrandbits(128):032x}"
+        self.span_id = f"{random.getrandbits(64):016x}"
+        self.parent_id = parent.span_id if parent else None
+        self.sampled = sampled
+        self.start_ns = time.time_ns()
+        self.end_ns = None
+        self.attributes: Dict[str, Any] = {}
+        self.error: Optional[str] = None
+
+    def set_attribute(self, key: str, value: Any):
+        self.attributes[key] = value
+
+    def to_otlp(self) -> dict:
+        span = {
+            'traceId': self.trace_id,
+            'spanId': self.span_id,
+            'name': self.name,
+            'kind': 1,  # SPAN_KIND_INTERNAL
+            'startTimeUnixNano': str(self.start_ns),
+            'endTimeUnixNano': str(self.end_ns),
+            'attributes': [_otlp_attribute(k, v) for k, v in self.attributes.items()],
+            'status': {'code': 2, 'message': self.error} if self.error else {'code': 1},
+        }
+        if self.parent_id:
+            span['parentSpanId'] = self.parent_id
+        return span
+
+
+def _otlp_attribute(key: str, value: Any) -> dict:
+    if isinstance(value, bool):
+        typed = {'boolValue': value}
+    elif isinstance(value, int):
+        typed = {'intValue': str(value)}
+    elif isinstance(value, float):
+        typed = {'doubleValue': value}
+    else:
+        typed = {'stringValue': str(value)}
+    return {'key': key, 'value': typed}
+
+
+class SpanExporter:
+    """Write finished spans to a file from a background thread"""
+
+    def __init__(self, path: str):
+        # Reuse the logging queue machinery so file writes never block the loop
+        self._queue = queue.Queue(maxsize=10000)
+        handler = logging.FileHandler(path, encoding='utf-8')
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        self._listener = QueueListener(self._queue, handler)
+        self._listener.start()
+        self._logger = logging.Logger('tracing.export')
+        self._logger.propagate = False
+        # Spans are dropped rather than blocking when the writer falls behind
+        self._logger.addHandler(DroppingQueueHandler(self._queue))
+
+    def export(self, span: Span):
+        request = {
+            'resourceSpans': [{
+                'resource': {'attributes': [_otlp_attribute('service.name', SERVICE_NAME)]},
+                'scopeSpans': [{'scope': {'name': 'bot'}, 'spans': [span.to_otlp()]}],
+            }]
+        }
+        self._logger.info(json.dumps(request, ensure_ascii=False))
+
+    def shutdown(self):
+        self._listener.stop()
+
+
+_exporter: Optional[SpanExporter] = None
+
+
+def _get_exporter() -> Optional[SpanExporter]:
+    global _exporter
+    if _exporter is None and TRACING_EXPORT_FILE:
+        _exporter = SpanExporter(TRACING_EXPORT_FILE)
+    return _exporter
+
+
+def current_span() -> Optional[Span]:
+    span = _current_span.get()
+    return span if span is not None and span.sampled else None
+
+
+@contextmanager
+def start_span(name: str, **attributes) -> Iterator[Optional[Span]]:
+    """Open a child of the current span, or a new sampled root span.
+
+    Yields None when tracing is disabled or the trace was not sampled.
+    """
+    if not TRACING_EXPORT_FILE:
+        yield None
+        return
+
+    parent = _current_span.get()
+    if parent is None:
+        # Updates picked for debug tracing (/loglevel) are always recorded
+        sampled = trace_active() or random.random() < SPAN_SAMPLE_RATE
+    else:
+        sampled = parent.sampled
+    span = Span(name, parent, sampled)
+    token = _current_span.set(span)
+    try:
+        if not sampled:
+            yield None
+            return
+        span.attributes.update(attributes)
+        yield span
+    except Exception as e:
+        span.error = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        _current_span.reset(token)
+        if sampled:
+            span.end_ns = time.time_ns()
+            exporter = _get_exporter()
+            if exporter:
+                exporter.export(span)
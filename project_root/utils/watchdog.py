@@ -0,0 +1,87 @@
+import asyncio
+import os
+import sys
+import threading
+import time
+import traceback
+from typing import Optional
+
+from utils.logging_config import setup_logging
+from utils.metrics import EVENT_LOOP_LAG_SECONDS, EVENT_LOOP_STALLS
+
+logger = setup_logging(__name__)
+
+
+class LoopWatchdog:
+    """Measure event loop lag and report what is blocking the loop when it stalls.
+
+    A coroutine wakes up every `interval` seconds and records how late it ran.
+    A helper thread watches that heartbeat; when the loop has not ticked for
+    `threshold` seconds it logs the loop thread's current stack, which points
+    at the sync call (DB query, PIL encode, ...) holding the loop.
+    """
+
+    def __init__(self, interval: float = 0.1, threshold: Optional[float] = None,
+                 dump_cooldown: float = 30.0):
+        self.interval = interval
+        self.threshold = threshold if threshold is not None else float(
+            os.getenv('LOOP_LAG_THRESHOLD', '0.5')
+        )
+        self.dump_cooldown = dump_cooldown
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+        self._heartbeat = time.monotonic()
+        self._loop_thread_id: Optional[int] = None
+        self._last_dump = 0.0
+        self._task: Optional[asyncio.Task] = None
+        self._stopped = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        """Start watching the running event loop"""
+        self._loop_thread_id = threading.get_ident()
+        self._heartbeat = time.monotonic()
+        self._stopped.clear()
+        self._task = asyncio.get_running_loop().create_task(self._measure())
+        self._thread = threading.Thread(target=self._watch, name='loop-watchdog', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._task:
+            self._task.cancel()
+            self._task = None
+
+    def seconds_since_heartbeat(self) -> float:
+        return time.monotonic() - self._heartbeat
+
+    async def _measure(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            started = loop.time()
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, loop.time() - started - self.interval)
+            self._heartbeat = time.monotonic()
+            self.last_lag = lag
+            self.max_lag = max(self.max_lag, lag)
+            EVENT_LOOP_LAG_SECONDS.observe(lag)
+            if lag > self.threshold:
+                EVENT_LOOP_STALLS.inc()
+                logger.warning(f"Event loop was blocked for {lag:.3f}s")
+
+    def _watch(self):
+        while not self._stopped.wait(self.interval):
+            stalled_for = self.seconds_since_heartbeat() - self.interval
+            if stalled_for < self.threshold:
+                continue
+            now = time.monotonic()
+            if now - self._last_dump < self.dump_cooldown:
+                continue
+            self._last_dump = now
+            frame = sys._current_frames().get(self._loop_thread_id)
+            if frame is None:
+                continue
+            stack = ''.join(traceback.format_stack(frame))
+            logger.warning(
+                f"Event loop blocked for {stalled_for:.3f}s so far, loop thread stack:\n{stack}"
+            )